@@ -0,0 +1,651 @@
+#!/usr/bin/env python
+"""benchMy2pg.py: microbenchmarks for the conversion paths of my2pg.py
+
+Usage: benchMy2pg.py [options] [benchmark ...]
+
+Runs every benchmark if none are named.  Only the server part of the
+'dates' and 'geometry' benchmarks needs a MySQL server, and is skipped
+unless --mysql-table is given; --pg-dsn is used to let psycopg2 pick
+the escaping the server would get, and by 'geometry' to time loading
+polygons as WKT and as EWKB (which needs PostGIS).
+
+The 'pipeline' benchmark loads a synthetic table from a MemorySource
+into a FileSink and reports the throughput and peak memory of each
+stage, and 'copy' times COPY of numeric and temporal columns in text
+and binary format (loading them too with --pg-dsn).  --save writes its
+results to a file, and --compare fails if a later run is more than
+--tolerance slower than the saved one.
+"""
+import os
+import sys
+import json
+import time
+import random
+import struct
+import datetime
+import optparse
+import resource
+import multiprocessing
+
+import psycopg2
+from psycopg2.extensions import adapt
+
+import my2pg
+
+
+def octal_blob(data):
+    """(str): str
+
+    The octal-escape BYTEA conversion that convert_data() used to do.
+    """
+    return ''.join([('\\%03o') % ord(ch) for ch in data])
+
+
+def timed(func, repeat):
+    """(callable, int): float
+
+    Return the number of seconds it takes to call func() repeat times.
+    """
+    start = time.time()
+    for i in xrange(repeat):
+        func()
+    return time.time() - start
+
+
+def quoted(value, pg_conn):
+    """(any, Connection): str
+
+    Return the SQL literal psycopg2 would send for a query parameter.
+    """
+    a = adapt(value)
+    if pg_conn is not None and hasattr(a, 'prepare'):
+        a.prepare(pg_conn)
+    return a.getquoted()
+
+
+def report(cases, repeat, size, unit='bytes'):
+    """([(str, callable)], int, int, str)
+
+    Time each case and print its throughput, given that one call
+    processes 'size' bytes (or whatever 'unit' says).
+    """
+    for name, func in cases:
+        elapsed = timed(func, repeat)
+        if unit == 'bytes':
+            print '  %-28s %10.1f MB/s %10.1f calls/s' % (
+                name, size * repeat / elapsed / 1e6, repeat / elapsed)
+        else:
+            print '  %-28s %10.1f %s/s' % (
+                name, size * repeat / elapsed, unit)
+
+
+def bench_blob(options, pg_conn):
+    """BYTEA conversion: octal escapes versus Binary/hex."""
+    data = os.urandom(options.blob_size)
+    cases = [
+        ('octal INSERT parameter',
+         lambda: quoted(octal_blob(data), pg_conn)),
+        ('Binary INSERT parameter',
+         lambda: quoted(my2pg.convert_blob(data), pg_conn)),
+        ('octal COPY field',
+         lambda: my2pg.copy_format(octal_blob(data))),
+        ('hex COPY field',
+         lambda: my2pg.copy_format(my2pg.convert_blob(data))),
+    ]
+    report(cases, options.repeat, len(data))
+
+
+def cpu_time():
+    """(): float
+
+    Return the user and system CPU time used by this process.
+    """
+    t = os.times()
+    return t[0] + t[1]
+
+
+def bench_dates(options, pg_conn):
+    """Zero-date replacement: DATE_FORMAT on MySQL versus in Python."""
+    cols = [my2pg.Column(name='d%i' % i, type=typ, default=None,
+                         is_nullable=bool(i % 2), auto_increment=False)
+            for i, typ in enumerate(['date', 'datetime'] * 3)]
+    server_plan = my2pg.TablePlan('public', 't', cols, [])
+    client_plan = my2pg.TablePlan('public', 't', cols, [], client_dates=True)
+    # What the driver returns for each strategy; one value in ten is zero.
+    day = datetime.datetime(2010, 5, 1, 12, 30)
+    server_rows = [tuple(i % 10 and '2010-05-01 12:30:00' or None
+                         for c in cols) for i in range(1000)]
+    client_rows = [tuple(i % 10 and day or my2pg.ZERO_DATE for c in cols)
+                   for i in range(1000)]
+
+    def convert(plan, rows):
+        def run():
+            my2pg.CopyRowStream(map(plan.convert_row, rows)).read(-1)
+        return run
+
+    print '  client side, 1000 rows of %i date columns:' % len(cols)
+    report([('server strategy', convert(server_plan, server_rows)),
+            ('client strategy', convert(client_plan, client_rows))],
+           options.repeat, 1000, 'rows')
+
+    if not options.mysql_table:
+        print '  (give --mysql-table to measure the MySQL side)'
+        return
+    options.date_conversion = 'client'
+    mysql_conn, cols = read_mysql_table(options)
+    for client_dates in (False, True):
+        plan = my2pg.TablePlan('public', options.mysql_table, cols, [],
+                               client_dates)
+        read_table(mysql_conn, plan,
+                   client_dates and 'client strategy' or 'server strategy')
+    mysql_conn.close()
+
+
+def read_mysql_table(options):
+    """(Options): (Connection, [Column])
+
+    Connect to MySQL and return the columns of --mysql-table.
+    """
+    mysql_conn = my2pg.connect_mysql(options, options.mysql_host,
+                                     options.mysql_db)
+    mysql_cur = mysql_conn.cursor(cursorclass=my2pg.DictCursor)
+    tables, table_cols, table_indexes = my2pg.read_mysql_tables(
+        mysql_cur, options.mysql_db, options, [options.mysql_table])
+    mysql_cur.close()
+    return mysql_conn, table_cols[options.mysql_table]
+
+
+def read_table(mysql_conn, plan, name):
+    """(Connection, TablePlan, str)
+
+    Read a MySQL table with a plan, and print the rows/s, the time the
+    server takes for the SELECT list alone and the client's CPU time.
+    """
+    # Evaluate the SELECT list on the server without sending the
+    # rows, to see the server's share of the work.
+    mysql_cur = mysql_conn.cursor()
+    start = time.time()
+    mysql_cur.execute("SELECT BIT_XOR(CRC32(CONCAT_WS(',', %s))) "
+                      "FROM (%s) AS t" % (
+                          ', '.join('`%s`' % c.name for c in plan.columns),
+                          plan.select_sql))
+    mysql_cur.fetchall()
+    server_time = time.time() - start
+    mysql_cur.close()
+
+    mysql_cur = mysql_conn.cursor(cursorclass=my2pg.SSCursor)
+    start = time.time()
+    start_cpu = cpu_time()
+    mysql_cur.execute(plan.select_sql)
+    stream = my2pg.CopyRowStream(my2pg.iter_table_rows(mysql_cur, plan))
+    while stream.read():
+        pass
+    row_count = stream.row_count
+    elapsed = time.time() - start
+    client_cpu = cpu_time() - start_cpu
+    mysql_cur.close()
+    print ('  %-28s %10.1f rows/s  server %.2fs  client CPU %.2fs'
+           % (name, row_count / elapsed, server_time, client_cpu))
+
+
+def polygon(rng, points):
+    """(Random, int): (str, str)
+
+    Return a random polygon with 'points' vertices as MySQL's asText()
+    returns it and as MySQL stores it (SRID 0, then little-endian WKB).
+    """
+    coords = [(rng.uniform(-180, 180), rng.uniform(-90, 90))
+              for i in range(points - 1)]
+    coords.append(coords[0])
+    wkt = 'POLYGON((%s))' % ','.join('%r %r' % xy for xy in coords)
+    stored = (struct.pack('<IBIII', 0, 1, 3, 1, len(coords)) +
+              struct.pack('<%id' % (2 * len(coords)),
+                          *[v for xy in coords for v in xy]))
+    return wkt, stored
+
+
+def copy_geometries(pg_conn, values):
+    """(Connection, [any]): float
+
+    Return the seconds PostgreSQL takes to COPY the geometry values
+    into a temporary table.
+    """
+    cur = pg_conn.cursor()
+    cur.execute('CREATE TEMP TABLE bench_geometry (shape geometry)')
+    stream = my2pg.CopyRowStream([(v,) for v in values])
+    start = time.time()
+    cur.copy_expert('COPY bench_geometry FROM STDIN', stream)
+    elapsed = time.time() - start
+    pg_conn.rollback()
+    return elapsed
+
+
+def bench_geometry(options, pg_conn):
+    """Geometry transfer: WKT and ST_GeomFromText versus EWKB."""
+    rng = random.Random(options.seed)
+    polygons = [polygon(rng, options.polygon_points) for i in range(100)]
+    wkts = [wkt for wkt, stored in polygons]
+    stored = [data for wkt, data in polygons]
+    print '  client side, 100 polygons of %i points:' % options.polygon_points
+    report([('WKT COPY field',
+             lambda: [my2pg.copy_format(my2pg.GeometryText(w))
+                      for w in wkts]),
+            ('EWKB COPY field',
+             lambda: [my2pg.copy_format(my2pg.convert_geometry(d))
+                      for d in stored]),
+            ('WKT INSERT parameter',
+             lambda: [quoted(my2pg.GeometryText(w), pg_conn) for w in wkts]),
+            ('EWKB INSERT parameter',
+             lambda: [quoted(my2pg.convert_geometry(d), pg_conn)
+                      for d in stored])],
+           options.repeat, len(polygons), 'polygons')
+
+    if pg_conn is None:
+        print '  (give --pg-dsn to measure the PostgreSQL side)'
+    else:
+        try:
+            for name, values in (
+                    ('WKT COPY', [my2pg.GeometryText(w) for w in wkts]),
+                    ('EWKB COPY', [my2pg.convert_geometry(d)
+                                   for d in stored])):
+                elapsed = min(copy_geometries(pg_conn, values * 10)
+                              for i in range(3))
+                print '  %-28s %10.1f polygons/s' % (name,
+                                                     len(values) * 10 /
+                                                     elapsed)
+        except psycopg2.Error as err:
+            pg_conn.rollback()
+            print '  (PostGIS is needed on the PostgreSQL side: %s)' % (
+                str(err).strip())
+
+    if not options.mysql_table:
+        print '  (give --mysql-table to measure the MySQL side)'
+        return
+    mysql_conn, cols = read_mysql_table(options)
+    for wkb_geometry in (False, True):
+        plan = my2pg.TablePlan('public', options.mysql_table, cols, [],
+                               wkb_geometry=wkb_geometry)
+        read_table(mysql_conn, plan, wkb_geometry and 'EWKB' or 'WKT')
+    mysql_conn.close()
+
+
+def fact_table(options):
+    """(Options): (TablePlan, [tuple])
+
+    Return the plan of a table of integer, floating point and temporal
+    columns, and --rows converted rows for it, depending only on
+    --seed.
+    """
+    rng = random.Random(options.seed)
+    cols = [my2pg.Column(name=name, type=type, default=None,
+                         is_nullable=nullable, auto_increment=False)
+            for name, type, nullable in (
+                ('id', 'bigint(20)', False),
+                ('customer_id', 'int(11)', False),
+                ('store_id', 'smallint(6)', False),
+                ('quantity', 'int(11)', True),
+                ('price', 'double', False),
+                ('discount', 'float', True),
+                ('sold', 'datetime', False),
+                ('shipped', 'date', True),
+                ('duration', 'time', True))]
+    # pg_temp, so --pg-dsn loads a temporary table.
+    plan = my2pg.TablePlan('pg_temp', 'bench_fact', cols, [])
+    start = datetime.datetime(2010, 1, 1)
+    rows = []
+    for i in xrange(options.rows):
+        sold = start + datetime.timedelta(seconds=rng.randint(0, 3e8))
+        rows.append((i + 1, rng.randint(1, 10 ** 6), rng.randint(1, 500),
+                     rng.choice([None, rng.randint(1, 100)]),
+                     rng.uniform(0, 1000), rng.choice([None, rng.random()]),
+                     sold.strftime('%Y-%m-%d %H:%M:%S'),
+                     rng.choice([None, sold.strftime('%Y-%m-%d')]),
+                     datetime.timedelta(seconds=rng.randint(0, 86399))))
+    return plan, rows
+
+
+def drain(stream):
+    """(CopyRowStream): int
+
+    Read a COPY stream to the end and return the number of bytes.
+    """
+    size = 0
+    while True:
+        data = stream.read()
+        if not data:
+            return size
+        size += len(data)
+
+
+def bench_copy(options, pg_conn):
+    """COPY of numeric and temporal columns: text versus binary format."""
+    plan, rows = fact_table(options)
+    encoder = my2pg.binary_copy_encoder(plan)
+    streams = [
+        ('text COPY', lambda: my2pg.CopyRowStream(rows), plan.copy_sql),
+        ('binary COPY', lambda: my2pg.BinaryCopyRowStream(rows, encoder),
+         plan.copy_sql + ' (FORMAT binary)')]
+    print '  client side, %i rows:' % len(rows)
+    results = {}
+    for name, make_stream, sql in streams:
+        elapsed = min(timed(lambda: drain(make_stream()), 1)
+                      for i in range(options.stage_repeat))
+        size = drain(make_stream())
+        results['copy ' + name] = len(rows) / elapsed
+        print '  %-28s %10.1f rows/s %8.1f MB/s' % (
+            name, len(rows) / elapsed, size / elapsed / 1e6)
+
+    if pg_conn is None:
+        print '  (give --pg-dsn to measure the PostgreSQL side)'
+        return results
+    for name, make_stream, sql in streams:
+        best = None
+        for i in range(options.stage_repeat):
+            cur = pg_conn.cursor()
+            cur.execute('CREATE TEMP TABLE %s (%s)' % (
+                plan.table, ','.join(c.pg_decl() for c in plan.columns)))
+            start = time.time()
+            cur.copy_expert(sql, make_stream())
+            elapsed = time.time() - start
+            pg_conn.rollback()
+            best = min(best or elapsed, elapsed)
+        print '  %-28s %10.1f rows/s including the server' % (
+            name, len(rows) / best)
+    return results
+
+
+def synthetic_table(options):
+    """(Options): (TablePlan, [tuple])
+
+    Return the plan of a table with --width text columns, a BLOB of
+    --row-blob-size bytes, a point, nullable dates and an enum, and
+    --rows rows for it as MySQL would return them for select_sql.
+    The rows depend only on --seed.
+    """
+    rng = random.Random(options.seed)
+
+    def column(name, type, **kw):
+        attrs = dict(name=name, type=type, default=None, is_nullable=True,
+                     auto_increment=False)
+        attrs.update(kw)
+        return my2pg.Column(**attrs)
+
+    cols = ([column('id', 'int(11)', is_nullable=False, auto_increment=True)]
+            + [column('v%i' % i, 'varchar(64)') for i in range(options.width)]
+            + [column('data', 'blob'),
+               column('shape', 'point'),
+               column('created', 'datetime'),
+               column('born', 'date'),
+               column('state', "enum('new','open','closed')",
+                      is_nullable=False)])
+    indexes = [my2pg.Index(name='PRIMARY', table='synthetic', type='BTREE',
+                           column_names=['id'])]
+    plan = my2pg.TablePlan('public', 'synthetic', cols, indexes)
+
+    letters = 'abcdefghijklmnopqrstuvwxyz\t\\ '
+    words = [''.join(rng.choice(letters) for i in range(rng.randint(1, 64)))
+             for i in range(1000)]
+    blob = os.urandom(options.row_blob_size * 2)
+    rows = []
+    for i in xrange(options.rows):
+        row = [i + 1]
+        row.extend(rng.choice(words) for j in range(options.width))
+        start = rng.randint(0, options.row_blob_size)
+        row.append(blob[start:start + options.row_blob_size])
+        row.append('POINT(%.6f %.6f)' % (rng.uniform(-180, 180),
+                                         rng.uniform(-90, 90)))
+        # One date in five is a zero date, which comes back as NULL.
+        row.append(rng.random() > 0.2 and '2010-05-01 12:30:00' or None)
+        row.append(rng.random() > 0.2 and '1970-02-03' or None)
+        row.append(rng.choice(('new', 'open', 'closed')))
+        rows.append(tuple(row))
+    return plan, rows
+
+
+def peak_rss():
+    """(): int
+
+    Return the peak resident set size of this process in bytes.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def fetch_stage(options, plan, source):
+    cur = source.cursor()
+    cur.execute(plan.select_sql)
+    size = 0
+    while True:
+        rows = cur.fetchmany(options.fetch_rows)
+        if not rows:
+            return size
+        size += sum([my2pg.row_size(row) for row in rows])
+
+
+def convert_stage(options, plan, source):
+    cur = source.cursor()
+    cur.execute(plan.select_sql)
+    size = 0
+    while True:
+        rows = cur.fetchmany(options.fetch_rows)
+        if not rows:
+            return size
+        size += sum([my2pg.row_size(plan.convert_row(row)) for row in rows])
+
+
+def format_stage(options, plan, source):
+    cur = source.cursor()
+    cur.execute(plan.select_sql)
+    stream = my2pg.CopyRowStream(my2pg.iter_table_rows(cur, plan))
+    size = 0
+    while True:
+        data = stream.read()
+        if not data:
+            return size
+        size += len(data)
+
+
+def load_stage(loader):
+    def stage(options, plan, source):
+        options = optparse.Values(dict(
+            options.__dict__, loader=loader, dry_run=False,
+            checkpoint=False, reject_file=None))
+        sink = my2pg.FileSink()
+        my2pg.load_table_rows(source, sink, options, plan)
+        return sink.bytes_written
+    return stage
+
+
+# Each stage includes the ones before it; the bytes are those produced
+# by the last step.
+PIPELINE_STAGES = [
+    ('fetch', fetch_stage),
+    ('convert', convert_stage),
+    ('copy format', format_stage),
+    ('load copy', load_stage('copy')),
+    ('load batch', load_stage('batch')),
+]
+
+
+def run_stage(options, stage, results):
+    plan, rows = synthetic_table(options)
+    source = my2pg.MemorySource({plan.table: rows})
+    baseline = peak_rss()
+    best = None
+    for i in range(options.stage_repeat):
+        start = time.time()
+        size = stage(options, plan, source)
+        elapsed = time.time() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, size)
+    results.put((len(rows), best[0], best[1], baseline, peak_rss()))
+
+
+def bench_pipeline(options, pg_conn):
+    """Synthetic table loaded from memory, stage by stage."""
+    print '  %i rows, %i text columns, %i byte BLOBs:' % (
+        options.rows, options.width, options.row_blob_size)
+    results = {}
+    for name, stage in PIPELINE_STAGES:
+        # A fresh process per stage, so its peak RSS is its own.
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run_stage,
+                                       args=(options, stage, queue))
+        proc.start()
+        row_count, elapsed, size, baseline, peak = queue.get()
+        proc.join()
+        results[name] = row_count / elapsed
+        print ('  %-16s %10.1f rows/s %8.1f MB/s  peak RSS %6.1f MB '
+               '(%+.1f MB over the data)' % (
+                   name, row_count / elapsed, size / elapsed / 1e6,
+                   peak / 1e6, (peak - baseline) / 1e6))
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+    """({str: float}, {str: float}, float): [str]
+
+    Return a message for each result that is more than 'tolerance'
+    (a fraction) slower than its baseline.
+    """
+    slower = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        if results[name] < baseline[name] * (1 - tolerance):
+            slower.append('%s: %.1f rows/s, was %.1f' % (
+                name, results[name], baseline[name]))
+    return slower
+
+
+BENCHMARKS = {
+    'blob': bench_blob,
+    'copy': bench_copy,
+    'dates': bench_dates,
+    'geometry': bench_geometry,
+    'pipeline': bench_pipeline,
+}
+
+
+def main():
+    parser = optparse.OptionParser('%prog [options] [benchmark ...]')
+    parser.add_option('--repeat',
+                      action="store", default=20, type="int",
+                      dest="repeat",
+                      help="Number of times to run each case")
+    parser.add_option('--blob-size',
+                      action="store", default=1 << 20, type="int",
+                      dest="blob_size",
+                      help="Size in bytes of the BLOB values")
+    parser.add_option('--polygon-points',
+                      action="store", default=200, type="int",
+                      dest="polygon_points",
+                      help="Number of points of the 'geometry' benchmark's "
+                      "polygons")
+    parser.add_option('--rows',
+                      action="store", default=20000, type="int",
+                      dest="rows",
+                      help="Number of rows in the 'pipeline' and 'copy' "
+                      "tables")
+    parser.add_option('--width',
+                      action="store", default=20, type="int",
+                      dest="width",
+                      help="Number of text columns in the 'pipeline' table")
+    parser.add_option('--row-blob-size',
+                      action="store", default=1024, type="int",
+                      dest="row_blob_size",
+                      help="Size in bytes of the 'pipeline' table's BLOBs")
+    parser.add_option('--seed',
+                      action="store", default=1, type="int",
+                      dest="seed",
+                      help="Random seed for the 'pipeline' table")
+    parser.add_option('--stage-repeat',
+                      action="store", default=3, type="int",
+                      dest="stage_repeat",
+                      help="Number of runs of each 'pipeline' stage; the "
+                      "fastest counts")
+    parser.add_option('--save',
+                      action="store", default=None,
+                      dest="save",
+                      help="File to save the 'pipeline' results to")
+    parser.add_option('--compare',
+                      action="store", default=None,
+                      dest="compare",
+                      help="File of saved results to compare against")
+    parser.add_option('--tolerance',
+                      action="store", default=0.1, type="float",
+                      dest="tolerance",
+                      help="Fraction by which results may be slower than "
+                      "the --compare ones")
+    parser.add_option('--mysql-host',
+                      action="store", default='localhost',
+                      dest="mysql_host",
+                      help="MySQL server for the 'dates' benchmark")
+    parser.add_option('--mysql-db',
+                      action="store", default=None,
+                      dest="mysql_db",
+                      help="MySQL database for the 'dates' benchmark")
+    parser.add_option('--mysql-table',
+                      action="store", default=None,
+                      dest="mysql_table",
+                      help="MySQL table with date or geometry columns to "
+                      "read for the 'dates' and 'geometry' benchmarks")
+    parser.add_option('--mysql-user',
+                      action="store",
+                      dest="mysql_user",
+                      help="User for login if not current user.")
+    parser.add_option('--mysql-password',
+                      action="store", default='',
+                      dest="mysql_password",
+                      help="Password to use when connecting to server.")
+    parser.add_option('--pg-dsn',
+                      action="store", default=None,
+                      dest="pg_dsn",
+                      help="PostgreSQL connection string used to prepare "
+                      "adapters (optional)")
+
+    options, args = parser.parse_args()
+    names = args or sorted(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark %r; choose from %s'
+                         % (name, ', '.join(sorted(BENCHMARKS))))
+
+    pg_conn = None
+    if options.pg_dsn:
+        pg_conn = psycopg2.connect(options.pg_dsn)
+
+    # Settings for load_table_rows() in the 'pipeline' benchmark.
+    options.fetch_rows = 1000
+    options.queue_rows = 50000
+    options.queue_mb = 64
+    options.batch_size = 1000
+    options.commit_rows = 1000000
+    options.commit_mb = 64
+    options.commit_seconds = 10.0
+
+    results = {}
+    for name in names:
+        print '%s: %s' % (name, BENCHMARKS[name].__doc__)
+        results.update(BENCHMARKS[name](options, pg_conn) or {})
+
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        slower = compare_results(results, baseline, options.tolerance)
+        for message in slower:
+            print 'SLOWER %s' % message
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
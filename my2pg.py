@@ -14,13 +14,37 @@ import logging
 import re
 import collections
 import pickle
+import copy
+import itertools
+import datetime
+import signal
+import multiprocessing
+import Queue
+import binascii
+import threading
+import time
+import json
+import resource
+import gzip
+import struct
 
 import MySQLdb
 import psycopg2
 from psycopg2 import InternalError
 from MySQLdb.cursors import DictCursor, SSCursor
+from MySQLdb.constants import FIELD_TYPE
+from MySQLdb.converters import conversions
 
-from psycopg2.extensions import adapt, register_adapter, AsIs
+from psycopg2.extensions import adapt, register_adapter, AsIs, Binary
+try:
+    from pymysqlreplication import BinLogStreamReader
+    from pymysqlreplication.event import (XidEvent, QueryEvent,
+                                          HeartbeatLogEvent)
+    from pymysqlreplication.row_event import (WriteRowsEvent, UpdateRowsEvent,
+                                              DeleteRowsEvent)
+except ImportError:
+    # Only the replicate command needs python-mysql-replication.
+    BinLogStreamReader = None
 
 
 class GeometryText(object):
@@ -29,12 +53,41 @@ class GeometryText(object):
 
 
 def adapt_geometry_text(geom):
+    if geom.text is None:
+        return AsIs('NULL')
     return AsIs("ST_GeomFromText(%s, 4326)" % adapt(geom.text))
 
 register_adapter(GeometryText, adapt_geometry_text)
 
-# We commit data rows every so often.
-COMMIT_AFTER_ROWS = 10000
+
+class GeometryWKB(object):
+    def __init__(self, ewkb):
+        self.ewkb = ewkb
+
+
+def adapt_geometry_wkb(geom):
+    # Hex EWKB is geometry's text input format, so no function call is
+    # needed on the server.
+    return AsIs("'%s'::geometry" % binascii.hexlify(geom.ewkb))
+
+register_adapter(GeometryWKB, adapt_geometry_wkb)
+
+# SRID given to geometries that have none in MySQL.
+DEFAULT_SRID = 4326
+# Flag of the EWKB geometry type saying an SRID follows it.
+EWKB_SRID_FLAG = 0x20000000
+
+# We commit data rows every so often: after --commit-rows rows,
+# --commit-mb MB of data or --commit-seconds seconds, whichever comes
+# first (see CommitBudget).  Without an estimate of the row size, the
+# first transaction of a table has at most COMMIT_FIRST_ROWS rows.
+COMMIT_FIRST_ROWS = 10000
+# Amount of COPY data handed to psycopg2 per read() call.
+COPY_BUFFER_SIZE = 65536
+# copy_rows() keeps the rows of each COPY for the INSERT fallback, so
+# it starts a new COPY after this many rows or bytes of COPY data.
+COPY_REPLAY_ROWS = 50000
+COPY_REPLAY_BYTES = 16 << 20
 GEOMETRY_TYPES = (
     'linestring',
     'point',
@@ -83,6 +136,30 @@ def pg_execute_many(pg_conn, options, sql, args_list):
             print "Error executing SQL: %s" % msg
             raise Exception(msg)
 
+
+def pg_copy(pg_conn, options, sql, stream):
+    """(Connection, Options, str, file)
+
+    Execute a COPY ... FROM STDIN command on the PostgreSQL connection,
+    reading the data from the file-like object 'stream'.
+    """
+    if isinstance(sql, unicode):
+        sql = sql.encode('utf-8')
+
+    if options.dry_run:
+        # Drain the stream anyway so the rows are still read and converted.
+        while stream.read(COPY_BUFFER_SIZE):
+            pass
+        return
+
+    pg_cur = pg_conn.cursor()
+    try:
+        pg_cur.copy_expert(sql, stream, COPY_BUFFER_SIZE)
+    except psycopg2.Error:
+        print "Error executing SQL: %s" % sql
+        raise
+
+
 # XXX need to expand this set of words.
 _reserved_words = set("""end user order group select""".split())
 
@@ -168,9 +245,20 @@ def convert_type(typ, auto_increment=False):
     return new_type or typ
 
 
-def convert_column_data(c):
-    if c.type in GEOMETRY_TYPES:
+def convert_column_data(c, client_dates=False, wkb_geometry=False):
+    """(Column, bool, bool): str
+
+    Return the SELECT list expression for a column.  Unless client_dates
+    is true, MySQL zero dates are replaced on the server.  Geometry
+    columns are selected as WKT, or with wkb_geometry as they are
+    stored, for convert_geometry().
+    """
+    if c.type in GEOMETRY_TYPES and wkb_geometry:
+        return '`%s`' % c.name
+    elif c.type in GEOMETRY_TYPES:
         return 'asText(%s) as `%s`' % (c.name, c.name)
+    elif client_dates:
+        return '`%s`' % c.name
     elif c.type == 'date' and c.is_nullable:
         return "IF(%(p)s != '0000-00-00', DATE_FORMAT(%(p)s, '%%Y-%%m-%%d'), NULL) as `%(p)s`" % {'p': c.name}
     elif c.type == 'date' and not c.is_nullable:
@@ -183,19 +271,501 @@ def convert_column_data(c):
         return '`%s`' % c.name
 
 
+class ZeroDate(object):
+    """
+    Stands for a MySQL zero date ('0000-00-00') in rows read over a
+    connection made with client_date_conversions().
+    """
+
+    def __repr__(self):
+        return 'ZERO_DATE'
+
+ZERO_DATE = ZeroDate()
+EPOCH_DATE = datetime.date(1970, 1, 1)
+EPOCH_DATETIME = datetime.datetime(1970, 1, 1)
+
+
+def zero_date_or(convert):
+    """(callable): callable
+
+    Wrap a MySQLdb date conversion function so it returns ZERO_DATE
+    for zero dates rather than None.
+    """
+    def convert_date(s):
+        if s.startswith('0000-00-00'):
+            return ZERO_DATE
+        return convert(s)
+    return convert_date
+
+
+def client_date_conversions():
+    """(): {int: callable}
+
+    Return MySQLdb conversions that turn zero dates into ZERO_DATE.
+    """
+    conv = conversions.copy()
+    for field_type in (FIELD_TYPE.DATE, FIELD_TYPE.DATETIME,
+                       FIELD_TYPE.TIMESTAMP):
+        conv[field_type] = zero_date_or(conv[field_type])
+    return conv
+
+
+def zero_date_to_null(data):
+    """(date): date
+
+    Convert zero dates in a nullable column to NULL.
+    """
+    if data is ZERO_DATE:
+        return None
+    return data
+
+
+def zero_date_to_epoch(data):
+    """(date): date
+
+    Convert zero and invalid dates in a NOT NULL column to 1970-01-01.
+    """
+    if data is ZERO_DATE or data is None:
+        return EPOCH_DATE
+    return data
+
+
+def zero_datetime_to_epoch(data):
+    """(datetime): datetime
+
+    Convert zero and invalid datetimes in a NOT NULL column to
+    1970-01-01 00:00:00.
+    """
+    if data is ZERO_DATE or data is None:
+        return EPOCH_DATETIME
+    return data
+
+
+def zero_date_converter(c):
+    """(Column): callable
+
+    Return the function that does the zero date replacement of
+    convert_column_data() on the client, or None if the column isn't a
+    date.
+    """
+    if c.type == 'date':
+        return c.is_nullable and zero_date_to_null or zero_date_to_epoch
+    if c.type in ('datetime', 'timestamp'):
+        return c.is_nullable and zero_date_to_null or zero_datetime_to_epoch
+    return None
+
+
+BLOB_TYPES = ('tinyblob', 'blob', 'mediumblob', 'longblob')
+
+
+def convert_blob(data):
+    """(str): Binary
+
+    Wrap a MySQL BLOB value for loading into a BYTEA column.  The data
+    isn't copied; psycopg2 escapes it when the query is sent, and
+    copy_format() writes it in hex.
+    """
+    if data is None:
+        return None
+    return psycopg2.Binary(data)
+
+
+def convert_geometry(data):
+    """(str): GeometryWKB
+
+    Turn a geometry value in MySQL's internal format, a 4-byte
+    little-endian SRID followed by the WKB, into EWKB for PostGIS by
+    moving the SRID after the geometry type.  The coordinates are
+    copied as they are, with no parsing or formatting of text.  A
+    geometry without an SRID gets DEFAULT_SRID, like the WKT path.
+    """
+    if data is None:
+        return None
+    srid = struct.unpack('<I', data[:4])[0] or DEFAULT_SRID
+    if data[4] == '\x01':
+        fmt = '<II'
+    else:
+        fmt = '>II'
+    wkb_type = struct.unpack(fmt[:2], data[5:9])[0]
+    return GeometryWKB(data[4] + struct.pack(fmt, wkb_type | EWKB_SRID_FLAG,
+                                             srid) + data[9:])
+
+
+def column_converter(type, wkb_geometry=False):
+    """(str, bool): callable
+
+    Return the function that converts values of the given MySQL column
+    type into PostgreSQL values, or None if they can be used unchanged.
+    wkb_geometry says how geometry columns are selected; see
+    convert_column_data().
+    """
+    if type in BLOB_TYPES:
+        return convert_blob
+    if type in GEOMETRY_TYPES and wkb_geometry:
+        return convert_geometry
+    if type in GEOMETRY_TYPES:
+        return GeometryText
+    return None
+
+
 def convert_data(type, data):
     """(Column, any) : any
 
     Convert a Python value retrieved from MySQL into a PostgreSQL value.
     """
-    if type in ('tinyblob', 'blob', 'mediumblob', 'longblob') and data:
-        # Convert to a BYTEA literal.  We just use octal escapes for
-        # everything.
-        return ''.join([('\\%03o') % ord(ch) for ch in data])
-    if type in GEOMETRY_TYPES:
-        return GeometryText(data)
+    converter = column_converter(type)
+    if converter is None:
+        return data
+    return converter(data)
 
-    return data
+
+_copy_escapes = {
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+}
+_copy_escape_re = re.compile(r'[\\\t\n\r]')
+
+
+def copy_format(data):
+    """(any): str
+
+    Format a value returned by convert_data() as a field of PostgreSQL's
+    COPY text format, encoded as UTF-8.
+    """
+    if data is None:
+        return '\\N'
+    if isinstance(data, Binary):
+        # bytea's hex input format; needs PostgreSQL 9.0 or later.
+        return '\\\\x' + binascii.hexlify(data.adapted)
+    if isinstance(data, GeometryWKB):
+        return binascii.hexlify(data.ewkb)
+    if isinstance(data, GeometryText):
+        if data.text is None:
+            return '\\N'
+        data = 'SRID=4326;' + data.text
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    elif isinstance(data, bool):
+        return data and 't' or 'f'
+    elif isinstance(data, (int, long)):
+        return str(data)
+    elif isinstance(data, float):
+        return repr(data)
+    elif isinstance(data, datetime.timedelta):
+        # MySQL TIME values come back as timedeltas; use the same
+        # interval syntax as psycopg2's adapter.
+        return '%d days %d.%06d seconds' % (data.days, data.seconds,
+                                            data.microseconds)
+    elif isinstance(data, (datetime.date, datetime.time)):
+        return data.isoformat()
+    elif not isinstance(data, str):
+        data = unicode(data).encode('utf-8')
+    return _copy_escape_re.sub(lambda m: _copy_escapes[m.group()], data)
+
+
+class CopyRowStream(object):
+    """
+    File-like object that feeds converted rows to cursor.copy_expert().
+
+    Rows are pulled from the iterator lazily, so a table is streamed
+    rather than held in memory.  If keep_rows is true, the rows that
+    have been sent are remembered in the 'sent' list so they can be
+    replayed if the COPY fails.  'bytes' counts the COPY data sent.
+
+    Instance attributes:
+    rows : iterator
+    sent : [[any]]
+    row_count : int
+    bytes : int
+
+    """
+
+    def __init__(self, rows, keep_rows=False):
+        self.rows = iter(rows)
+        self.keep_rows = keep_rows
+        self.sent = []
+        self.row_count = 0
+        self.bytes = 0
+
+    def read(self, size=COPY_BUFFER_SIZE):
+        lines = []
+        length = 0
+        for row in self.rows:
+            # Keep the row before formatting it, so a value that can't
+            # be formatted reaches the INSERT fallback and the reject
+            # file.
+            if self.keep_rows:
+                self.sent.append(row)
+            line = '\t'.join([copy_format(v) for v in row]) + '\n'
+            lines.append(line)
+            length += len(line)
+            self.bytes += len(line)
+            self.row_count += 1
+            if size >= 0 and length >= size:
+                break
+        return ''.join(lines)
+
+
+# PostgreSQL's binary COPY format: a signature, flags and header
+# extension length, then each row as a 16-bit field count followed by
+# the fields, each a 32-bit length (-1 for NULL) and the value in the
+# type's binary send format, then a field count of -1.
+BINARY_COPY_HEADER = 'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+BINARY_COPY_TRAILER = struct.pack('>h', -1)
+BINARY_NULL = struct.pack('>i', -1)
+# Dates and timestamps count from 2000-01-01.
+PG_EPOCH_ORDINAL = datetime.date(2000, 1, 1).toordinal()
+
+
+def binary_date(value):
+    """(date or str): int
+
+    Return a date, or the string DATE_FORMAT() makes of one, as days
+    since 2000-01-01.
+    """
+    if isinstance(value, basestring):
+        value = datetime.date(int(value[:4]), int(value[5:7]),
+                              int(value[8:10]))
+    return value.toordinal() - PG_EPOCH_ORDINAL
+
+
+def binary_timestamp(value):
+    """(datetime or str): int
+
+    Return a timestamp, or the string DATE_FORMAT() makes of one, as
+    microseconds since 2000-01-01, the format of servers built with
+    integer datetimes (the default since PostgreSQL 8.4).
+    """
+    if isinstance(value, basestring):
+        value = datetime.datetime(int(value[:4]), int(value[5:7]),
+                                  int(value[8:10]), int(value[11:13]),
+                                  int(value[14:16]), int(value[17:19]))
+    elif not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    seconds = ((value.toordinal() - PG_EPOCH_ORDINAL) * 86400 +
+               value.hour * 3600 + value.minute * 60 + value.second)
+    return seconds * 1000000 + value.microsecond
+
+
+_interval = struct.Struct('>qii')
+
+
+def binary_interval(value):
+    """(timedelta): str
+
+    Return a MySQL TIME value as an interval: microseconds, days and
+    months.
+    """
+    return _interval.pack(value.seconds * 1000000 + value.microseconds,
+                          value.days, 0)
+
+
+def binary_text(value):
+    """(any): str
+
+    Return a value for a text column as UTF-8.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    return unicode(value).encode('utf-8')
+
+
+def binary_bytea(value):
+    """(Binary or str): str
+
+    Return the bytes of a BYTEA value.
+    """
+    if isinstance(value, Binary):
+        return value.adapted
+    return value
+
+
+def binary_geometry(value):
+    """(GeometryWKB): str
+
+    Return a geometry value as EWKB, PostGIS's binary format.
+    """
+    return value.ewkb
+
+
+# Fixed-size PostgreSQL types: (struct code, size, conversion).
+BINARY_FIXED_TYPES = {
+    'smallint': ('h', 2, int),
+    'integer': ('i', 4, int),
+    'serial': ('i', 4, int),
+    'bigint': ('q', 8, long),
+    'bigserial': ('q', 8, long),
+    'real': ('f', 4, float),
+    'double precision': ('d', 8, float),
+    'date': ('i', 4, binary_date),
+    'timestamp': ('q', 8, binary_timestamp),
+}
+
+# Variable-size PostgreSQL types: conversion to the binary format.
+BINARY_VARIABLE_TYPES = {
+    'text': binary_text,
+    'bytea': binary_bytea,
+    'geometry': binary_geometry,
+    'interval': binary_interval,
+}
+
+
+def binary_column_type(pg_type):
+    """(str): str
+
+    Return the key of BINARY_FIXED_TYPES or BINARY_VARIABLE_TYPES under
+    which a PostgreSQL column type is encoded, or None if it can't be.
+    """
+    if pg_type.startswith('varchar(') or pg_type.startswith('char('):
+        return 'text'
+    if pg_type in BINARY_FIXED_TYPES or pg_type in BINARY_VARIABLE_TYPES:
+        return pg_type
+    return None
+
+
+class BinaryCopyEncoder(object):
+    """
+    Encodes converted rows in PostgreSQL's binary COPY format, given
+    the PostgreSQL types of the columns.
+
+    The row layout is compiled once: each run of adjacent fixed-size
+    columns is packed, lengths and values, with one struct.Struct, and
+    other columns are packed one by one.  A run holding a NULL is
+    packed column by column.
+
+    Instance attributes:
+    steps : [callable]
+
+    """
+
+    def __init__(self, pg_types):
+        self.field_count = struct.pack('>h', len(pg_types))
+        self.steps = []
+        run = []
+        for position, pg_type in enumerate(pg_types):
+            key = binary_column_type(pg_type)
+            if key is None:
+                raise ValueError('no binary COPY format for %s' % pg_type)
+            if key in BINARY_FIXED_TYPES:
+                run.append((position,) + BINARY_FIXED_TYPES[key])
+                continue
+            if run:
+                self.steps.append(self.fixed_step(run))
+                run = []
+            self.steps.append(self.variable_step(position,
+                                                 BINARY_VARIABLE_TYPES[key]))
+        if run:
+            self.steps.append(self.fixed_step(run))
+
+    def fixed_step(self, run):
+        positions = [position for position, code, size, convert in run]
+        layout = struct.Struct('>' + ''.join('i' + code
+                                             for p, code, size, c in run))
+        singles = [(struct.Struct('>i' + code), size, convert)
+                   for p, code, size, convert in run]
+        pairs = [(size, convert) for p, code, size, convert in run]
+
+        def step(row, parts):
+            values = [row[position] for position in positions]
+            if None not in values:
+                args = []
+                for (size, convert), value in zip(pairs, values):
+                    args.append(size)
+                    args.append(convert(value))
+                parts.append(layout.pack(*args))
+                return
+            for (single, size, convert), value in zip(singles, values):
+                if value is None:
+                    parts.append(BINARY_NULL)
+                else:
+                    parts.append(single.pack(size, convert(value)))
+        return step
+
+    def variable_step(self, position, convert):
+        length = struct.Struct('>i')
+
+        def step(row, parts):
+            value = row[position]
+            if value is None:
+                parts.append(BINARY_NULL)
+            else:
+                data = convert(value)
+                parts.append(length.pack(len(data)))
+                parts.append(data)
+        return step
+
+    def encode(self, row):
+        """([any]): str
+
+        Return a converted row in binary COPY format.
+        """
+        parts = [self.field_count]
+        for step in self.steps:
+            step(row, parts)
+        return ''.join(parts)
+
+
+def binary_copy_encoder(plan):
+    """(TablePlan): BinaryCopyEncoder
+
+    Return an encoder for the rows of a table, or None if a column has
+    a type without a binary encoding here, such as numeric, or holds
+    geometries as WKT.
+    """
+    pg_types = []
+    for c in plan.columns:
+        pg_type = convert_type(c.type.lower(), c.auto_increment)
+        if pg_type == 'geometry' and not plan.wkb_geometry:
+            return None
+        if binary_column_type(pg_type) is None:
+            return None
+        pg_types.append(pg_type)
+    return BinaryCopyEncoder(pg_types)
+
+
+class BinaryCopyRowStream(CopyRowStream):
+    """
+    A CopyRowStream that sends the rows in binary COPY format, for
+    COPY ... FROM STDIN (FORMAT binary), using a BinaryCopyEncoder.
+
+    Instance attributes:
+    encoder : BinaryCopyEncoder
+
+    """
+
+    def __init__(self, rows, encoder, keep_rows=False):
+        CopyRowStream.__init__(self, rows, keep_rows)
+        self.encoder = encoder
+        self.started = self.finished = False
+
+    def read(self, size=COPY_BUFFER_SIZE):
+        if self.finished:
+            return ''
+        encode = self.encoder.encode
+        chunks = []
+        length = 0
+        if not self.started:
+            self.started = True
+            chunks.append(BINARY_COPY_HEADER)
+        for row in self.rows:
+            # As in CopyRowStream.read().
+            if self.keep_rows:
+                self.sent.append(row)
+            chunk = encode(row)
+            chunks.append(chunk)
+            length += len(chunk)
+            self.bytes += len(chunk)
+            self.row_count += 1
+            if size >= 0 and length >= size:
+                break
+        else:
+            self.finished = True
+            chunks.append(BINARY_COPY_TRAILER)
+        return ''.join(chunks)
 
 
 class Column(object):
@@ -267,15 +837,19 @@ class Index(object):
         for k, v in kw.items():
             setattr(self, k, v)
 
-    def pg_decl(self, schema='public'):
-        """(): str
+    def pg_decl(self, schema='public', unique=False):
+        """(str, bool): str
 
-        Return the PostgreSQL declaration syntax for this index.
+        Return the PostgreSQL declaration syntax for this index.  If
+        'unique' is true and the MySQL index is unique, so is this one.
         """
         # We'll ignore the MySQL index name, and invent a new name.
         #name = 'idx_' + '_'.join([self.table] + self.column_names)
         name = self.name
-        sql = 'CREATE INDEX %s ON "%s"."%s" (%s)' % (fix_reserved_word(name),
+        unique = (unique and not getattr(self, 'non_unique', True) and
+                  'UNIQUE ' or '')
+        sql = 'CREATE %sINDEX %s ON "%s"."%s" (%s)' % (unique,
+                                             fix_reserved_word(name),
                                              schema,
                                              fix_reserved_word(self.table),
                                              ','.join(map(lambda x: '"%s"' % x, self.column_names)))
@@ -286,320 +860,4280 @@ class Index(object):
         return sql
 
 
-def read_mysql_tables(mysql_cur, mysql_db, options):
-    logging.info('Reading structure of MySQL database')
-    mysql_cur.execute('''
-        SELECT * FROM information_schema.tables
-        WHERE table_schema = %s and TABLE_TYPE = 'BASE TABLE'
-    ''', mysql_db)
-    rows = mysql_cur.fetchall()
-    tables = sorted(row['TABLE_NAME'] for row in rows)
-    if options.starting_table:
-        tables = [t for t in tables if options.starting_table <= t]
+def distinct_indexes(indexes):
+    """([Index]): [Index]
 
-    # Convert tables
-    table_cols = {}
-    table_indexes = {}
-    for table in tables:
-        logging.debug('Reading table %s', table)
-        mysql_cur.execute('''SELECT * FROM information_schema.columns
-                          WHERE table_schema = %s and table_name = %s
-                          ''', (mysql_db, table))
-        cols = table_cols[table] = []
-        for num, row in enumerate(mysql_cur.fetchall()):
-            c = Column()
-            cols.append(c)
-            c.index = num
-            c.name = row['COLUMN_NAME']
-            c.type = row['COLUMN_TYPE']
-            c.position = row['ORDINAL_POSITION']
-            c.default = row['COLUMN_DEFAULT']
-            c.is_nullable = bool(row['IS_NULLABLE'] == 'YES')
-            c.auto_increment = row['EXTRA'] == 'auto_increment'
-            # XXX character set?
-
-        # Sort columns into left-to-right order.
-        cols.sort(key=lambda c: c.position)
-
-        # Convert indexes
-        mysql_cur.execute('''SELECT * FROM information_schema.statistics
-                          WHERE table_schema = %s AND table_name = %s
-                          ''', (mysql_db, table))
-        d = collections.defaultdict(Index)
-        for row in mysql_cur.fetchall():
-            index_name = row['INDEX_NAME']
-            i = d[index_name]
-            i.table = table
-            i.name = index_name
-            i.column_names.append(row['COLUMN_NAME'])
-            i.type = row['INDEX_TYPE']
-            i.non_unique = bool(row['NON_UNIQUE'])
-            i.nullable = bool(row['NULLABLE'] == 'YES')
-        table_indexes[table] = d.values()
+    Drop indexes that cover exactly the same columns as another index of
+    the table.  The primary key is kept in preference to a unique index,
+    and a unique index in preference to a non-unique one.
+    """
+    def preference(i):
+        return (i.name != 'PRIMARY', getattr(i, 'non_unique', True), i.name)
 
-    return tables, table_cols, table_indexes
+    seen = {}
+    for i in sorted(indexes, key=preference):
+        key = tuple(i.column_names)
+        if key in seen:
+            logging.info('%s: Skipping index %s, which duplicates %s',
+                         i.table, i.name, seen[key].name)
+        else:
+            seen[key] = i
+    kept = set(id(i) for i in seen.values())
+    return [i for i in indexes if id(i) in kept]
 
 
-def main():
-    parser = optparse.OptionParser(
-        '%prog [options] mysql-host mysql-db pg-host pg-db')
-    parser.add_option('--data-only',
-                      action="store_true", default=False,
-                      dest="data_only",
-                      help="Assume the tables already exist, and only convert data")
-    parser.add_option('--drop-tables',
-                      action="store_true", default=False,
-                      dest="drop_tables",
-                      help="Drop existing PostgreSQL tables (if any) before creating")
-    parser.add_option('-n', '--dry-run',
-                      action="store_true", default=False,
-                      dest="dry_run",
-                      help="Make no changes to PostgreSQL database")
-    parser.add_option('--mysql-user',
-                      action="store",
-                      dest="mysql_user",
-                      help="User for login if not current user.")
-    parser.add_option('--mysql-password',
-                      action="store",
-                      dest="mysql_password",
-                      help="Password to use when connecting to server.")
-    parser.add_option('--pg-user',
-                      action="store",
-                      dest="pg_user",
-                      help="User for login if not current user.")
-    parser.add_option('--pg-schema',
-                      action="store",
-                      dest="pg_schema",
-                      help="PostgreSQL database target schema (if not public).")
-    parser.add_option('--pg-password',
-                      action="store", default='',
-                      dest="pg_password",
-                      help="Password to use when connecting to server.")
-    parser.add_option('--pickle=',
-                      action="store", default='',
-                      dest="pickle",
-                      help="File for storing a pickled version of the MySQL table structure.")
-    parser.add_option('--starting-table',
-                      action="store", default=None,
-                      dest="starting_table",
-                      help="Name of table to start conversion with")
-    parser.add_option('-v', '--verbose',
-                      action="count", default=0,
-                      dest="verbose",
-                      help="Display more output as the script runs")
+def pg_primary_key_sql(schema, table, indexes):
+    """(str, str, [Index]): str
 
-    options, args = parser.parse_args()
-    if len(args) != 4:
-        parser.print_help()
-        sys.exit(1)
+    Return the ALTER TABLE statement that adds the table's primary key,
+    or None if it doesn't have one.
+    """
+    primary_L = [i for i in indexes if i.name == 'PRIMARY']
+    if len(primary_L) != 1:
+        return None
+    return 'ALTER TABLE "%s".%s ADD PRIMARY KEY (%s)' % (
+        schema, fix_reserved_word(table),
+        ','.join(map(lambda x: '"%s"' % x, primary_L[0].column_names)))
 
-    mysql_host, mysql_db, pg_host, pg_db = args
 
-    # Set logging level.
-    if options.verbose:
-        logging.basicConfig(level=logging.INFO)
-        if options.verbose > 1:
-            logging.basicConfig(level=logging.DEBUG)
+def pg_create_table_sql(schema, table, cols, indexes, primary_key=True):
+    """(str, str, [Column], [Index], bool): str
 
-    # Set up connections
-    logging.info('Connecting to databases')
+    Return the PostgreSQL statements that create a table, including any
+    geometry columns and, if primary_key is true, its primary key.
+    """
+    # Assemble into a PGSQL declaration
+    pg_table = fix_reserved_word(table)
+    sql = '''CREATE TABLE "%s".%s (\n''' % (schema, pg_table)
+    std_columns = []
+    geom_columns = []
+    for c in cols:
+        if convert_type(c.type.lower(), c.auto_increment) != 'geometry':
+            std_columns.append(c.pg_decl())
+        else:
+            geom_column_def = "SELECT AddGeometryColumn('%s', '%s', '%s', 4326, '%s', 2)" % (schema, pg_table, c.name, c.type.upper())
+            geom_columns.append(geom_column_def)
+    sql += ',\n'.join(std_columns) + '\n'
 
-    mysql_conn = MySQLdb.Connection(
-        user=options.mysql_user,
-        passwd=options.mysql_password,
-        db=mysql_db,
-        host=mysql_host,
-        use_unicode=True,
-        charset='UTF8'
-        )
-    pg_conn = psycopg2.connect(
-        database=pg_db,
-        host=pg_host,
-        user=options.pg_user,
-        password=options.pg_password,
-        )
-    pg_conn.set_client_encoding('UNICODE')
-    mysql_cur = mysql_conn.cursor(cursorclass=DictCursor)
+    # Look for index named PRIMARY, and add PRIMARY KEY if found.
+    primary_L = [i for i in indexes if i.name == 'PRIMARY']
+    if len(primary_L) and primary_key:
+        if len(primary_L) > 1:
+            logging.warn('%s: Multiple PRIMARY indexes on table',
+                         table)
+        else:
+            primary = primary_L.pop()
+            sql = sql.rstrip() + ',\n'
+            sql += '  PRIMARY KEY (%s)' % ','.join(map(lambda x: '"%s"' % x, primary.column_names))
 
-    # Make list of tables to process.
-    if options.pickle and os.path.exists(options.pickle):
-        f = open(options.pickle, 'rb')
-        tables, table_cols, table_indexes = pickle.load(f)
-        f.close()
+    sql += ');'
+    # Geometry columns
+    sql += '\n' + '\n'.join(geom_columns) + ';'
+    return sql
 
-        # Discard tables that we don't need to process.
-        if options.starting_table:
-            tables = [t for t in tables if options.starting_table <= t]
 
-    else:
-        tables, table_cols, table_indexes = read_mysql_tables(mysql_cur,
-                                                              mysql_db,
-                                                              options)
-        if options.pickle and not options.starting_table:
-            f = open(options.pickle, 'wb')
-            t = (tables, table_cols, table_indexes)
-            pickle.dump(t, f)
-            f.close()
-    # Schema
-    if not options.pg_schema:
-        schema = "public"
-    else:
-        schema = options.pg_schema
+_integer_types = ('smallint', 'integer', 'bigint', 'serial', 'bigserial')
 
-    #
-    # Convert the table structure.
-    #
-    if not options.data_only:
-        for table in tables:
-            cols = table_cols[table]
-            indexes = table_indexes[table]
 
-            # Drop table if necessary.
-            if options.drop_tables:
-                sql = '''DROP TABLE IF EXISTS "%s".%s''' % (schema, fix_reserved_word(table))
-                pg_execute(pg_conn, options, sql)
+# Prefix of the names of the shadow tables of --swap, and their indexes.
+SHADOW_PREFIX = 'my2pg_new_'
 
-            # Assemble into a PGSQL declaration
-            pg_table = fix_reserved_word(table)
-            sql = '''CREATE TABLE "%s".%s (\n''' % (schema, pg_table)
-            std_columns = []
-            geom_columns = []
-            for c in cols:
-                if convert_type(c.type.lower(), c.auto_increment) != 'geometry':
-                    std_columns.append(c.pg_decl())
-                else:
-                    geom_column_def = "SELECT AddGeometryColumn('%s', '%s', '%s', 4326, '%s', 2)" % (schema, pg_table, c.name, c.type.upper())
-                    geom_columns.append(geom_column_def)
-            sql += ',\n'.join(std_columns) + '\n'
-
-            # Look for index named PRIMARY, and add PRIMARY KEY if found.
-            primary_L = [i for i in indexes if i.name == 'PRIMARY']
-            if len(primary_L):
-                if len(primary_L) > 1:
-                    logging.warn('%s: Multiple PRIMARY indexes on table',
-                                 table)
-                else:
-                    primary = primary_L.pop()
-                    sql = sql.rstrip() + ',\n'
-                    sql += '  PRIMARY KEY (%s)' % ','.join(map(lambda x: '"%s"' % x, primary.column_names))
 
-            sql += ');'
-            # Geometry columns
-            sql += '\n' + '\n'.join(geom_columns) + ';'
-            pg_execute(pg_conn, options, sql)
+def integer_primary_key(cols, indexes):
+    """([Column], [Index]): Column
 
-            # Create indexes
-            for i in indexes:
-                if i.name == 'PRIMARY':
-                    continue
+    Return the column of a single-column integer primary key, or None
+    if the table doesn't have one.
+    """
+    primary_L = [i for i in indexes if i.name == 'PRIMARY']
+    if len(primary_L) != 1 or len(primary_L[0].column_names) != 1:
+        return None
+    for c in cols:
+        if c.name == primary_L[0].column_names[0]:
+            if convert_type(c.type.lower(), c.auto_increment) in _integer_types:
+                return c
+    return None
+
+
+class TablePlan(object):
+    """
+    Everything needed to convert one table, worked out once up front.
+
+    Plans can be pickled, and are what the --pickle file stores.
+
+    Instance attributes:
+    schema : str
+    client_dates : bool
+    wkb_geometry : bool
+    unique_indexes : bool
+    table : str
+    pg_table : str
+    columns : [Column]
+    indexes : [Index]
+    select_sql : str
+    create_sql : str
+    bare_create_sql : str
+    primary_key_sql : str
+    index_sql : [str]
+    primary_key : Column
+    key_position : int
+    key_columns : [str]
+    column_list : str
+    insert_prefix : str
+    row_template : str
+    conflict_sql : str
+    insert_sql : str
+    copy_sql : str
+    staging_sql : str
+    merge_sql : str
+    converters : ((int, callable),)
+    data_length : int
+    avg_row_length : int
+
+    'bare_create_sql' creates the table without its primary key, which
+    'primary_key_sql' adds afterwards (it is None if there isn't one).
+    'index_sql' creates the other indexes, leaving out duplicates;
+    with unique_indexes (--unique-indexes), MySQL's unique indexes are
+    created UNIQUE.
+
+    'primary_key' is the column of a single-column integer primary key,
+    or None, and 'key_position' its position in the SELECT list.
+    'key_columns' names the columns of any primary key.
+
+    A multi-row INSERT is insert_prefix, then row_template for each row,
+    then conflict_sql; insert_sql is the single-row version.  Plans
+    from for_upsert() COPY into a temporary table, created by
+    staging_sql, and then run merge_sql; otherwise those are None.
+    Plans from for_shadow() load a shadow table instead of pg_table, and
+    plans from for_shard() add a column numbering the MySQL source.
+
+    'converters' lists the position and conversion function of only
+    those columns whose values need converting; when it is empty, rows
+    from MySQL are loaded as they are.  If client_dates is true, date
+    columns are selected as they are and their zero dates are replaced
+    by the converters, which expects a connection made with
+    client_date_conversions().  If wkb_geometry is true, geometry
+    columns are read in MySQL's binary format and loaded as EWKB
+    (--geometry=wkb), otherwise as WKT.
+
+    'data_length' and 'avg_row_length' are MySQL's estimates of the
+    table's size and average row size in bytes, used to schedule the
+    tables and to size the first transactions and fetches; they are 0
+    if unknown.
+    """
+
+    data_length = avg_row_length = 0
+    unique_indexes = False
+
+    def __init__(self, schema, table, columns, indexes, client_dates=False,
+                 wkb_geometry=False, unique_indexes=False):
+        self.schema = schema
+        self.client_dates = client_dates
+        self.wkb_geometry = wkb_geometry
+        self.unique_indexes = unique_indexes
+        self.table = table
+        self.pg_table = fix_reserved_word(table)
+        self.columns = columns
+        self.indexes = indexes
+
+        self.select_sql = 'SELECT %s FROM %s' % (
+            ', '.join(convert_column_data(c, client_dates, wkb_geometry)
+                      for c in columns),
+            table)
+        self.create_sql = pg_create_table_sql(schema, table, columns, indexes)
+        self.bare_create_sql = pg_create_table_sql(schema, table, columns,
+                                                   indexes, primary_key=False)
+        self.primary_key_sql = pg_primary_key_sql(schema, table, indexes)
+        self.index_sql = [i.pg_decl(schema, unique_indexes)
+                          for i in distinct_indexes(indexes)
+                          if i.name != 'PRIMARY']
+        self.primary_key = integer_primary_key(columns, indexes)
+        self.key_position = None
+        if self.primary_key is not None:
+            self.key_position = columns.index(self.primary_key)
+        primary_L = [i for i in indexes if i.name == 'PRIMARY']
+        self.key_columns = primary_L and list(primary_L[0].column_names) or []
+        self.column_list = ', '.join('"%s"' % c.name for c in columns)
+        self.insert_prefix = ('INSERT INTO "%s".%s (%s) VALUES ' %
+                              (schema, self.pg_table, self.column_list))
+        self.row_template = '(%s)' % ','.join(['%s'] * len(columns))
+        self.conflict_sql = ''
+        self.insert_sql = self.insert_prefix + self.row_template + ';'
+        self.copy_sql = ('COPY "%s".%s (%s) FROM STDIN' %
+                         (schema, self.pg_table, self.column_list))
+        self.staging_sql = None
+        self.merge_sql = None
+
+        converters = []
+        for position, c in enumerate(columns):
+            converter = column_converter(c.type, wkb_geometry)
+            if converter is None and client_dates:
+                converter = zero_date_converter(c)
+            if converter is not None:
+                converters.append((position, converter))
+        self.converters = tuple(converters)
+
+    def convert_row(self, row):
+        """(tuple): sequence
+
+        Convert a row selected with select_sql into PostgreSQL values.
+        """
+        if not self.converters:
+            return row
+        row = list(row)
+        for position, converter in self.converters:
+            row[position] = converter(row[position])
+        return row
+
+    def binary_encoder(self):
+        """(): BinaryCopyEncoder
+
+        Return binary_copy_encoder() for this plan, building it only
+        the first time.  The encoder isn't pickled with the plan.
+        """
+        if '_binary_encoder' not in self.__dict__:
+            self._binary_encoder = binary_copy_encoder(self)
+        return self._binary_encoder
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_binary_encoder', None)
+        return state
+
+    def for_upsert(self):
+        """(): TablePlan
+
+        Return a copy of this plan that updates rows which already exist
+        with the same primary key instead of failing.  Needs PostgreSQL
+        9.5 or later for ON CONFLICT.
+        """
+        plan = copy.copy(self)
+        updates = ['"%s" = EXCLUDED."%s"' % (c.name, c.name)
+                   for c in self.columns if c.name not in self.key_columns]
+        plan.conflict_sql = ' ON CONFLICT (%s) %s' % (
+            ', '.join('"%s"' % name for name in self.key_columns),
+            updates and 'DO UPDATE SET ' + ', '.join(updates) or 'DO NOTHING')
+        plan.insert_sql = (plan.insert_prefix + plan.row_template +
+                           plan.conflict_sql + ';')
+        stage = '"my2pg_stage_%s"' % self.table
+        plan.staging_sql = ('CREATE TEMP TABLE IF NOT EXISTS %s '
+                            '(LIKE "%s".%s) ON COMMIT DELETE ROWS'
+                            % (stage, self.schema, self.pg_table))
+        plan.copy_sql = 'COPY %s (%s) FROM STDIN' % (stage, self.column_list)
+        # The merge empties the stage for the next COPY.
+        plan.merge_sql = ('WITH staged AS (DELETE FROM %s RETURNING *) '
+                          'INSERT INTO "%s".%s (%s) SELECT %s FROM staged%s'
+                          % (stage, self.schema, self.pg_table,
+                             self.column_list, self.column_list,
+                             plan.conflict_sql))
+        return plan
+
+    def for_shadow(self):
+        """(): TablePlan
+
+        Return a plan that loads the MySQL table into a shadow table,
+        SHADOW_PREFIX + table, for swap_table() to put in place of
+        pg_table.  The shadow's indexes are named with the same prefix.
+        The plan has two more attributes: 'live_table' is pg_table of
+        this plan, and 'index_renames' lists the (shadow, live) names of
+        the indexes.
+        """
+        name = SHADOW_PREFIX + self.table
+        indexes = []
+        for i in self.indexes:
+            i = copy.copy(i)
+            i.table = name
+            if i.name != 'PRIMARY':
+                i.name = SHADOW_PREFIX + i.name
+            indexes.append(i)
+        plan = TablePlan(self.schema, name, self.columns, indexes,
+                         self.client_dates, self.wkb_geometry,
+                         self.unique_indexes)
+        # The rows still come from the MySQL table.
+        plan.table = self.table
+        plan.select_sql = self.select_sql
+        plan.live_table = self.pg_table
+        plan.data_length = self.data_length
+        plan.avg_row_length = self.avg_row_length
+        plan.index_renames = [
+            (fix_reserved_word(SHADOW_PREFIX + index.name),
+             fix_reserved_word(index.name))
+            for index in distinct_indexes(self.indexes)
+            if index.name != 'PRIMARY']
+        if self.primary_key_sql:
+            plan.index_renames.append(
+                ('%s_pkey' % name, '"%s_pkey"' % self.pg_table.strip('"')))
+        return plan
+
+    def for_shard(self, column, shard):
+        """(str, int): TablePlan
+
+        Return a plan that loads the table from one of several MySQL
+        shards into a table shared by all of them, with an extra integer
+        column, first, holding the shard's number.  The column is added
+        to the front of the primary key, since keys only need to be
+        unique within a shard.
+        """
+        indexes = []
+        for i in self.indexes:
+            if i.name == 'PRIMARY':
+                i = copy.copy(i)
+                i.column_names = [column] + list(i.column_names)
+            indexes.append(i)
+        shard_column = Column(name=column, type='int(11)', default=None,
+                              is_nullable=False, auto_increment=False)
+        plan = TablePlan(self.schema, self.table,
+                         [shard_column] + self.columns, indexes,
+                         self.client_dates, self.wkb_geometry,
+                         self.unique_indexes)
+        plan.select_sql = 'SELECT %d AS `%s`, %s' % (
+            shard, column, self.select_sql[len('SELECT '):])
+        plan.data_length = self.data_length
+        plan.avg_row_length = self.avg_row_length
+        return plan
+
+    def for_binlog(self):
+        """(): TablePlan
+
+        Return a plan that applies rows read from the binlog, which hold
+        dates and geometries the way MySQL stores them, so they are
+        converted as with client_dates and wkb_geometry, and upserted
+        on the primary key.  The plan has two more attributes:
+        'key_positions' lists the positions of the key columns, and
+        'delete_sql' deletes the rows with the keys given as a tuple of
+        tuples.  Returns None if the table has no primary key.
+        """
+        if not self.key_columns:
+            return None
+        plan = TablePlan(self.schema, self.table, self.columns, self.indexes,
+                         client_dates=True, wkb_geometry=True).for_upsert()
+        names = [c.name for c in self.columns]
+        plan.key_positions = [names.index(name) for name in self.key_columns]
+        plan.delete_sql = 'DELETE FROM "%s".%s WHERE (%s) IN %%s' % (
+            self.schema, self.pg_table,
+            ', '.join('"%s"' % name for name in self.key_columns))
+        return plan
+
+
+def read_mysql_tables(mysql_cur, mysql_db, options, tables=None):
+    """(Cursor, str, Options, [str]): ([str], {str: [Column]},
+                                       {str: [Index]})
+
+    Read the structure of the MySQL tables, or of just the listed ones.
+    The whole schema is read with one query each against
+    information_schema.tables, columns and statistics, and the rows are
+    grouped by table here.
+    """
+    logging.info('Reading structure of MySQL database')
+    if tables is None:
+        mysql_cur.execute('''
+            SELECT * FROM information_schema.tables
+            WHERE table_schema = %s and TABLE_TYPE = 'BASE TABLE'
+        ''', mysql_db)
+        rows = mysql_cur.fetchall()
+        tables = sorted(row['TABLE_NAME'] for row in rows)
+        if options.starting_table:
+            tables = [t for t in tables if options.starting_table <= t]
+        condition = 'table_schema = %s'
+        args = (mysql_db,)
+    else:
+        condition = 'table_schema = %%s AND table_name IN (%s)' % (
+            ','.join(['%s'] * len(tables)))
+        args = (mysql_db,) + tuple(tables)
+
+    # Convert tables
+    table_cols = dict((table, []) for table in tables)
+    table_indexes = dict((table, []) for table in tables)
+    if not tables:
+        return tables, table_cols, table_indexes
+
+    mysql_cur.execute('''SELECT * FROM information_schema.columns
+                      WHERE %s
+                      ORDER BY table_name, ordinal_position
+                      ''' % condition, args)
+    for row in mysql_cur.fetchall():
+        cols = table_cols.get(row['TABLE_NAME'])
+        if cols is None:
+            continue
+        c = Column()
+        c.index = len(cols)
+        cols.append(c)
+        c.name = row['COLUMN_NAME']
+        c.type = row['COLUMN_TYPE']
+        c.position = row['ORDINAL_POSITION']
+        c.default = row['COLUMN_DEFAULT']
+        c.is_nullable = bool(row['IS_NULLABLE'] == 'YES')
+        c.auto_increment = row['EXTRA'] == 'auto_increment'
+        # XXX character set?
+
+    # Convert indexes
+    mysql_cur.execute('''SELECT * FROM information_schema.statistics
+                      WHERE %s
+                      ORDER BY table_name, index_name, seq_in_index
+                      ''' % condition, args)
+    table_index_names = collections.defaultdict(dict)
+    for row in mysql_cur.fetchall():
+        table = row['TABLE_NAME']
+        if table not in table_indexes:
+            continue
+        index_name = row['INDEX_NAME']
+        d = table_index_names[table]
+        i = d.get(index_name)
+        if i is None:
+            i = d[index_name] = Index()
+            table_indexes[table].append(i)
+        i.table = table
+        i.name = index_name
+        i.column_names.append(row['COLUMN_NAME'])
+        i.type = row['INDEX_TYPE']
+        i.non_unique = bool(row['NON_UNIQUE'])
+        i.nullable = bool(row['NULLABLE'] == 'YES')
+
+    return tables, table_cols, table_indexes
+
+
+def read_mysql_fingerprints(mysql_cur, mysql_db):
+    """(Cursor, str): {str: str}
+
+    Return a fingerprint of the structure of every MySQL table, made
+    from its CREATE_TIME and checksums of its column and index
+    definitions.  UPDATE_TIME is left out since it changes with the
+    data, not the structure.
+    """
+    mysql_cur.execute('SET SESSION group_concat_max_len = 1048576')
+    mysql_cur.execute('''
+        SELECT TABLE_NAME, CREATE_TIME FROM information_schema.tables
+        WHERE table_schema = %s and TABLE_TYPE = 'BASE TABLE'
+    ''', mysql_db)
+    fingerprints = dict((row['TABLE_NAME'], [str(row['CREATE_TIME'])])
+                        for row in mysql_cur.fetchall())
+    mysql_cur.execute('''
+        SELECT TABLE_NAME, MD5(GROUP_CONCAT(
+            CONCAT_WS(':', COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE,
+                      IFNULL(COLUMN_DEFAULT, 'NULL'), EXTRA)
+            ORDER BY ORDINAL_POSITION SEPARATOR '|')) AS checksum
+        FROM information_schema.columns
+        WHERE table_schema = %s
+        GROUP BY TABLE_NAME
+    ''', mysql_db)
+    for row in mysql_cur.fetchall():
+        if row['TABLE_NAME'] in fingerprints:
+            fingerprints[row['TABLE_NAME']].append(row['checksum'])
+    mysql_cur.execute('''
+        SELECT TABLE_NAME, MD5(GROUP_CONCAT(
+            CONCAT_WS(':', INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME,
+                      NON_UNIQUE, INDEX_TYPE)
+            ORDER BY INDEX_NAME, SEQ_IN_INDEX SEPARATOR '|')) AS checksum
+        FROM information_schema.statistics
+        WHERE table_schema = %s
+        GROUP BY TABLE_NAME
+    ''', mysql_db)
+    for row in mysql_cur.fetchall():
+        if row['TABLE_NAME'] in fingerprints:
+            fingerprints[row['TABLE_NAME']].append(row['checksum'])
+    return dict((table, '/'.join(parts))
+                for table, parts in fingerprints.items())
+
+
+def read_table_estimates(mysql_cur, mysql_db):
+    """(Cursor, str): {str: int}
+
+    Return MySQL's estimate of the number of rows in every table.  For
+    InnoDB tables it can be off by a good margin.
+    """
+    mysql_cur.execute('''
+        SELECT TABLE_NAME, TABLE_ROWS FROM information_schema.tables
+        WHERE table_schema = %s and TABLE_TYPE = 'BASE TABLE'
+    ''', mysql_db)
+    return dict((row['TABLE_NAME'], int(row['TABLE_ROWS'] or 0))
+                for row in mysql_cur.fetchall())
+
+
+def read_table_sizes(mysql_cur, mysql_db):
+    """(Cursor, str): {str: (int, int)}
+
+    Return MySQL's estimate of the data size and the average row size,
+    in bytes, of every table, from the same statistics as
+    read_table_estimates().
+    """
+    mysql_cur.execute('''
+        SELECT TABLE_NAME, DATA_LENGTH, AVG_ROW_LENGTH
+        FROM information_schema.tables
+        WHERE table_schema = %s and TABLE_TYPE = 'BASE TABLE'
+    ''', mysql_db)
+    return dict((row['TABLE_NAME'], (int(row['DATA_LENGTH'] or 0),
+                                     int(row['AVG_ROW_LENGTH'] or 0)))
+                for row in mysql_cur.fetchall())
+
+
+def order_by_size(plans):
+    """([TablePlan]): [TablePlan]
+
+    Return the plans largest table first, by data_length, so that with
+    --jobs the big tables don't start last and keep the run going after
+    the others are done.  Tables of the same size stay in name order.
+    """
+    return sorted(plans, key=lambda plan: (-plan.data_length, plan.table))
+
+
+def read_auto_increments(mysql_cur, mysql_db):
+    """(Cursor, str): {str: int}
+
+    Return the next AUTO_INCREMENT value of every table that has one.
+    """
+    try:
+        # MySQL 8 caches these values for a day by default.
+        mysql_cur.execute('SET SESSION information_schema_stats_expiry = 0')
+    except MySQLdb.Error:
+        pass
+    mysql_cur.execute('''
+        SELECT TABLE_NAME, AUTO_INCREMENT FROM information_schema.tables
+        WHERE table_schema = %s and AUTO_INCREMENT IS NOT NULL
+    ''', mysql_db)
+    return dict((row['TABLE_NAME'], int(row['AUTO_INCREMENT']))
+                for row in mysql_cur.fetchall())
+
+
+def load_table_cache(filename):
+    """(str): {str: any}
+
+    Read the --pickle cache of table plans.  Returns an empty cache if
+    the file doesn't exist or can't be used.
+    """
+    if not os.path.exists(filename):
+        return {}
+    f = open(filename, 'rb')
+    try:
+        cache = pickle.load(f)
+    except Exception:
+        logging.warning('Ignoring unreadable cache %s', filename,
+                        exc_info=True)
+        cache = {}
+    f.close()
+    if not isinstance(cache, dict) or 'fingerprints' not in cache:
+        logging.warning('Ignoring cache %s from an older version', filename)
+        return {}
+    return cache
+
+
+def read_table_plans(mysql_cur, mysql_db, options, schema, cache):
+    """(Cursor, str, Options, str, {str: any}): ([TablePlan], {str: any})
+
+    Return the plans for the tables to convert, re-reading the structure
+    of only those tables whose fingerprint differs from the cache's.
+    Also returns the updated cache.
+    """
+    fingerprints = read_mysql_fingerprints(mysql_cur, mysql_db)
+    tables = sorted(fingerprints)
+    cached_plans = cache.get('plans', {})
+    cached_fingerprints = cache.get('fingerprints', {})
+    stale = [t for t in tables
+             if t not in cached_plans or
+             cached_fingerprints.get(t) != fingerprints[t]]
+    logging.info('Using cached structure for %i of %i tables',
+                 len(tables) - len(stale), len(tables))
+
+    client_dates = options.date_conversion == 'client'
+    wkb_geometry = options.geometry == 'wkb'
+    unique_indexes = options.unique_indexes
+    plans = {}
+    for table in tables:
+        if table not in stale:
+            plan = cached_plans[table]
+            if (plan.schema != schema or plan.client_dates != client_dates or
+                getattr(plan, 'wkb_geometry', False) != wkb_geometry or
+                plan.unique_indexes != unique_indexes):
+                # The cached plan was made with different options.
+                plan = TablePlan(schema, table, plan.columns, plan.indexes,
+                                 client_dates, wkb_geometry, unique_indexes)
+            plans[table] = plan
+    if stale:
+        stale, table_cols, table_indexes = read_mysql_tables(
+            mysql_cur, mysql_db, options, stale)
+        for table in stale:
+            plans[table] = TablePlan(schema, table, table_cols[table],
+                                     table_indexes[table], client_dates,
+                                     wkb_geometry, unique_indexes)
+
+    cache = {'fingerprints': fingerprints, 'plans': plans}
+    return [plans[table] for table in tables], cache
+
+
+def read_plans(mysql_cur, mysql_db, options, schema):
+    """(Cursor, str, Options, str): [TablePlan]
+
+    Return the plans of the tables to convert, reusing and updating the
+    --pickle cache if there is one.
+    """
+    if options.pickle:
+        plans, cache = read_table_plans(mysql_cur, mysql_db, options, schema,
+                                        load_table_cache(options.pickle))
+        f = open(options.pickle, 'wb')
+        pickle.dump(cache, f)
+        f.close()
+
+        # Discard tables that we don't need to process.
+        if options.starting_table:
+            plans = [p for p in plans if options.starting_table <= p.table]
+        return plans
+
+    tables, table_cols, table_indexes = read_mysql_tables(mysql_cur,
+                                                          mysql_db,
+                                                          options)
+    return [TablePlan(schema, table, table_cols[table],
+                      table_indexes[table],
+                      options.date_conversion == 'client',
+                      options.geometry == 'wkb', options.unique_indexes)
+            for table in tables]
+
+
+def create_tables(pg_conn, options, plans):
+    """(Connection, Options, [TablePlan])
+
+    Create the PostgreSQL tables, dropping existing ones first with
+    --drop-tables.  With --defer-indexes they are created without
+    their primary keys and indexes, which build_indexes() adds after
+    the data is loaded.  With --fast-load they are created UNLOGGED,
+    and set_tables_logged() has to be run after loading them; that
+    needs PostgreSQL 9.5 or later.
+    """
+    for plan in plans:
+        # Drop table if necessary.  A shadow table left over from an
+        # earlier --swap run is always dropped.
+        if options.drop_tables or options.swap:
+            sql = '''DROP TABLE IF EXISTS "%s".%s''' % (plan.schema, plan.pg_table)
+            pg_execute(pg_conn, options, sql)
+
+        if options.defer_indexes:
+            sql = plan.bare_create_sql
+        else:
+            sql = plan.create_sql
+        if options.fast_load:
+            sql = sql.replace('CREATE TABLE', 'CREATE UNLOGGED TABLE', 1)
+        pg_execute(pg_conn, options, sql)
+        if options.defer_indexes:
+            pg_conn.commit()
+            continue
+
+        # Create indexes
+        for sql in plan.index_sql:
+            try:
+                pg_execute(pg_conn, options, sql)
+            except Exception:
+                logging.error('Failure creating index on table %s\n Statement: %s', plan.table, sql,
+                              exc_info=True)
+
+        pg_conn.commit()
+
+
+def connect_mysql(options, host, db):
+    """(Options, str, str): Connection
+
+    Open a connection to the MySQL database.
+    """
+    kw = {}
+    if options.date_conversion == 'client':
+        kw['conv'] = client_date_conversions()
+    return MySQLdb.Connection(
+        user=options.mysql_user,
+        passwd=options.mysql_password,
+        db=db,
+        host=host,
+        use_unicode=True,
+        charset='UTF8',
+        **kw
+        )
+
+
+def connect_pg(options, host, db):
+    """(Options, str, str): Connection
+
+    Open a connection to the PostgreSQL database.
+    """
+    pg_conn = psycopg2.connect(
+        database=db,
+        host=host,
+        user=options.pg_user,
+        password=options.pg_password,
+        )
+    pg_conn.set_client_encoding('UNICODE')
+    if options.fast_load:
+        # Losing the last commits in a crash is fine when the whole
+        # load would be restarted anyway.
+        pg_execute(pg_conn, options, 'SET synchronous_commit = off')
+        pg_execute(pg_conn, options, 'SET work_mem = %s',
+                   (options.work_mem,))
+        pg_conn.commit()
+    return pg_conn
+
+
+class MemorySource(object):
+    """
+    Stand-in for a MySQL connection that serves rows from memory, so
+    the loading code can be tested and benchmarked without a server.
+    It supports what load_table_rows() uses: cursor(), and execute(),
+    fetchone(), fetchmany() and close() on the cursor.  A query returns
+    all the rows of the table named after FROM; WHERE and ORDER BY
+    clauses are ignored.  Rows must be given the way the MySQL driver
+    would return them for the plan's select_sql.
+
+    Instance attributes:
+    tables : {str: [tuple]}
+    queries : [str]
+
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.queries = []
+
+    def cursor(self, cursorclass=None):
+        return MemorySourceCursor(self)
+
+    def close(self):
+        pass
+
+
+class MemorySourceCursor(object):
+    _table_re = re.compile(r'\bFROM\s+`?(\w+)`?')
+
+    def __init__(self, source):
+        self.source = source
+        self.rows = iter(())
+
+    def execute(self, sql, args=None):
+        self.source.queries.append(sql)
+        table = self._table_re.findall(sql)[-1]
+        self.rows = iter(self.source.tables[table])
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self.rows, size))
+
+    def close(self):
+        pass
+
+
+class FileSink(object):
+    """
+    Stand-in for a PostgreSQL connection that writes the statements
+    and COPY data it is sent to a file, as a script psql can run, or
+    just counts them if no file is given.  It supports what the loaders
+    use: cursor(), commit() and rollback(), and execute() and
+    copy_expert() on the cursor.  Query parameters are quoted the way
+    psycopg2 would.
+
+    Instance attributes:
+    f : file
+    bytes_written : int
+    commits : int
+
+    """
+
+    def __init__(self, f=None):
+        self.f = f
+        self.bytes_written = 0
+        self.commits = 0
+        self.write('BEGIN;\n')
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self.f is not None:
+            self.f.write(data)
+
+    def cursor(self):
+        return FileSinkCursor(self)
+
+    def commit(self):
+        self.commits += 1
+        self.write('COMMIT;\nBEGIN;\n')
+
+    def rollback(self):
+        self.write('ROLLBACK;\nBEGIN;\n')
+
+    def close(self):
+        self.write('COMMIT;\n')
+
+
+class FileSinkCursor(object):
+    def __init__(self, sink):
+        self.sink = sink
+
+    def execute(self, sql, args=()):
+        if args:
+            quoted = []
+            for v in args:
+                a = adapt(v)
+                if hasattr(a, 'encoding'):
+                    a.encoding = 'utf8'
+                quoted.append(a.getquoted())
+            sql = sql % tuple(quoted)
+        self.sink.write(sql.strip() + ';\n')
+
+    def copy_expert(self, sql, stream, size=COPY_BUFFER_SIZE):
+        self.sink.write(sql + ';\n')
+        while True:
+            data = stream.read(size)
+            if not data:
+                break
+            self.sink.write(data)
+        self.sink.write('\\.\n')
+
+
+def insert_rows(pg_conn, options, plan, rows):
+    """(Connection, Options, TablePlan, iter): (int, int)
+
+    Insert converted rows one at a time, logging and skipping rows that
+    fail.  Returns the number of rows inserted and the number of failures.
+    """
+    row_count = 0
+    errors = 0
+    for row in rows:
+        try:
+            pg_execute(pg_conn, options, plan.insert_sql, row)
+        except (InternalError, KeyboardInterrupt):
+            raise
+        except Exception as err:
+            logging.error('Failure inserting row into table %s', plan.table,
+                          exc_info=True)
+            write_reject(options, plan.table, row, err)
+            errors += 1
+        else:
+            row_count += 1
+    return row_count, errors
+
+
+def copy_rows(pg_conn, options, plan, rows, binary=False):
+    """(Connection, Options, TablePlan, iter, bool): (int, int)
+
+    Load converted rows with COPY FROM STDIN, each COPY followed by the
+    plan's merge_sql if it has one.  A COPY that fails is rolled back
+    and its rows are loaded with bisecting multi-row INSERTs instead,
+    so the offending rows can be logged and skipped.  Since those rows
+    are kept until the COPY ends, a new COPY is started every
+    COPY_REPLAY_ROWS rows or COPY_REPLAY_BYTES bytes.  If binary is
+    true and the plan's binary_encoder() can encode the table's
+    columns, the rows are sent in binary format.  Returns the number of
+    rows loaded and the number of failures.
+    """
+    encoder = binary and plan.binary_encoder() or None
+    rows = iter(rows)
+    row_count = errors = 0
+    for first in rows:
+        loaded, failed = copy_batch(pg_conn, options, plan,
+                                    itertools.chain([first], rows), encoder)
+        row_count += loaded
+        errors += failed
+    return row_count, errors
+
+
+def copy_batch(pg_conn, options, plan, rows, encoder):
+    """(Connection, Options, TablePlan, iter, BinaryCopyEncoder):
+       (int, int)
+
+    Do one COPY of copy_rows(), sending rows until the replay limits
+    are reached and leaving the rest in the iterator.  The encoder is
+    None for text format.
+    """
+    def limited():
+        for row in rows:
+            yield row
+            if (stream.row_count >= COPY_REPLAY_ROWS or
+                stream.bytes >= COPY_REPLAY_BYTES):
+                return
+
+    if encoder is not None:
+        stream = BinaryCopyRowStream(limited(), encoder, keep_rows=True)
+        sql = plan.copy_sql + ' (FORMAT binary)'
+    else:
+        stream = CopyRowStream(limited(), keep_rows=True)
+        sql = plan.copy_sql
+    pg_execute(pg_conn, options, 'SAVEPOINT my2pg_copy')
+    try:
+        pg_copy(pg_conn, options, sql, stream)
+        if plan.merge_sql:
+            pg_execute(pg_conn, options, plan.merge_sql)
+    except (InternalError, KeyboardInterrupt):
+        raise
+    except (psycopg2.Error, struct.error, ValueError):
+        # The latter two abort the COPY: BinaryCopyEncoder raises them
+        # for values out of range of their column, and copy_format()
+        # ValueError (such as UnicodeError) for values it can't encode.
+        logging.warning('COPY into table %s failed; '
+                        'falling back to batched INSERTs', plan.table,
+                        exc_info=True)
+        pg_execute(pg_conn, options, 'ROLLBACK TO SAVEPOINT my2pg_copy')
+        # Rows the COPY didn't get to are left for the next one.
+        return batch_insert_rows(pg_conn, options, plan, stream.sent)
+    pg_execute(pg_conn, options, 'RELEASE SAVEPOINT my2pg_copy')
+    return stream.row_count, 0
+
+
+def write_reject(options, table, row, err):
+    """(Options, str, [any], Exception)
+
+    Append a row that couldn't be loaded to the reject file, if one was
+    requested.  Each line holds the table name, the error message and
+    the row in COPY text format, separated by tabs.
+    """
+    if not options.reject_file:
+        return
+    line = '%s\t%s\t%s\n' % (table, copy_format(str(err).strip()),
+                              '\t'.join([copy_format(v) for v in row]))
+    f = open(options.reject_file, 'ab')
+    try:
+        f.write(line)
+    finally:
+        f.close()
+
+
+def insert_batch(pg_conn, options, plan, rows):
+    """(Connection, Options, TablePlan, [[any]]): (int, int)
+
+    Insert a list of rows with one multi-row INSERT inside a SAVEPOINT.
+    If the statement fails, including when psycopg2 can't adapt a value,
+    the batch is rolled back and split in half until the offending rows
+    are isolated; those are logged, written to the reject file and
+    skipped.  Errors of the connection itself are raised.  Returns the
+    number of rows inserted and the number of failures.
+    """
+    table = plan.table
+    sql = (plan.insert_prefix + ','.join([plan.row_template] * len(rows)) +
+           plan.conflict_sql)
+    args = [v for row in rows for v in row]
+    pg_execute(pg_conn, options, 'SAVEPOINT my2pg_batch')
+    try:
+        pg_execute(pg_conn, options, sql, args)
+    except (InternalError, psycopg2.OperationalError,
+            psycopg2.InterfaceError, KeyboardInterrupt):
+        raise
+    except Exception as err:
+        pg_execute(pg_conn, options, 'ROLLBACK TO SAVEPOINT my2pg_batch')
+        pg_execute(pg_conn, options, 'RELEASE SAVEPOINT my2pg_batch')
+        if len(rows) == 1:
+            logging.error('Failure inserting row into table %s: %s',
+                          table, str(err).strip())
+            write_reject(options, table, rows[0], err)
+            return 0, 1
+        middle = len(rows) // 2
+        loaded1, errors1 = insert_batch(pg_conn, options, plan, rows[:middle])
+        loaded2, errors2 = insert_batch(pg_conn, options, plan, rows[middle:])
+        return loaded1 + loaded2, errors1 + errors2
+    pg_execute(pg_conn, options, 'RELEASE SAVEPOINT my2pg_batch')
+    return len(rows), 0
+
+
+def batch_insert_rows(pg_conn, options, plan, rows):
+    """(Connection, Options, TablePlan, iter): (int, int)
+
+    Insert converted rows options.batch_size at a time with multi-row
+    INSERT statements, bisecting any batch that fails.
+    Returns the number of rows inserted and the number of failures.
+    """
+    rows = iter(rows)
+    row_count = 0
+    errors = 0
+    while True:
+        batch = list(itertools.islice(rows, options.batch_size))
+        if not batch:
+            break
+        loaded, failed = insert_batch(pg_conn, options, plan, batch)
+        row_count += loaded
+        errors += failed
+    return row_count, errors
+
+
+def binary_copy_rows(pg_conn, options, plan, rows):
+    """(Connection, Options, TablePlan, iter): (int, int)
+
+    Load converted rows with a binary COPY, or a text one for tables
+    with columns that can't be sent in binary; see copy_rows().
+    """
+    return copy_rows(pg_conn, options, plan, rows, binary=True)
+
+
+# Functions that load an iterator of converted rows into a table.
+LOADERS = {
+    'insert': insert_rows,
+    'batch': batch_insert_rows,
+    'copy': copy_rows,
+    'binary': binary_copy_rows,
+}
+
+
+def iter_table_rows(mysql_cur, plan):
+    """(Cursor, TablePlan): iter
+
+    Yield the rows of an executed MySQL query, converted for PostgreSQL.
+    """
+    convert_row = plan.convert_row
+    while True:
+        row = mysql_cur.fetchone()
+        if row is None:
+            break
+        yield convert_row(row)
+
+
+def row_size(row):
+    """([any]): int
+
+    Roughly estimate the memory taken by a converted row: the length of
+    its strings, BLOBs and EWKB geometries, and 8 bytes for any other
+    value.
+    """
+    size = 0
+    for v in row:
+        if isinstance(v, basestring):
+            size += len(v)
+        elif isinstance(v, Binary):
+            size += len(v.adapted)
+        elif isinstance(v, GeometryWKB):
+            size += len(v.ewkb)
+        else:
+            size += 8
+    return size
+
+
+class TableStats(object):
+    """
+    Performance counters for the conversion of a table, or of one key
+    range of it.
+
+    Instance attributes:
+    table : str
+    key_range : (int, int)
+    shard : int
+    rows : int
+    errors : int
+    bytes : int
+    fetch_time : float
+    convert_time : float
+    write_time : float
+    commit_time : float
+    index_time : float
+    started : float
+    updated : float
+    peak_rss : int
+    done : bool
+
+    'shard' is the number of the MySQL source the rows come from, or
+    None if there is only one.
+    'bytes' is the estimated size of the converted rows (see row_size()).
+    The times are in seconds; 'write_time' leaves out the time spent
+    waiting for rows and committing.  'started' and 'updated' are
+    timestamps.  'peak_rss' is the peak resident memory, in bytes, of
+    the process doing the conversion since it started, not of this
+    table alone: it includes the tables the process loaded before.
+    """
+
+    COUNTERS = ('rows', 'errors', 'bytes', 'fetch_time', 'convert_time',
+                'write_time', 'commit_time', 'index_time')
+
+    def __init__(self, table, key_range=None, shard=None):
+        self.table = table
+        self.key_range = key_range
+        self.shard = shard
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.started = self.updated = time.time()
+        self.peak_rss = 0
+        self.done = False
+
+    def add(self, other):
+        """(TableStats)
+
+        Add the counters of another part of the same table to these.
+        """
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.started = min(self.started, other.started)
+        self.updated = max(self.updated, other.updated)
+        self.peak_rss = max(self.peak_rss, other.peak_rss)
+
+    def as_dict(self):
+        """(): {str: any}
+
+        Return the counters as a dictionary, with the elapsed time and
+        rows per second worked out.
+        """
+        d = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        elapsed = self.updated - self.started
+        d.update(elapsed=elapsed, peak_rss=self.peak_rss, done=self.done,
+                 rows_per_second=elapsed and self.rows / elapsed or 0.0)
+        return d
+
+
+# Per-process destination of progress reports; see report_progress().
+_progress = {}
+
+
+def report_progress(stats):
+    """(TableStats)
+
+    Send the current counters of a table to the RunReport of the main
+    process, if there is one.
+    """
+    queue = _progress.get('queue')
+    if queue is None:
+        return
+    stats.updated = time.time()
+    stats.peak_rss = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                      * 1024)
+    queue.put(stats)
+
+
+class RowPipeline(object):
+    """
+    Reads and converts the rows of an executed MySQL query in a
+    background thread, so that reading from MySQL, converting rows and
+    writing to PostgreSQL overlap.
+
+    The reader thread fetches fetch_rows rows at a time with
+    fetchmany() and passes the converted batches through a queue that
+    holds at most max_rows rows and max_bytes bytes (as estimated by
+    row_size()), so memory stays bounded when PostgreSQL falls behind.
+    Fewer rows are fetched at a time when they are large, so that one
+    fetch holds at most a quarter of max_bytes; the row size is taken
+    from plan.avg_row_length until rows have been read.
+    Iterating over the pipeline yields the rows in order; an exception
+    raised in the reader is re-raised there.
+
+    Instance attributes:
+    fetch_time : float
+    convert_time : float
+    reader_wait : float
+    writer_wait : float
+    queued_rows : int
+    queued_bytes : int
+    bytes : int
+    rows : int
+    consumed_bytes : int
+
+    'bytes' and 'rows' count what the reader has converted so far, and
+    'consumed_bytes' the bytes of the rows taken out of the queue.
+    'fetch_time' and 'convert_time' are the seconds the reader spent in
+    fetchmany() and converting rows.  'reader_wait' is how long it was
+    blocked on a full queue, meaning PostgreSQL is the bottleneck;
+    'writer_wait' is how long the consumer was blocked on an empty one,
+    meaning MySQL or the conversion is.
+    """
+
+    def __init__(self, mysql_cur, plan, fetch_rows, max_rows, max_bytes):
+        self.mysql_cur = mysql_cur
+        self.plan = plan
+        self.fetch_rows = fetch_rows
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.fetch_time = self.convert_time = 0.0
+        self.reader_wait = self.writer_wait = 0.0
+        self.queued_rows = self.queued_bytes = 0
+        self.bytes = self.rows = self.consumed_bytes = 0
+        self.batches = collections.deque()
+        self.finished = False
+        self.closed = False
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.read,
+                                       name='reader %s' % plan.table)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def fetch_size(self):
+        """(): int
+
+        Return the number of rows to fetch next: fetch_rows, or fewer
+        if that many rows would take over a quarter of max_bytes.
+        """
+        if self.rows:
+            row_bytes = self.bytes / float(self.rows)
+        else:
+            row_bytes = self.plan.avg_row_length
+        if row_bytes <= 0:
+            return self.fetch_rows
+        return max(1, min(self.fetch_rows,
+                          int(self.max_bytes / 4 / row_bytes)))
+
+    def read(self):
+        convert_row = self.plan.convert_row
+        try:
+            while True:
+                start = time.time()
+                rows = self.mysql_cur.fetchmany(self.fetch_size())
+                fetched = time.time()
+                self.fetch_time += fetched - start
+                if not rows:
+                    break
+                rows = [convert_row(row) for row in rows]
+                size = sum([row_size(row) for row in rows])
+                self.convert_time += time.time() - fetched
+                if not self.put(rows, size):
+                    break
+        except Exception:
+            self.error = sys.exc_info()
+        self.cond.acquire()
+        try:
+            self.finished = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def put(self, rows, size):
+        """([[any]], int): bool
+
+        Add a batch of rows to the queue, waiting until there is room
+        for it.  A batch always fits into an empty queue.  Returns false
+        if the pipeline has been closed.
+        """
+        self.cond.acquire()
+        try:
+            start = time.time()
+            while (self.batches and not self.closed and
+                   (self.queued_rows + len(rows) > self.max_rows or
+                    self.queued_bytes + size > self.max_bytes)):
+                self.cond.wait()
+            self.reader_wait += time.time() - start
+            if self.closed:
+                return False
+            self.batches.append((rows, size))
+            self.queued_rows += len(rows)
+            self.queued_bytes += size
+            self.bytes += size
+            self.rows += len(rows)
+            self.cond.notify_all()
+            return True
+        finally:
+            self.cond.release()
+
+    def get(self):
+        """(): [[any]]
+
+        Return the next batch of rows, waiting for the reader if
+        necessary, or None once all the rows have been returned.
+        """
+        self.cond.acquire()
+        try:
+            start = time.time()
+            while not self.batches and not self.finished:
+                self.cond.wait()
+            self.writer_wait += time.time() - start
+            if not self.batches:
+                if self.error is not None:
+                    raise self.error[0], self.error[1], self.error[2]
+                return None
+            rows, size = self.batches.popleft()
+            self.queued_rows -= len(rows)
+            self.queued_bytes -= size
+            self.consumed_bytes += size
+            self.cond.notify_all()
+            return rows
+        finally:
+            self.cond.release()
+
+    def __iter__(self):
+        while True:
+            rows = self.get()
+            if rows is None:
+                break
+            for row in rows:
+                yield row
+
+    def close(self):
+        """()
+
+        Stop the reader thread after the batch it is working on, and
+        wait for it to finish, so the MySQL connection can be used or
+        closed again once this returns.
+        """
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        self.thread.join()
+
+
+def empty_table(pg_conn, options, plan):
+    """(Connection, Options, TablePlan)
+
+    Delete the rows of a PostgreSQL table.  With --fast-load the table
+    is truncated instead, which is quicker and, if wal_level is minimal,
+    lets COPY skip the WAL in the same transaction.
+    """
+    if options.fast_load:
+        sql = 'TRUNCATE "%s".%s'
+    else:
+        sql = 'DELETE FROM "%s".%s'
+    pg_execute(pg_conn, options, sql % (plan.schema, plan.pg_table))
+
+
+def create_checkpoint_table(pg_conn, options, schema):
+    """(Connection, Options, str)
+
+    Create the control table that records conversion progress, unless
+    it already exists.  Each row covers a primary key range of a table
+    (both ends NULL for the whole table), with the last key and number
+    of rows committed so far.
+    """
+    pg_execute(pg_conn, options, '''
+        CREATE TABLE IF NOT EXISTS "%s".my2pg_progress (
+            table_name text NOT NULL,
+            range_start bigint,
+            range_end bigint,
+            last_key bigint,
+            row_count bigint NOT NULL,
+            done boolean NOT NULL,
+            updated timestamp NOT NULL DEFAULT now()
+        )''' % schema)
+    pg_conn.commit()
+
+
+def read_checkpoints(pg_conn, schema):
+    """(Connection, str): {str: [(int, int, int, int, bool)]}
+
+    Return the recorded progress of each table as a list of
+    (range_start, range_end, last_key, row_count, done) tuples.
+    """
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute('''SELECT 1 FROM pg_tables
+                      WHERE schemaname = %s AND tablename = 'my2pg_progress'
+                   ''', (schema,))
+    if not pg_cur.fetchall():
+        pg_cur.close()
+        return {}
+    pg_cur.execute('''SELECT table_name, range_start, range_end, last_key,
+                             row_count, done
+                      FROM "%s".my2pg_progress
+                      ORDER BY table_name, range_start''' % schema)
+    progress = collections.defaultdict(list)
+    for row in pg_cur.fetchall():
+        progress[row[0]].append(tuple(row[1:]))
+    pg_cur.close()
+    pg_conn.commit()
+    return dict(progress)
+
+
+def record_checkpoint(pg_conn, options, plan, key_range, last_key, row_count,
+                      done):
+    """(Connection, Options, TablePlan, (int, int), int, int, bool)
+
+    Record the progress of a key range of a table (or of the whole table
+    if key_range is None).  This is called just before committing the
+    rows it describes, so the record is committed along with them.
+    """
+    range_start, range_end = key_range or (None, None)
+    pg_execute(pg_conn, options, '''
+        DELETE FROM "%s".my2pg_progress
+        WHERE table_name = %%s AND range_start IS NOT DISTINCT FROM %%s
+        ''' % plan.schema, (plan.table, range_start))
+    pg_execute(pg_conn, options, '''
+        INSERT INTO "%s".my2pg_progress
+            (table_name, range_start, range_end, last_key, row_count, done)
+        VALUES (%%s, %%s, %%s, %%s, %%s, %%s)
+        ''' % plan.schema,
+        (plan.table, range_start, range_end, last_key, row_count, done))
+
+
+def clear_checkpoints(pg_conn, options, plan):
+    """(Connection, Options, TablePlan)
+
+    Forget the recorded progress of a table that is being reloaded.
+    """
+    pg_execute(pg_conn, options,
+               'DELETE FROM "%s".my2pg_progress WHERE table_name = %%s'
+               % plan.schema, (plan.table,))
+
+
+class CommitBudget(object):
+    """
+    Sizes the transactions of a table load so each one stays within
+    max_rows rows, max_bytes bytes and max_seconds seconds.
+
+    Instance attributes:
+    max_rows : int
+    max_bytes : int
+    max_seconds : float
+    row_bytes : float
+    rows_per_second : float
+
+    'row_bytes' and 'rows_per_second' are running estimates, starting
+    from MySQL's average row length (or unknown, 0) and updated with
+    each committed transaction.  batch_rows() turns them into the number
+    of rows to aim for; take() also stops a transaction early when the
+    rows turn out larger or slower than expected.
+    """
+
+    def __init__(self, max_rows, max_bytes, max_seconds, row_bytes=0):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.row_bytes = float(row_bytes)
+        self.rows_per_second = 0.0
+
+    def batch_rows(self):
+        """(): int
+
+        Return the number of rows the next transaction should hold.
+        """
+        rows = self.max_rows
+        if self.row_bytes > 0:
+            rows = min(rows, int(self.max_bytes / self.row_bytes))
+        else:
+            rows = min(rows, COMMIT_FIRST_ROWS)
+        if self.rows_per_second > 0:
+            rows = min(rows, int(self.rows_per_second * self.max_seconds))
+        return max(rows, 1)
+
+    def update(self, rows, size, seconds):
+        """(int, int, float)
+
+        Fold a committed transaction of 'rows' rows, 'size' bytes that
+        took 'seconds' seconds into the estimates.  Each transaction
+        counts for half, so the estimates follow tables whose rows
+        change along the key.
+        """
+        if rows <= 0:
+            return
+        row_bytes = size / float(rows)
+        if self.row_bytes > 0:
+            row_bytes = (self.row_bytes + row_bytes) / 2
+        self.row_bytes = row_bytes
+        if seconds > 0:
+            rate = rows / seconds
+            if self.rows_per_second > 0:
+                rate = (self.rows_per_second + rate) / 2
+            self.rows_per_second = rate
+
+    def take(self, rows, pipeline):
+        """(iter, RowPipeline): iter
+
+        Yield the rows of the next transaction from 'rows', which are
+        read through 'pipeline': batch_rows() rows, or fewer if the
+        pipeline hands over max_bytes bytes or max_seconds pass first.
+        """
+        limit = self.batch_rows()
+        start_bytes = pipeline.consumed_bytes
+        deadline = time.time() + self.max_seconds
+        count = 0
+        for row in rows:
+            yield row
+            count += 1
+            if (count >= limit or
+                pipeline.consumed_bytes - start_bytes >= self.max_bytes or
+                (count % 100 == 0 and time.time() > deadline)):
+                break
+
+
+def track_last_key(rows, position, last_key):
+    """(iter, int, [int]): iter
+
+    Pass rows through, storing the value at 'position' of each one in
+    last_key[0].
+    """
+    for row in rows:
+        last_key[0] = row[position]
+        yield row
+
+
+def load_table_rows(mysql_conn, pg_conn, options, plan, key_range=None,
+                    after_key=None, rows_before=0, where=None, shard=None):
+    """(Connection, Connection, Options, TablePlan, (int, int), int, int,
+        str, int): (int, int)
+
+    Copy the rows of a MySQL table into the PostgreSQL table, committing
+    as the table's CommitBudget allows.  Rows are read through a
+    RowPipeline, and the time each stage spent working and waiting is
+    logged and sent to report_progress() with each commit.  key_range
+    limits the rows to an inclusive range of the integer primary key,
+    after_key to keys greater than it, and 'where' to rows matching an
+    SQL condition.  With options.checkpoint, progress is recorded with
+    each commit; rows_before is the number of rows of the range that
+    were loaded by an earlier run.  'shard' is the number of the MySQL
+    source when there are several (see convert_shards()).  Returns the
+    number of rows converted and the number of rows that failed.
+    """
+    loader = LOADERS[options.loader]
+    pk = plan.primary_key
+
+    conditions = []
+    if key_range is not None:
+        conditions.append('`%s` BETWEEN %d AND %d'
+                          % (pk.name, key_range[0], key_range[1]))
+    if after_key is not None:
+        conditions.append('`%s` > %d' % (pk.name, after_key))
+    if where:
+        conditions.append(where)
+    sql = plan.select_sql
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    if options.checkpoint and pk is not None:
+        # Read in key order so a checkpoint's last key covers every row
+        # before it.  This is the clustered index order for InnoDB.
+        sql += ' ORDER BY `%s`' % pk.name
+
+    stats = TableStats(plan.table, key_range, shard)
+
+    def update_stats():
+        stats.fetch_time = pipeline.fetch_time
+        stats.convert_time = pipeline.convert_time
+        stats.bytes = pipeline.bytes
+        stats.write_time = (time.time() - stats.started -
+                            pipeline.writer_wait - stats.commit_time)
+
+    budget = CommitBudget(options.commit_rows, options.commit_mb << 20,
+                          options.commit_seconds, plan.avg_row_length)
+    last_key = [after_key]
+    # The cursor is closed even if the load fails, which reads the rest
+    # of the result so the connection can be used again.
+    mysql_cur = mysql_conn.cursor(cursorclass=SSCursor)
+    pipeline = None
+    try:
+        mysql_cur.execute(sql)
+        # We don't do a fetchall() since the table contents are
+        # very likely to not fit into memory.
+        pipeline = RowPipeline(mysql_cur, plan, options.fetch_rows,
+                               options.queue_rows, options.queue_mb << 20)
+        rows = iter(pipeline)
+        if options.checkpoint and pk is not None:
+            rows = track_last_key(rows, plan.key_position, last_key)
+        for first in rows:
+            batch_start = time.time()
+            start_bytes = pipeline.consumed_bytes
+            batch = budget.take(itertools.chain([first], rows), pipeline)
+            loaded, failed = loader(pg_conn, options, plan, batch)
+            stats.rows += loaded
+            stats.errors += failed
+            start = time.time()
+            if options.checkpoint:
+                record_checkpoint(pg_conn, options, plan, key_range,
+                                  last_key[0], rows_before + stats.rows,
+                                  False)
+            logging.debug('Committing transaction after %i rows',
+                          stats.rows)
+            pg_conn.commit()
+            stats.commit_time += time.time() - start
+            budget.update(loaded + failed,
+                          pipeline.consumed_bytes - start_bytes,
+                          time.time() - batch_start)
+            update_stats()
+            report_progress(stats)
+    finally:
+        if pipeline is not None:
+            pipeline.close()
+        mysql_cur.close()
+    update_stats()
+    logging.info('Table %s: MySQL read %.1fs, conversion %.1fs, '
+                 'PostgreSQL write %.1fs, commit %.1fs; reader blocked '
+                 '%.1fs, writer blocked %.1fs', plan.table,
+                 stats.fetch_time, stats.convert_time, stats.write_time,
+                 stats.commit_time, pipeline.reader_wait,
+                 pipeline.writer_wait)
+
+    start = time.time()
+    if options.checkpoint:
+        record_checkpoint(pg_conn, options, plan, key_range, last_key[0],
+                          rows_before + stats.rows, True)
+    pg_conn.commit()
+    stats.commit_time += time.time() - start
+    stats.done = True
+    report_progress(stats)
+    return stats.rows, stats.errors
+
+
+def convert_table_data(mysql_conn, pg_conn, options, plan, resume=None):
+    """(Connection, Connection, Options, TablePlan, (int, int)): (int, int)
+
+    Replace the contents of the PostgreSQL table with the rows of the
+    MySQL table (or, with --incremental, just the rows that changed
+    since the last run; see sync_table_data()).  If resume is given, it
+    is the (last_key, row_count) checkpoint of an interrupted run, and
+    the rows after last_key are added to the table instead.  Returns
+    the number of rows converted and the number of rows that failed.
+    """
+    if options.incremental:
+        return sync_table_data(mysql_conn, pg_conn, options, plan)
+    if resume is not None:
+        after_key, rows_before = resume
+        logging.info('Resuming table %s after key %i', plan.table, after_key)
+        return load_table_rows(mysql_conn, pg_conn, options, plan,
+                               after_key=after_key, rows_before=rows_before)
+
+    # Ensure the table is empty.
+    empty_table(pg_conn, options, plan)
+    if options.checkpoint:
+        clear_checkpoints(pg_conn, options, plan)
+    return load_table_rows(mysql_conn, pg_conn, options, plan)
+
+
+def create_sync_table(pg_conn, options, schema):
+    """(Connection, Options, str)
+
+    Create the control table that records the high-water mark of each
+    table for --incremental, unless it already exists.
+    """
+    pg_execute(pg_conn, options, '''
+        CREATE TABLE IF NOT EXISTS "%s".my2pg_sync (
+            table_name text PRIMARY KEY,
+            column_name text NOT NULL,
+            high_water text NOT NULL,
+            updated timestamp NOT NULL DEFAULT now()
+        )''' % schema)
+    pg_conn.commit()
+
+
+def high_water_column(options, plan):
+    """(Options, TablePlan): Column
+
+    Return the column whose values show which rows are new: the
+    --updated-column if the table has it, otherwise an auto_increment
+    integer primary key.  Returns None if there isn't one.
+    """
+    for c in plan.columns:
+        if c.name == options.updated_column:
+            return c
+    if plan.primary_key is not None and plan.primary_key.auto_increment:
+        return plan.primary_key
+    return None
+
+
+def read_high_water(pg_conn, options, plan, column):
+    """(Connection, Options, TablePlan, Column): str
+
+    Return the recorded high-water mark of a table, or None if there
+    isn't one for this column.
+    """
+    if options.dry_run:
+        return None
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute('''SELECT high_water FROM "%s".my2pg_sync
+                      WHERE table_name = %%s AND column_name = %%s'''
+                   % plan.schema, (plan.table, column.name))
+    row = pg_cur.fetchone()
+    pg_cur.close()
+    return row and row[0]
+
+
+def record_high_water(pg_conn, options, plan, column, high_water):
+    """(Connection, Options, TablePlan, Column, any)
+
+    Record the high-water mark of a table.
+    """
+    pg_execute(pg_conn, options,
+               'DELETE FROM "%s".my2pg_sync WHERE table_name = %%s'
+               % plan.schema, (plan.table,))
+    pg_execute(pg_conn, options, '''
+        INSERT INTO "%s".my2pg_sync (table_name, column_name, high_water)
+        VALUES (%%s, %%s, %%s)''' % plan.schema,
+        (plan.table, column.name, unicode(high_water)))
+
+
+def sync_table_data(mysql_conn, pg_conn, options, plan):
+    """(Connection, Connection, Options, TablePlan): (int, int)
+
+    Bring a PostgreSQL table up to date with only the MySQL rows that
+    are past its high-water mark, upserting them by primary key.  An
+    auto_increment key picks up new rows; an --updated-column timestamp
+    picks up changed ones too.  Deleted rows are not noticed.  Tables
+    without a primary key and high-water column, or without a recorded
+    mark, are reloaded.  If any rows fail, the old mark is kept so that
+    the next run tries them again.  Returns the number of rows
+    converted and the number of rows that failed.
+    """
+    column = high_water_column(options, plan)
+    if column is None or not plan.key_columns:
+        logging.warning('Table %s has no primary key and high-water '
+                        'column; reloading it', plan.table)
+        old_mark = None
+    else:
+        old_mark = read_high_water(pg_conn, options, plan, column)
+
+        # Take the new mark before reading, so rows added while the
+        # table is read are picked up again by the next run.
+        mysql_cur = mysql_conn.cursor()
+        mysql_cur.execute('SELECT MAX(`%s`) FROM `%s`'
+                          % (column.name, plan.table))
+        new_mark = mysql_cur.fetchone()[0]
+        mysql_cur.close()
+
+    if old_mark is None:
+        empty_table(pg_conn, options, plan)
+        result = load_table_rows(mysql_conn, pg_conn, options, plan)
+    else:
+        # Timestamps aren't unique, so rows changed in the same second
+        # as the mark are read again; upserting them twice is harmless.
+        op = column is plan.primary_key and '>' or '>='
+        logging.info('Syncing rows of table %s with %s %s %s',
+                     plan.table, column.name, op, old_mark)
+        upsert_plan = plan.for_upsert()
+        if options.loader in ('copy', 'binary'):
+            pg_execute(pg_conn, options, upsert_plan.staging_sql)
+        result = load_table_rows(mysql_conn, pg_conn, options, upsert_plan,
+                                 where='`%s` %s %s' % (
+                                     column.name, op,
+                                     mysql_conn.literal(old_mark)))
+
+    if result[1]:
+        logging.warning('Table %s: %i rows failed; keeping the old '
+                        'high-water mark', plan.table, result[1])
+    elif column is not None and plan.key_columns and new_mark is not None:
+        record_high_water(pg_conn, options, plan, column, new_mark)
+        pg_conn.commit()
+    return result
+
+
+def estimate_range_rows(mysql_cur, table, pk, lo, hi):
+    """(Cursor, str, Column, int, int): int
+
+    Ask the MySQL optimizer how many rows have a primary key between lo
+    and hi.  This uses index dives rather than reading the rows.
+    """
+    mysql_cur.execute('EXPLAIN SELECT * FROM `%s` WHERE `%s` BETWEEN %d AND %d'
+                      % (table, pk.name, lo, hi))
+    row = mysql_cur.fetchone()
+    return int(row['rows'] or 0)
+
+
+def primary_key_chunks(mysql_cur, table, pk, chunk_rows):
+    """(Cursor, str, Column, int): [(int, int)]
+
+    Split a table into inclusive primary key ranges of about chunk_rows
+    rows each.  The key space is bisected using the optimizer's row
+    estimates, so sparse regions end up in wide ranges and dense regions
+    in narrow ones; adjacent small ranges are then merged.
+    """
+    mysql_cur.execute('SELECT MIN(`%s`) AS lo, MAX(`%s`) AS hi FROM `%s`'
+                      % (pk.name, pk.name, table))
+    row = mysql_cur.fetchone()
+    if row['lo'] is None:
+        return []
+
+    leaves = []
+    stack = [(int(row['lo']), int(row['hi']))]
+    while stack:
+        lo, hi = stack.pop()
+        estimate = estimate_range_rows(mysql_cur, table, pk, lo, hi)
+        if estimate > chunk_rows and lo < hi:
+            middle = lo + (hi - lo) // 2
+            # Pushed in reverse so ranges come off the stack in key order.
+            stack.append((middle + 1, hi))
+            stack.append((lo, middle))
+        else:
+            leaves.append((lo, hi, estimate))
+
+    chunks = []
+    for lo, hi, estimate in leaves:
+        if chunks and chunks[-1][2] + estimate <= chunk_rows:
+            chunks[-1] = (chunks[-1][0], hi, chunks[-1][2] + estimate)
+        else:
+            chunks.append((lo, hi, estimate))
+    return [(lo, hi) for lo, hi, estimate in chunks]
+
+
+def chunk_worker(options, db_args, plan, tasks, results, progress=None):
+    """(Options, (str, str, str, str), TablePlan, Queue, Queue, Queue)
+
+    Process body for convert_table_chunked().  Opens a consistent
+    snapshot on its own MySQL connection, reports ('ready', ok), then
+    converts (lo, hi, after_key, rows_before) key ranges from the tasks
+    queue until it gets None.  Each range is reported as
+    ('chunk', lo, hi, rows, errors, failure).  'progress' is the
+    RunReport queue, if any.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _progress['queue'] = progress
+    table = plan.table
+    mysql_host, mysql_db, pg_host, pg_db = db_args
+    try:
+        mysql_conn = connect_mysql(options, mysql_host, mysql_db)
+        mysql_cur = mysql_conn.cursor()
+        mysql_cur.execute('SET SESSION TRANSACTION ISOLATION LEVEL '
+                          'REPEATABLE READ')
+        mysql_cur.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+        mysql_cur.close()
+        pg_conn = connect_pg(options, pg_host, pg_db)
+    except Exception:
+        logging.error('Failure starting worker for table %s', table,
+                      exc_info=True)
+        results.put(('ready', False))
+        return
+    results.put(('ready', True))
+
+    for lo, hi, after_key, rows_before in iter(tasks.get, None):
+        logging.info('Converting rows %i-%i of table %s', lo, hi, table)
+        try:
+            row_count, errors = load_table_rows(
+                mysql_conn, pg_conn, options, plan, (lo, hi),
+                after_key, rows_before)
+        except Exception as err:
+            logging.error('Failure converting rows %i-%i of table %s',
+                          lo, hi, table, exc_info=True)
+            results.put(('chunk', lo, hi, 0, 0,
+                         str(err).strip() or err.__class__.__name__))
+            break
+        results.put(('chunk', lo, hi, row_count, errors, None))
+    mysql_conn.close()
+    pg_conn.close()
+
+
+def convert_table_chunked(mysql_conn, pg_conn, options, db_args, plan,
+                          chunks, resume=False):
+    """(Connection, Connection, Options, (str, str, str, str), TablePlan,
+        [(int, int, int, int)], bool): (str, int, int, str)
+
+    Replace the contents of a PostgreSQL table by converting primary
+    key ranges of the MySQL table concurrently in options.jobs worker
+    processes.  'chunks' holds (lo, hi, after_key, rows_before) tuples
+    as taken by load_table_rows().  If resume is true, the chunks are
+    the unfinished part of an interrupted run and the rows already in
+    the table are kept.  The table is locked against writes on
+    mysql_conn while the workers start their transactions, so they all
+    read the same snapshot.  Returns (table, rows, errors, failure) like
+    convert_table_worker().
+    """
+    table = plan.table
+    logging.info('Converting data in table %s as %i chunks',
+                 table, len(chunks))
+    if not resume:
+        empty_table(pg_conn, options, plan)
+        if options.checkpoint:
+            # Record the ranges up front, so that a resumed run uses the
+            # same ones.
+            clear_checkpoints(pg_conn, options, plan)
+            for lo, hi, after_key, rows_before in chunks:
+                record_checkpoint(pg_conn, options, plan, (lo, hi), None, 0,
+                                  False)
+        pg_conn.commit()
+
+    tasks = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    num_workers = min(options.jobs, len(chunks))
+    for chunk in chunks:
+        tasks.put(chunk)
+    for i in range(num_workers):
+        tasks.put(None)
+
+    mysql_cur = mysql_conn.cursor()
+    locked = False
+    try:
+        mysql_cur.execute('LOCK TABLES `%s` READ' % table)
+        locked = True
+    except MySQLdb.Error:
+        logging.warning('Could not lock table %s; chunks may not see '
+                        'a consistent snapshot', table, exc_info=True)
+
+    workers = [multiprocessing.Process(target=chunk_worker,
+                                       args=(options, db_args, plan,
+                                             tasks, results,
+                                             _progress.get('queue')))
+               for i in range(num_workers)]
+    row_count = 0
+    errors = 0
+    failures = []
+    try:
+        for w in workers:
+            w.start()
+        ready = 0
+        remaining = len(chunks)
+        while remaining or ready < num_workers:
+            try:
+                msg = results.get(timeout=1)
+            except Queue.Empty:
+                if not any(w.is_alive() for w in workers):
+                    break
+                continue
+            if msg[0] == 'ready':
+                ready += 1
+                if not msg[1]:
+                    logging.warning('A worker for table %s failed to start',
+                                    table)
+                # Release the lock once every worker has its snapshot.
+                if ready == num_workers and locked:
+                    mysql_cur.execute('UNLOCK TABLES')
+                    locked = False
+                continue
+            remaining -= 1
+            _, lo, hi, chunk_rows, chunk_errors, failure = msg
+            row_count += chunk_rows
+            errors += chunk_errors
+            if failure is not None:
+                failures.append('rows %i-%i: %s' % (lo, hi, failure))
+        if remaining:
+            failures.append('%i chunks were not converted' % remaining)
+        for w in workers:
+            w.join()
+    except BaseException:
+        for w in workers:
+            if w.is_alive():
+                w.terminate()
+        raise
+    finally:
+        if locked:
+            mysql_cur.execute('UNLOCK TABLES')
+        mysql_cur.close()
+
+    if failures:
+        return table, row_count, errors, '; '.join(failures)
+    logging.info("Table %s: %i rows converted (%i errors)",
+                 table, row_count, errors)
+    return table, row_count, errors, None
+
+
+# Per-process state for convert_table_worker().
+_worker = {}
+
+
+def init_worker(options, db_args, progress=None):
+    """(Options, (str, str, str, str), Queue)
+
+    Initializer for the processes of the --jobs pool.  Connections are
+    opened lazily by convert_table_worker().  'progress' is the
+    RunReport queue, if any.
+    """
+    # Let the parent process handle ^C and terminate the pool.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _worker['options'] = options
+    _worker['db_args'] = db_args
+    _progress['queue'] = progress
+
+
+def convert_table_worker(args):
+    """((TablePlan, (int, int))): (str, int, int, str)
+
+    Convert the data of one table inside a pool process, using the
+    process's own pair of MySQL and PostgreSQL connections.  args holds
+    the plan and convert_table_data()'s resume argument.
+    Returns (table, rows, errors, failure), where failure is None on
+    success or the error message if the table could not be converted.
+    """
+    plan, resume = args
+    table = plan.table
+    options = _worker['options']
+    mysql_host, mysql_db, pg_host, pg_db = _worker['db_args']
+    try:
+        if 'mysql_conn' not in _worker:
+            _worker['mysql_conn'] = connect_mysql(options, mysql_host,
+                                                  mysql_db)
+            _worker['pg_conn'] = connect_pg(options, pg_host, pg_db)
+        logging.info('Converting data in table %s', table)
+        row_count, errors = convert_table_data(_worker['mysql_conn'],
+                                               _worker['pg_conn'], options,
+                                               plan, resume)
+    except Exception as err:
+        logging.error('Failure converting table %s', table, exc_info=True)
+        # The connections may be unusable; reconnect for the next table.
+        for name in ('mysql_conn', 'pg_conn'):
+            conn = _worker.pop(name, None)
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+        return table, 0, 0, str(err).strip() or err.__class__.__name__
+    return table, row_count, errors, None
+
+
+def convert_tables_parallel(options, db_args, tasks):
+    """(Options, (str, str, str, str), [(TablePlan, (int, int))]):
+       [(str, int, int, str)]
+
+    Convert the data of several tables concurrently in a pool of
+    options.jobs processes.  A table that fails is reported without
+    stopping the other tables; the batches it had already committed
+    stay in its PostgreSQL table.  Returns the convert_table_worker()
+    results in order of completion.
+    """
+    pool = multiprocessing.Pool(options.jobs, init_worker,
+                                (options, db_args, _progress.get('queue')))
+    results = []
+    try:
+        for result in pool.imap_unordered(convert_table_worker, tasks):
+            table, row_count, errors, failure = result
+            if failure is None:
+                logging.info("Table %s: %i rows converted (%i errors)",
+                             table, row_count, errors)
+            results.append(result)
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+def convert_tables_serial(options, db_args, tasks):
+    """(Options, (str, str, str, str), [(TablePlan, (int, int))]):
+       [(str, int, int, str)]
+
+    Convert the data of several tables one after another in this
+    process, handling failures like convert_tables_parallel().
+    Returns the convert_table_worker() results in order.
+    """
+    _worker['options'] = options
+    _worker['db_args'] = db_args
+    results = []
+    try:
+        for task in tasks:
+            result = convert_table_worker(task)
+            table, row_count, errors, failure = result
+            if failure is None:
+                logging.info("Table %s: %i rows converted (%i errors)",
+                             table, row_count, errors)
+            results.append(result)
+    finally:
+        for name in ('mysql_conn', 'pg_conn'):
+            conn = _worker.pop(name, None)
+            if conn is not None:
+                conn.close()
+    return results
+
+
+def parse_shard(value, mysql_db):
+    """(str, str): (str, str)
+
+    Parse a --shard value, 'host' or 'host/database', into the host and
+    database, which defaults to mysql_db.
+    """
+    host, sep, db = value.partition('/')
+    return host, db or mysql_db
+
+
+def check_shards(options, mysql_cur, sources, plans):
+    """(Options, Cursor, [(str, str)], [TablePlan]): {str: int}
+
+    Check that every MySQL source other than the first, whose structure
+    is in the plans and which mysql_cur is connected to, has the same
+    tables with the same columns and indexes.  Returns the estimated
+    number of rows of each table, added up over all the sources, or
+    None if the structures differ, which is logged.
+    """
+    def structures(cur, db):
+        # Leave out the creation time, which differs between shards.
+        return dict((table, fingerprint.split('/', 1)[1])
+                    for table, fingerprint
+                    in read_mysql_fingerprints(cur, db).items())
+
+    mysql_host, mysql_db = sources[0]
+    expected = structures(mysql_cur, mysql_db)
+    estimates = read_table_estimates(mysql_cur, mysql_db)
+    matching = True
+    for host, db in sources[1:]:
+        mysql_conn = connect_mysql(options, host, db)
+        cur = mysql_conn.cursor(cursorclass=DictCursor)
+        found = structures(cur, db)
+        for plan in plans:
+            if plan.table not in found:
+                logging.error('Shard %s/%s has no table %s', host, db,
+                              plan.table)
+                matching = False
+            elif found[plan.table] != expected[plan.table]:
+                logging.error('Table %s of shard %s/%s differs from '
+                              '%s/%s', plan.table, host, db,
+                              mysql_host, mysql_db)
+                matching = False
+        for table, rows in read_table_estimates(cur, db).items():
+            estimates[table] = estimates.get(table, 0) + rows
+        mysql_conn.close()
+    if not matching:
+        return None
+    return estimates
+
+
+def shard_table_worker(args):
+    """((TablePlan, int, (str, str))): (str, int, int, int, str)
+
+    Load one table of one MySQL shard inside a pool process, over a
+    MySQL connection of its own and the process's PostgreSQL
+    connection.  args holds the plan, the shard's number and its
+    (host, database).  Returns (table, shard, rows, errors, failure),
+    where failure is None on success or the error message.
+    """
+    plan, shard, (host, db) = args
+    options = _worker['options']
+    mysql_conn = None
+    try:
+        if 'pg_conn' not in _worker:
+            _worker['pg_conn'] = connect_pg(options, *_worker['db_args'][2:])
+        mysql_conn = connect_mysql(options, host, db)
+        logging.info('Converting data in table %s from %s/%s', plan.table,
+                     host, db)
+        row_count, errors = load_table_rows(mysql_conn, _worker['pg_conn'],
+                                            options, plan, shard=shard)
+    except Exception as err:
+        logging.error('Failure converting table %s from %s/%s', plan.table,
+                      host, db, exc_info=True)
+        pg_conn = _worker.pop('pg_conn', None)
+        for conn in (pg_conn, mysql_conn):
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+        return (plan.table, shard, 0, 0,
+                str(err).strip() or err.__class__.__name__)
+    mysql_conn.close()
+    return plan.table, shard, row_count, errors, None
+
+
+def convert_shards(options, pg_conn, pg_args, sources, plans):
+    """(Options, Connection, (str, str), [(str, str)], [TablePlan]):
+       [(str, int, int, str)]
+
+    Load the tables from several MySQL sources with the same structure
+    into the same PostgreSQL tables.  The tables are emptied once, then
+    every table of every source is loaded concurrently in a pool of
+    options.jobs processes.  Sources are numbered from 1 in order; with
+    --shard-column the number is stored in every row.  Returns one
+    (table, rows, errors, failure) result per table, like
+    convert_tables_parallel(), where failure describes the sources
+    that failed, if any.
+    """
+    tasks = []
+    for plan in plans:
+        for shard, source in enumerate(sources, 1):
+            shard_plan = plan
+            if options.shard_column:
+                shard_plan = shard_plan.for_shard(options.shard_column, shard)
+            if options.swap:
+                shard_plan = shard_plan.for_shadow()
+            if shard == 1:
+                empty_table(pg_conn, options, shard_plan)
+            tasks.append((shard_plan, shard, source))
+    pg_conn.commit()
+
+    totals = dict((plan.table, [0, 0, []]) for plan in plans)
+    pool = multiprocessing.Pool(options.jobs, init_worker,
+                                (options, (None, None) + pg_args,
+                                 _progress.get('queue')))
+    try:
+        for table, shard, row_count, errors, failure in pool.imap_unordered(
+                shard_table_worker, tasks):
+            host, db = sources[shard - 1]
+            if failure is None:
+                logging.info('Table %s from %s/%s: %i rows converted (%i '
+                             'errors)', table, host, db, row_count, errors)
+            else:
+                totals[table][2].append('%s/%s: %s' % (host, db, failure))
+            totals[table][0] += row_count
+            totals[table][1] += errors
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return [(table, row_count, errors, failures and '; '.join(failures) or
+             None)
+            for table, (row_count, errors, failures)
+            in sorted(totals.items())]
+
+
+def run_statements(options, pg_args, statements, jobs, times=None):
+    """(Options, (str, str), [(str, str)], int, {str: float}): set(str)
+
+    Execute (table, sql) pairs in any order over up to 'jobs' PostgreSQL
+    connections at once, committing each statement.  Failures are logged
+    and skipped.  If 'times' is given, the seconds spent on each table
+    are added to it.  Returns the set of tables with a statement that
+    failed.
+    """
+    work = Queue.Queue()
+    for item in statements:
+        work.put(item)
+    failures = set()
+    lock = threading.Lock()
+
+    def run():
+        pg_conn = connect_pg(options, *pg_args)
+        try:
+            if options.maintenance_work_mem:
+                pg_execute(pg_conn, options, 'SET maintenance_work_mem = %s',
+                           (options.maintenance_work_mem,))
+            while True:
+                try:
+                    table, sql = work.get_nowait()
+                except Queue.Empty:
+                    break
+                start = time.time()
+                try:
+                    pg_execute(pg_conn, options, sql)
+                    pg_conn.commit()
+                except Exception:
+                    pg_conn.rollback()
+                    logging.error('Failure on table %s\n Statement: %s',
+                                  table, sql, exc_info=True)
+                    failures.add(table)
+                else:
+                    logging.info('%s: %s (%.1fs)', table, sql,
+                                 time.time() - start)
+                if times is not None:
+                    lock.acquire()
+                    try:
+                        times[table] = (times.get(table, 0) +
+                                        time.time() - start)
+                    finally:
+                        lock.release()
+        finally:
+            pg_conn.close()
+
+    threads = [threading.Thread(target=run)
+               for i in range(min(jobs, len(statements)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # Join with a timeout so ^C still reaches the main thread.
+        while t.is_alive():
+            t.join(1)
+    return failures
+
+
+def build_indexes(options, pg_args, plans, times=None):
+    """(Options, (str, str), [TablePlan], {str: float}): set(str)
+
+    Add the primary keys and indexes of tables created with
+    bare_create_sql, then ANALYZE them.  Each step runs over
+    options.index_jobs connections at once; primary keys go first since
+    ALTER TABLE locks out concurrent index builds on the same table.
+    The time spent on each table is added to 'times', if given.
+    Returns the set of tables for which a statement failed.
+    """
+    jobs = options.index_jobs or options.jobs
+    logging.info('Building indexes')
+    start = time.time()
+    failures = run_statements(options, pg_args,
+                              [(p.table, p.primary_key_sql) for p in plans
+                               if p.primary_key_sql], jobs, times)
+    failures |= run_statements(options, pg_args,
+                               [(p.table, sql) for p in plans
+                                for sql in p.index_sql], jobs, times)
+    logging.info('Built indexes in %.1fs (%i tables failed)',
+                 time.time() - start, len(failures))
+    return failures | analyze_tables(options, pg_args, plans, times)
+
+
+def analyze_tables(options, pg_args, plans, times=None):
+    """(Options, (str, str), [TablePlan], {str: float}): set(str)
+
+    ANALYZE the tables over options.index_jobs connections at once,
+    adding the time spent on each table to 'times', if given.  Returns
+    the set of tables that failed.
+    """
+    start = time.time()
+    failures = run_statements(options, pg_args,
+                              [(p.table, 'ANALYZE "%s".%s' %
+                                (p.schema, p.pg_table)) for p in plans],
+                              options.index_jobs or options.jobs, times)
+    logging.info('Analyzed tables in %.1fs (%i failures)',
+                 time.time() - start, len(failures))
+    return failures
+
+
+def set_tables_logged(options, pg_args, plans):
+    """(Options, (str, str), [TablePlan]): set(str)
+
+    Switch tables created UNLOGGED by --fast-load back to LOGGED, over
+    options.index_jobs connections at once.  Each table is written to
+    the WAL in one pass; this needs PostgreSQL 9.5 or later.  Returns
+    the set of tables that failed.
+    """
+    start = time.time()
+    failures = run_statements(options, pg_args,
+                              [(p.table, 'ALTER TABLE "%s".%s SET LOGGED' %
+                                (p.schema, p.pg_table)) for p in plans],
+                              options.index_jobs or options.jobs)
+    logging.info('Switched tables to LOGGED in %.1fs (%i failures)',
+                 time.time() - start, len(failures))
+    return failures
+
+
+def swap_tables(pg_conn, options, plans, skipped):
+    """(Connection, Options, [TablePlan], {str: str}): int
+
+    Put the shadow tables of plans from for_shadow() in place with
+    swap_table(), except for the tables in 'skipped', which maps them
+    to the reason they are left in their shadow.  Returns the number
+    of tables swapped in.
+    """
+    swapped = 0
+    for plan in plans:
+        if plan.table in skipped:
+            logging.error('Table %s was not swapped in because %s; its '
+                          'rows are left in %s', plan.table,
+                          skipped[plan.table], plan.pg_table)
+        elif swap_table(pg_conn, options, plan):
+            swapped += 1
+    return swapped
+
+
+def privileges_sql(pg_cur, kind, old, new):
+    """(Cursor, str, str, str): [str]
+
+    Return the GRANT statements that give the table or sequence 'new'
+    the privileges on 'old'; kind is TABLE or SEQUENCE.  Needs
+    PostgreSQL 9.0 or later.
+    """
+    pg_cur.execute('''SELECT a.privilege_type,
+                             CASE a.grantee WHEN 0 THEN 'PUBLIC'
+                             ELSE quote_ident(pg_get_userbyid(a.grantee))
+                             END,
+                             a.is_grantable
+                      FROM pg_class c, aclexplode(c.relacl) a
+                      WHERE c.oid = %s::regclass''', (old,))
+    return ['GRANT %s ON %s %s TO %s%s' % (
+                privilege, kind, new, grantee,
+                grantable and ' WITH GRANT OPTION' or '')
+            for privilege, grantee, grantable in pg_cur.fetchall()]
+
+
+def swap_table(pg_conn, options, plan):
+    """(Connection, Options, TablePlan): bool
+
+    Put the shadow table loaded by a for_shadow() plan in place of the
+    live table in one short transaction, giving the shadow the live
+    table's owner and privileges and those of its sequences, dropping
+    the live table and renaming the shadow, its indexes and its
+    sequences.  Comments, triggers, column privileges and policies of
+    the live table are not carried over.  The transaction locks the
+    live table, so readers wait for it, but only briefly.  If it
+    fails, for instance because views depend on the live table, the
+    live table is instead truncated and the rows copied over from the
+    shadow, also in one transaction, during which readers of the live
+    table are blocked.  Returns true if the table was swapped.
+    """
+    if options.dry_run:
+        return True
+    schema = plan.schema
+    live = '"%s".%s' % (schema, plan.live_table)
+    shadow = '"%s".%s' % (schema, plan.pg_table)
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute('''SELECT 1 FROM pg_tables
+                      WHERE schemaname = %s AND tablename = %s
+                   ''', (schema, plan.live_table.strip('"').lower()))
+    exists = bool(pg_cur.fetchall())
+    grants = []
+    renames = ['ALTER INDEX "%s".%s RENAME TO %s' % (schema, old, new)
+               for old, new in plan.index_renames]
+    if exists:
+        grants = privileges_sql(pg_cur, 'TABLE', live, shadow)
+        pg_cur.execute('SELECT quote_ident(pg_get_userbyid(relowner)) '
+                       'FROM pg_class WHERE oid = %s::regclass', (live,))
+        # Owned sequences follow the table to the new owner.
+        grants.append('ALTER TABLE %s OWNER TO %s' % (
+            shadow, pg_cur.fetchone()[0]))
+        # Give the shadow's sequences the names and privileges of the
+        # live table's.
+        for c in plan.columns:
+            if not c.auto_increment:
+                continue
+            pg_cur.execute('SELECT pg_get_serial_sequence(%s, %s), '
+                           'pg_get_serial_sequence(%s, %s)',
+                           (shadow, c.name, live, c.name))
+            new_sequence, old_sequence = pg_cur.fetchone()
+            if new_sequence and old_sequence:
+                grants[-1:-1] = privileges_sql(pg_cur, 'SEQUENCE',
+                                               old_sequence, new_sequence)
+                renames.append('ALTER SEQUENCE %s RENAME TO %s' % (
+                    new_sequence, old_sequence.split('.', 1)[1]))
+    pg_cur.close()
+    pg_conn.commit()
+
+    try:
+        for sql in grants:
+            pg_execute(pg_conn, options, sql)
+        if exists:
+            pg_execute(pg_conn, options, 'DROP TABLE %s' % live)
+        pg_execute(pg_conn, options, 'ALTER TABLE %s RENAME TO %s' %
+                   (shadow, plan.live_table))
+        for sql in renames:
+            pg_execute(pg_conn, options, sql)
+        pg_conn.commit()
+        return True
+    except psycopg2.Error:
+        pg_conn.rollback()
+        if not exists:
+            logging.error('Could not rename the new table %s; its rows are '
+                          'left in %s', plan.live_table, plan.pg_table,
+                          exc_info=True)
+            return False
+        logging.warning('Could not swap in the new table %s; copying its '
+                        'rows instead', plan.live_table, exc_info=True)
+    pg_execute(pg_conn, options, 'TRUNCATE %s' % live)
+    pg_execute(pg_conn, options, 'INSERT INTO %s (%s) SELECT %s FROM %s' %
+               (live, plan.column_list, plan.column_list, shadow))
+    pg_execute(pg_conn, options, 'DROP TABLE %s' % shadow)
+    pg_conn.commit()
+    return False
+
+
+def reset_sequences(pg_conn, options, plans, auto_increments):
+    """(Connection, Options, [TablePlan], {str: int})
+
+    Set the sequences of the auto_increment columns of the converted
+    tables so they continue from MySQL's AUTO_INCREMENT values, with a
+    single statement.  Tables without a known value get max() + 1 of
+    the column, which MySQL requires to be indexed.  Other sequences
+    are left alone, as are tables that don't exist in PostgreSQL; if
+    the statement fails anyway, the error is logged.
+    """
+    if not options.dry_run:
+        pg_cur = pg_conn.cursor()
+        pg_cur.execute('SELECT schemaname, tablename FROM pg_tables '
+                       'WHERE schemaname = ANY(%s)',
+                       (sorted(set(plan.schema for plan in plans)),))
+        existing = set(pg_cur.fetchall())
+        pg_cur.close()
+        for plan in plans:
+            if (plan.schema, plan.pg_table.strip('"').lower()) not in existing:
+                logging.warning('Table %s does not exist; its sequences '
+                                'were not reset', plan.pg_table)
+        plans = [plan for plan in plans
+                 if (plan.schema, plan.pg_table.strip('"').lower())
+                 in existing]
+    exprs = []
+    args = []
+    for plan in plans:
+        for c in plan.columns:
+            if (not c.auto_increment or
+                convert_type(c.type, True) not in ('serial', 'bigserial')):
+                continue
+            table = '"%s".%s' % (plan.schema, plan.pg_table)
+            sequence = 'pg_get_serial_sequence(%s, %s)'
+            args.extend([table, c.name])
+            next_value = auto_increments.get(plan.table)
+            if next_value is not None:
+                exprs.append('setval(%s, %%s, false)' % sequence)
+                args.append(next_value)
+            else:
+                exprs.append('setval(%s, COALESCE((SELECT max("%s") FROM %s), '
+                             '0) + 1, false)' % (sequence, c.name, table))
+    if not exprs:
+        return
+    try:
+        pg_execute(pg_conn, options, 'SELECT ' + ', '.join(exprs), args)
+    except psycopg2.Error:
+        pg_conn.rollback()
+        logging.error('Could not reset the sequences', exc_info=True)
+        return
+    pg_conn.commit()
+
+
+def dump_table(mysql_conn, options, plan, directory):
+    """(Connection, Options, TablePlan, str): [{str: any}]
+
+    Write the rows of a MySQL table to gzipped files of PostgreSQL COPY
+    text in 'directory', starting a new file once one holds
+    options.segment_mb MB of uncompressed data.  Files are written
+    under a temporary name and renamed when complete.  Returns the
+    manifest entries of the files, with their names and numbers of rows
+    and uncompressed bytes.  The cursor is closed even if a file
+    cannot be written, which reads the rest of the result so that the
+    connection can be used for the next table.
+    """
+    mysql_cur = mysql_conn.cursor(cursorclass=SSCursor)
+    try:
+        mysql_cur.execute(plan.select_sql)
+        return write_segments(mysql_cur, options, plan, directory)
+    finally:
+        mysql_cur.close()
+
+
+def write_segments(mysql_cur, options, plan, directory):
+    """(Cursor, Options, TablePlan, str): [{str: any}]
+
+    Do the work of dump_table() for an executed cursor.
+    """
+    pipeline = RowPipeline(mysql_cur, plan, options.fetch_rows,
+                           options.queue_rows, options.queue_mb << 20)
+    stream = CopyRowStream(pipeline)
+    limit = options.segment_mb << 20
+    segments = []
+    out = None
+    try:
+        while True:
+            rows_before = stream.row_count
+            data = stream.read()
+            if not data:
+                break
+            segment = {'file': '%s.%04i.copy.gz' % (plan.table,
+                                                    len(segments)),
+                       'bytes': 0}
+            path = os.path.join(directory, segment['file'])
+            out = gzip.open(path + '.tmp', 'wb', options.compress_level)
+            while data:
+                out.write(data)
+                segment['bytes'] += len(data)
+                if segment['bytes'] >= limit:
+                    break
+                data = stream.read()
+            out.close()
+            out = None
+            os.rename(path + '.tmp', path)
+            segment['rows'] = stream.row_count - rows_before
+            segments.append(segment)
+            logging.info('Wrote %s: %i rows', segment['file'],
+                         segment['rows'])
+    finally:
+        pipeline.close()
+        if out is not None:
+            out.close()
+    return segments
+
+
+def dump_database(options, mysql_host, mysql_db, directory):
+    """(Options, str, str, str): int
+
+    Write the tables of a MySQL database to 'directory' for a later
+    'load': schema.sql with the PostgreSQL DDL, plans.pickle with the
+    table plans, gzipped COPY files from dump_table(), and
+    manifest.json, which lists the files of each table.  All tables are
+    read from one consistent snapshot.  The manifest is written last, so
+    a dump without one is incomplete.  Returns the number of tables that
+    could not be dumped.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    mysql_conn = connect_mysql(options, mysql_host, mysql_db)
+    mysql_cur = mysql_conn.cursor(cursorclass=DictCursor)
+    plans = read_plans(mysql_cur, mysql_db, options,
+                       options.pg_schema or 'public')
+    mysql_cur.close()
+
+    f = open(os.path.join(directory, 'schema.sql'), 'w')
+    try:
+        for plan in plans:
+            f.write(plan.create_sql + ';\n')
+            for sql in plan.index_sql:
+                f.write(sql + ';\n')
+    finally:
+        f.close()
+    f = open(os.path.join(directory, 'plans.pickle'), 'wb')
+    try:
+        pickle.dump(plans, f)
+    finally:
+        f.close()
+
+    mysql_cur = mysql_conn.cursor()
+    mysql_cur.execute('SET SESSION TRANSACTION ISOLATION LEVEL '
+                      'REPEATABLE READ')
+    mysql_cur.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+    mysql_cur.close()
+    manifest = {'mysql_db': mysql_db,
+                'started': datetime.datetime.now().isoformat(),
+                'tables': {}, 'failed': {}}
+    for plan in plans:
+        logging.info('Dumping table %s', plan.table)
+        try:
+            segments = dump_table(mysql_conn, options, plan, directory)
+        except Exception as err:
+            logging.error('Failure dumping table %s', plan.table,
+                          exc_info=True)
+            manifest['failed'][plan.table] = (str(err).strip() or
+                                              err.__class__.__name__)
+            continue
+        manifest['tables'][plan.table] = {
+            'rows': sum(segment['rows'] for segment in segments),
+            'segments': segments}
+    # Read after the rows, so no dumped key is past them.
+    mysql_cur = mysql_conn.cursor(cursorclass=DictCursor)
+    manifest['auto_increment'] = read_auto_increments(mysql_cur, mysql_db)
+    mysql_cur.close()
+    mysql_conn.close()
+
+    manifest['finished'] = datetime.datetime.now().isoformat()
+    f = open(os.path.join(directory, 'manifest.json'), 'w')
+    try:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    logging.info('Dumped %i rows in %i tables',
+                 sum(t['rows'] for t in manifest['tables'].values()),
+                 len(manifest['tables']))
+    return len(manifest['failed'])
+
+
+def load_segment_worker(args):
+    """((str, str, str, int)): (str, str, int, str)
+
+    Load one file written by dump_table() inside a pool process, with
+    COPY over the process's own PostgreSQL connection, and commit it.
+    args holds the table, COPY statement, path and number of rows.
+    Returns (table, path, rows, failure), where failure is None on
+    success or the error message.
+    """
+    table, copy_sql, path, row_count = args
+    options = _worker['options']
+    mysql_host, mysql_db, pg_host, pg_db = _worker['db_args']
+    try:
+        if 'pg_conn' not in _worker:
+            _worker['pg_conn'] = connect_pg(options, pg_host, pg_db)
+        pg_conn = _worker['pg_conn']
+        logging.info('Loading %s', path)
+        f = gzip.open(path, 'rb')
+        try:
+            pg_copy(pg_conn, options, copy_sql, f)
+        finally:
+            f.close()
+        pg_conn.commit()
+    except Exception as err:
+        logging.error('Failure loading %s', path, exc_info=True)
+        conn = _worker.pop('pg_conn', None)
+        try:
+            if conn is not None:
+                conn.close()
+        except Exception:
+            pass
+        return table, path, 0, str(err).strip() or err.__class__.__name__
+    return table, path, row_count, None
+
+
+def load_dump(options, directory, pg_host, pg_db):
+    """(Options, str, str, str): int
+
+    Load a directory written by dump_database() into PostgreSQL.  The
+    tables are created (unless --data-only) and emptied, and then the
+    COPY files are loaded over options.jobs connections at once, each
+    file in its own transaction.  Returns the number of files that
+    failed to load, plus the number of tables that could not be
+    switched to LOGGED or indexed.
+    """
+    f = open(os.path.join(directory, 'manifest.json'))
+    try:
+        manifest = json.load(f)
+    finally:
+        f.close()
+    f = open(os.path.join(directory, 'plans.pickle'), 'rb')
+    try:
+        plans = [p for p in pickle.load(f) if p.table in manifest['tables']]
+    finally:
+        f.close()
+    for table in sorted(manifest['failed']):
+        logging.warning('Table %s is missing from the dump: %s',
+                        table, manifest['failed'][table])
+
+    pg_conn = connect_pg(options, pg_host, pg_db)
+    if not options.data_only:
+        create_tables(pg_conn, options, plans)
+    tasks = []
+    for plan in plans:
+        empty_table(pg_conn, options, plan)
+        for segment in manifest['tables'][plan.table]['segments']:
+            tasks.append((plan.table, plan.copy_sql,
+                          os.path.join(directory, segment['file']),
+                          segment['rows']))
+    pg_conn.commit()
+
+    pool = multiprocessing.Pool(options.jobs, init_worker,
+                                (options, (None, None, pg_host, pg_db)))
+    failures = []
+    row_count = 0
+    try:
+        for table, path, rows, failure in pool.imap_unordered(
+                load_segment_worker, tasks):
+            row_count += rows
+            if failure is not None:
+                failures.append((path, failure))
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    logging.info('Loaded %i rows from %i files', row_count,
+                 len(tasks) - len(failures))
+    for path, failure in sorted(failures):
+        logging.error('%s was not loaded: %s', path, failure)
+
+    step_failed = set()
+    if options.fast_load and not options.data_only:
+        step_failed |= set_tables_logged(options, (pg_host, pg_db), plans)
+    if options.defer_indexes and not options.data_only:
+        step_failed |= build_indexes(options, (pg_host, pg_db), plans)
+    elif options.fast_load:
+        step_failed |= analyze_tables(options, (pg_host, pg_db), plans)
+    reset_sequences(pg_conn, options, plans,
+                    manifest.get('auto_increment', {}))
+    pg_conn.close()
+    return len(failures) + len(step_failed)
+
+
+# Rows per chunk for 'verify' when --chunk-rows isn't given, the number
+# of rows below which a mismatching range is compared row by row, and
+# the number of differing keys reported per table.
+VERIFY_CHUNK_ROWS = 100000
+VERIFY_ROWS = 1000
+VERIFY_MAX_KEYS = 1000
+
+# Shown instead of NULL in checksummed values.
+CHECKSUM_NULL = '~NULL~'
+
+
+def checksum_exprs(c):
+    """(Column): (str, str)
+
+    Return MySQL and PostgreSQL expressions that render a column's value
+    as the same text on both servers, normalized the way the conversion
+    treats it: zero dates become NULL or the epoch, and floating point
+    numbers are rounded to 6 decimal places.  NULL is rendered as
+    CHECKSUM_NULL.
+    """
+    typ = c.type.lower()
+    pg_type = convert_type(typ)
+    my = '`%s`' % c.name
+    pg = '"%s"' % c.name
+    if typ in ('datetime', 'timestamp'):
+        zero = c.is_nullable and 'NULL' or "'1970-01-01 00:00:00'"
+        my = ("IF(%s != '0000-00-00 00:00:00', "
+              "DATE_FORMAT(%s, '%%Y-%%m-%%d %%H:%%i:%%s'), %s)"
+              % (my, my, zero))
+        pg = "to_char(%s, 'YYYY-MM-DD HH24:MI:SS')" % pg
+    elif typ == 'date':
+        zero = c.is_nullable and 'NULL' or "'1970-01-01'"
+        my = ("IF(%s != '0000-00-00', DATE_FORMAT(%s, '%%Y-%%m-%%d'), %s)"
+              % (my, my, zero))
+        pg = "to_char(%s, 'YYYY-MM-DD')" % pg
+    elif typ in BLOB_TYPES:
+        my = 'HEX(%s)' % my
+        pg = "upper(encode(%s, 'hex'))" % pg
+    elif typ in GEOMETRY_TYPES:
+        my = 'AsText(%s)' % my
+        pg = 'ST_AsText(%s)' % pg
+    elif pg_type in ('real', 'double precision'):
+        my = 'CAST(%s AS DECIMAL(65, 6))' % my
+        pg = 'round(%s::numeric, 6)::text' % pg
+    elif pg_type == 'interval':
+        my = 'TIME_TO_SEC(%s)' % my
+        pg = 'extract(epoch from %s)::bigint::text' % pg
+    else:
+        my = 'CAST(%s AS CHAR)' % my
+        pg = '%s::text' % pg
+    return ("IFNULL(%s, '%s')" % (my, CHECKSUM_NULL),
+            "COALESCE(%s, '%s')" % (pg, CHECKSUM_NULL))
+
+
+def checksum_sql(plan):
+    """(TablePlan): (str, str)
+
+    Return the MySQL and PostgreSQL expressions for the MD5 checksum of
+    a row of the table, as 32 hex digits.
+    """
+    exprs = [checksum_exprs(c) for c in plan.columns]
+    return ("MD5(CONVERT(CONCAT_WS('|', %s) USING utf8mb4))"
+            % ', '.join(my for my, pg in exprs),
+            "md5(%s)" % " || '|' || ".join(pg for my, pg in exprs))
+
+
+def key_range_condition(column, lo, hi):
+    """(str, int, int): str
+
+    Return a WHERE condition for a key range, where lo or hi may be None
+    for an open end.
+    """
+    conditions = []
+    if lo is not None:
+        conditions.append('%s >= %d' % (column, lo))
+    if hi is not None:
+        conditions.append('%s <= %d' % (column, hi))
+    return conditions and ' WHERE ' + ' AND '.join(conditions) or ''
+
+
+def range_checksums(mysql_conn, pg_conn, plan, lo, hi):
+    """(Connection, Connection, TablePlan, int, int): ((int, int), (int, int))
+
+    Return the (count, checksum) of the rows with keys from lo to hi on
+    MySQL and on PostgreSQL.  The checksum adds up the first 60 bits of
+    every row's MD5, so it doesn't depend on the order of the rows.
+    Tables without an integer primary key are checksummed whole.
+    """
+    my_hash, pg_hash = checksum_sql(plan)
+    my_where = pg_where = ''
+    if plan.primary_key is not None:
+        my_where = key_range_condition('`%s`' % plan.primary_key.name, lo, hi)
+        pg_where = key_range_condition('"%s"' % plan.primary_key.name, lo, hi)
+    mysql_cur = mysql_conn.cursor()
+    mysql_cur.execute('SELECT COUNT(*), SUM(CAST(CONV(SUBSTRING(%s, 1, 15), '
+                      '16, 10) AS UNSIGNED)) FROM `%s`%s'
+                      % (my_hash, plan.table, my_where))
+    my_count, my_sum = mysql_cur.fetchone()
+    mysql_cur.close()
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute("SELECT count(*), sum(('x' || substr(%s, 1, 15))"
+                   "::bit(60)::bigint) FROM \"%s\".%s%s"
+                   % (pg_hash, plan.schema, plan.pg_table, pg_where))
+    pg_count, pg_sum = pg_cur.fetchone()
+    pg_cur.close()
+    return ((int(my_count), int(my_sum or 0)),
+            (int(pg_count), int(pg_sum or 0)))
+
+
+def row_checksums(mysql_conn, pg_conn, plan, lo, hi):
+    """(Connection, Connection, TablePlan, int, int):
+       ({int: str}, {int: str})
+
+    Return the checksum of each row with a key from lo to hi, by key,
+    on MySQL and on PostgreSQL.
+    """
+    my_hash, pg_hash = checksum_sql(plan)
+    pk = plan.primary_key.name
+    mysql_cur = mysql_conn.cursor()
+    mysql_cur.execute('SELECT `%s`, %s FROM `%s`%s' % (
+        pk, my_hash, plan.table, key_range_condition('`%s`' % pk, lo, hi)))
+    my_rows = dict((int(key), h) for key, h in mysql_cur.fetchall())
+    mysql_cur.close()
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute('SELECT "%s", %s FROM "%s".%s%s' % (
+        pk, pg_hash, plan.schema, plan.pg_table,
+        key_range_condition('"%s"' % pk, lo, hi)))
+    pg_rows = dict((int(key), h) for key, h in pg_cur.fetchall())
+    pg_cur.close()
+    return my_rows, pg_rows
+
+
+def key_bounds(mysql_conn, pg_conn, plan, lo, hi):
+    """(Connection, Connection, TablePlan, int, int): (int, int)
+
+    Return the smallest and largest key from lo to hi on either server,
+    or (None, None) if there are none.
+    """
+    pk = plan.primary_key.name
+    bounds = []
+    mysql_cur = mysql_conn.cursor()
+    mysql_cur.execute('SELECT MIN(`%s`), MAX(`%s`) FROM `%s`%s' % (
+        pk, pk, plan.table, key_range_condition('`%s`' % pk, lo, hi)))
+    bounds.extend(mysql_cur.fetchone())
+    mysql_cur.close()
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute('SELECT min("%s"), max("%s") FROM "%s".%s%s' % (
+        pk, pk, plan.schema, plan.pg_table,
+        key_range_condition('"%s"' % pk, lo, hi)))
+    bounds.extend(pg_cur.fetchone())
+    pg_cur.close()
+    bounds = [int(b) for b in bounds if b is not None]
+    if not bounds:
+        return None, None
+    return min(bounds), max(bounds)
+
+
+def verify_range(mysql_conn, pg_conn, plan, lo, hi, diffs):
+    """(Connection, Connection, TablePlan, int, int, {str: [int]})
+
+    Compare the rows with keys from lo to hi (None for an open end),
+    splitting a mismatching range in halves until it holds at most
+    VERIFY_ROWS rows, which are compared row by row.  The keys of rows
+    that are only in MySQL, only in PostgreSQL, or differ are added to
+    the 'missing', 'extra' and 'different' lists of 'diffs'; mismatches
+    in tables without an integer primary key are added to 'tables'.
+    """
+    (my_count, my_sum), (pg_count, pg_sum) = range_checksums(
+        mysql_conn, pg_conn, plan, lo, hi)
+    if (my_count, my_sum) == (pg_count, pg_sum):
+        return
+    if plan.primary_key is None:
+        logging.warning('Table %s differs: %i rows in MySQL, %i in '
+                        'PostgreSQL', plan.table, my_count, pg_count)
+        diffs['tables'].append(plan.table)
+        return
+    if lo is None or hi is None:
+        lo, hi = key_bounds(mysql_conn, pg_conn, plan, lo, hi)
+    if max(my_count, pg_count) > VERIFY_ROWS and lo < hi:
+        middle = lo + (hi - lo) // 2
+        verify_range(mysql_conn, pg_conn, plan, lo, middle, diffs)
+        verify_range(mysql_conn, pg_conn, plan, middle + 1, hi, diffs)
+        return
+    my_rows, pg_rows = row_checksums(mysql_conn, pg_conn, plan, lo, hi)
+    for key in sorted(set(my_rows) | set(pg_rows)):
+        if key not in pg_rows:
+            diffs['missing'].append(key)
+        elif key not in my_rows:
+            diffs['extra'].append(key)
+        elif my_rows[key] != pg_rows[key]:
+            diffs['different'].append(key)
+
+
+def verify_worker(args):
+    """((TablePlan, int, int)): (str, int, int, {str: [int]}, str)
+
+    Verify a key range of a table inside a pool process, using the
+    process's own pair of connections (see convert_table_worker()).
+    Returns (table, lo, hi, diffs, failure), where failure is None on
+    success or the error message.
+    """
+    plan, lo, hi = args
+    options = _worker['options']
+    mysql_host, mysql_db, pg_host, pg_db = _worker['db_args']
+    diffs = {'missing': [], 'extra': [], 'different': [], 'tables': []}
+    try:
+        if 'mysql_conn' not in _worker:
+            _worker['mysql_conn'] = connect_mysql(options, mysql_host,
+                                                  mysql_db)
+            _worker['pg_conn'] = connect_pg(options, pg_host, pg_db)
+        verify_range(_worker['mysql_conn'], _worker['pg_conn'], plan,
+                     lo, hi, diffs)
+        _worker['pg_conn'].rollback()
+    except Exception as err:
+        logging.error('Failure verifying table %s', plan.table,
+                      exc_info=True)
+        for name in ('mysql_conn', 'pg_conn'):
+            conn = _worker.pop(name, None)
+            try:
+                if conn is not None:
+                    conn.close()
+            except Exception:
+                pass
+        return plan.table, lo, hi, diffs, (str(err).strip() or
+                                           err.__class__.__name__)
+    return plan.table, lo, hi, diffs, None
+
+
+def verify_database(options, mysql_host, mysql_db, pg_host, pg_db):
+    """(Options, str, str, str, str): int
+
+    Compare the converted tables with MySQL.  Tables with an integer
+    primary key are split into key ranges of about --chunk-rows rows,
+    which are checksummed on both servers over options.jobs processes;
+    see verify_range().  The first and last ranges are open-ended so
+    rows past MySQL's keys are found too.  The differences are logged
+    and, with --report, written as JSON.  Returns the number of tables
+    that differ or could not be verified.
+    """
+    mysql_conn = connect_mysql(options, mysql_host, mysql_db)
+    mysql_cur = mysql_conn.cursor(cursorclass=DictCursor)
+    plans = read_plans(mysql_cur, mysql_db, options,
+                       options.pg_schema or 'public')
+    tasks = []
+    for plan in plans:
+        chunks = []
+        if plan.primary_key is not None:
+            chunks = primary_key_chunks(
+                mysql_cur, plan.table, plan.primary_key,
+                options.chunk_rows or VERIFY_CHUNK_ROWS)
+        if not chunks:
+            tasks.append((plan, None, None))
+            continue
+        chunks[0] = (None, chunks[0][1])
+        chunks[-1] = (chunks[-1][0], None)
+        tasks.extend((plan, lo, hi) for lo, hi in chunks)
+    mysql_cur.close()
+    mysql_conn.close()
+
+    tables = dict((plan.table, {'missing': [], 'extra': [], 'different': [],
+                                'chunks': 0, 'failures': []})
+                  for plan in plans)
+    pool = multiprocessing.Pool(options.jobs, init_worker,
+                                (options, (mysql_host, mysql_db,
+                                           pg_host, pg_db)))
+    try:
+        for table, lo, hi, diffs, failure in pool.imap_unordered(
+                verify_worker, tasks):
+            result = tables[table]
+            result['chunks'] += 1
+            if failure is not None:
+                result['failures'].append(failure)
+            if diffs['tables']:
+                result['failures'].append('rows differ')
+            for kind in ('missing', 'extra', 'different'):
+                result[kind].extend(diffs[kind])
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+    differing = 0
+    for table in sorted(tables):
+        result = tables[table]
+        counts = [len(result[kind])
+                  for kind in ('missing', 'extra', 'different')]
+        if sum(counts) or result['failures']:
+            differing += 1
+            logging.error('Table %s: %i rows missing, %i extra, %i '
+                          'different%s', table, counts[0], counts[1],
+                          counts[2], result['failures'] and
+                          ' (%s)' % '; '.join(result['failures']) or '')
+        else:
+            logging.info('Table %s matches', table)
+        for kind in ('missing', 'extra', 'different'):
+            result[kind + '_rows'] = len(result[kind])
+            result[kind] = sorted(result[kind])[:VERIFY_MAX_KEYS]
+    if options.report:
+        f = open(options.report, 'w')
+        try:
+            json.dump({'tables': tables, 'differing': differing}, f,
+                      indent=2, sort_keys=True)
+        finally:
+            f.close()
+    logging.info('Verified %i tables; %i differ', len(tables), differing)
+    return differing
+
+
+#
+# Replication: after a conversion run with --binlog, the replicate
+# command applies the changes MySQL has logged since, until cutover.
+#
+
+def check_binlog_settings(mysql_conn):
+    """(Connection): str
+
+    Return what keeps the MySQL server's binlog from being replicated,
+    or None if nothing does.  Replication needs binary logging with
+    binlog_format=ROW and, since the changes are applied as whole
+    rows, binlog_row_image=FULL (the only kind before MySQL 5.6).
+    """
+    mysql_cur = mysql_conn.cursor()
+    mysql_cur.execute("SHOW VARIABLES WHERE Variable_name IN "
+                      "('log_bin', 'binlog_format', 'binlog_row_image')")
+    settings = dict(mysql_cur.fetchall())
+    mysql_cur.close()
+    if settings.get('log_bin') != 'ON':
+        return 'binary logging is off'
+    if settings.get('binlog_format') != 'ROW':
+        return 'binlog_format is %s, not ROW' % settings.get('binlog_format')
+    if settings.get('binlog_row_image', 'FULL') != 'FULL':
+        return 'binlog_row_image is %s, not FULL' % (
+            settings['binlog_row_image'])
+    return None
+
+
+def read_binlog_position(mysql_conn):
+    """(Connection): (str, int)
+
+    Return the MySQL server's current binlog file and position, read
+    under a brief global read lock so that no transaction is half
+    written to the binlog.  Needs the RELOAD and REPLICATION CLIENT
+    privileges.
+    """
+    mysql_cur = mysql_conn.cursor()
+    mysql_cur.execute('FLUSH TABLES WITH READ LOCK')
+    try:
+        mysql_cur.execute('SHOW MASTER STATUS')
+        row = mysql_cur.fetchone()
+    finally:
+        mysql_cur.execute('UNLOCK TABLES')
+        mysql_cur.close()
+    return row and (row[0], int(row[1]))
+
+
+def create_binlog_table(pg_conn, options, schema):
+    """(Connection, Options, str)
+
+    Create the control table that records how far the binlog of each
+    MySQL source has been applied, unless it already exists.
+    """
+    pg_execute(pg_conn, options, '''
+        CREATE TABLE IF NOT EXISTS "%s".my2pg_binlog (
+            source text PRIMARY KEY,
+            log_file text NOT NULL,
+            log_pos bigint NOT NULL,
+            updated timestamp NOT NULL DEFAULT now()
+        )''' % schema)
+    pg_conn.commit()
+
+
+def read_recorded_position(pg_conn, options, schema, source):
+    """(Connection, Options, str, str): (str, int)
+
+    Return the binlog file and position recorded for a MySQL source,
+    or None if there isn't one.
+    """
+    if options.dry_run:
+        return None
+    pg_cur = pg_conn.cursor()
+    pg_cur.execute('SELECT log_file, log_pos FROM "%s".my2pg_binlog '
+                   'WHERE source = %%s' % schema, (source,))
+    row = pg_cur.fetchone()
+    pg_cur.close()
+    return row and (row[0], int(row[1]))
+
+
+def record_binlog_position(pg_conn, options, schema, source, position):
+    """(Connection, Options, str, str, (str, int))
+
+    Record the binlog file and position up to which the changes of a
+    MySQL source have been applied.
+    """
+    pg_execute(pg_conn, options,
+               'DELETE FROM "%s".my2pg_binlog WHERE source = %%s' % schema,
+               (source,))
+    pg_execute(pg_conn, options, '''
+        INSERT INTO "%s".my2pg_binlog (source, log_file, log_pos)
+        VALUES (%%s, %%s, %%s)''' % schema, (source,) + tuple(position))
 
-                sql = i.pg_decl(schema)
-                try:
-                    pg_execute(pg_conn, options, sql)
-                except Exception:
-                    logging.error('Failure creating index on table %s\n Statement: %s', table, sql,
-                                  exc_info=True)
 
-            pg_conn.commit()
+class BinlogEvent(object):
+    """
+    A binlog event, as MySQLBinlog and RecordedBinlog return them.
+
+    Instance attributes:
+    kind : str
+    table : str
+    rows : [{str: any}]
+    log_file : str
+    log_pos : int
+    timestamp : int
+
+    'kind' is 'insert', 'update' or 'delete' for row events, 'commit'
+    for the end of a transaction, or 'heartbeat' when the server has
+    nothing more to send for now.  'rows' holds the rows of a row
+    event as dictionaries of column values, or for updates as (before,
+    after) pairs of them.  log_file and log_pos are the position after
+    the event, and 'timestamp' when it was logged, in seconds since
+    the epoch.
+    """
+
+    table = None
+    rows = ()
+    timestamp = None
+
+    def __init__(self, **kw):
+        for k, v in kw.items():
+            setattr(self, k, v)
+
+
+def binlog_event(event, log_file, log_pos):
+    """(BinLogEvent, str, int): BinlogEvent
+
+    Return a python-mysql-replication event, read up to the given
+    position, as a BinlogEvent, or None if it doesn't matter here.
+    Transactions end with an XID event, and changes to
+    non-transactional tables such as MyISAM ones with a COMMIT query.
+    """
+    name = type(event).__name__
+    if name == 'HeartbeatLogEvent':
+        return BinlogEvent(kind='heartbeat', log_file=log_file,
+                           log_pos=log_pos)
+    kw = dict(log_file=log_file, log_pos=log_pos, timestamp=event.timestamp)
+    if name == 'XidEvent' or (name == 'QueryEvent' and
+                              event.query.strip().upper() == 'COMMIT'):
+        return BinlogEvent(kind='commit', **kw)
+    if name == 'UpdateRowsEvent':
+        return BinlogEvent(kind='update', table=event.table,
+                           rows=[(row['before_values'], row['after_values'])
+                                 for row in event.rows], **kw)
+    kind = {'WriteRowsEvent': 'insert',
+            'DeleteRowsEvent': 'delete'}.get(name)
+    if kind is None:
+        return None
+    return BinlogEvent(kind=kind, table=event.table,
+                       rows=[row['values'] for row in event.rows], **kw)
+
+
+class MySQLBinlog(object):
+    """
+    Reads the row events of a database from a MySQL server's binlog,
+    acting as a replica with the given server ID, with
+    python-mysql-replication.  The server needs the settings
+    check_binlog_settings() asks for, and the user the REPLICATION
+    SLAVE privilege.  Schema changes are not read.
+
+    Instance attributes:
+    settings : {str: str}
+    db : str
+    server_id : int
+    heartbeat : float
+
+    """
+
+    def __init__(self, options, host, db):
+        self.settings = {'host': host, 'user': options.mysql_user,
+                         'passwd': options.mysql_password}
+        self.db = db
+        self.server_id = options.server_id
+        self.heartbeat = options.commit_seconds
+
+    def events(self, log_file, log_pos, blocking=True):
+        """(str, int, bool): iter
+
+        Yield the BinlogEvents after the position.  Unless blocking is
+        true, stop at the end of the binlog.
+        """
+        stream = BinLogStreamReader(
+            connection_settings=self.settings, server_id=self.server_id,
+            log_file=log_file, log_pos=log_pos, resume_stream=True,
+            blocking=blocking, only_schemas=[self.db],
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent,
+                         XidEvent, QueryEvent, HeartbeatLogEvent],
+            slave_heartbeat=blocking and self.heartbeat or None)
+        try:
+            for event in stream:
+                event = binlog_event(event, stream.log_file, stream.log_pos)
+                if event is not None:
+                    yield event
+        finally:
+            stream.close()
+
+
+class RecordedBinlog(object):
+    """
+    Stand-in for MySQLBinlog that replays a list of BinlogEvents, so
+    replication can be tested without a server.
+
+    Instance attributes:
+    recorded : [BinlogEvent]
+
+    """
+
+    def __init__(self, recorded):
+        self.recorded = recorded
+
+    def events(self, log_file, log_pos, blocking=True):
+        for event in self.recorded:
+            if (event.log_file, event.log_pos) > (log_file, log_pos):
+                yield event
+
+
+class BinlogApplier(object):
+    """
+    Collects the row changes of committed MySQL transactions and applies
+    them to the PostgreSQL tables in one transaction per batch.
+
+    Changes are kept per table and primary key, so a batch applies only
+    the last version of each row: a DELETE of the deleted keys, then
+    multi-row upserts of the rest.  Since the binlog holds whole rows,
+    applying changes the bulk copy already saw is harmless.  The rows
+    of the transaction being read are held back until its commit,
+    whose position is recorded with the batch that applies it.
+
+    Instance attributes:
+    plans : {str: TablePlan}
+    schema : str
+    source : str
+    changes : {str: {tuple: [any]}}
+    current : [(str, tuple, [any])]
+    pending : int
+    position : (str, int)
+    timestamp : int
+    lag : float
+    applied : int
+    errors : int
+
+    'changes' maps each table and key to the new row, or to None if the
+    row was deleted; 'pending' counts the row changes it stands for.
+    'position' and 'timestamp' are those of the last commit read, and
+    'lag' is how far behind MySQL the last batch applied was.
+    """
+
+    def __init__(self, plans, schema, source, position):
+        self.plans = {}
+        for plan in plans:
+            binlog_plan = plan.for_binlog()
+            if binlog_plan is None:
+                logging.warning('Table %s has no primary key; its changes '
+                                'will not be replicated', plan.table)
+                continue
+            self.plans[plan.table] = binlog_plan
+        self.schema = schema
+        self.source = source
+        self.changes = {}
+        self.current = []
+        self.pending = 0
+        self.position = position
+        self.timestamp = None
+        self.lag = None
+        self.applied = self.errors = 0
+
+    def row(self, plan, values):
+        row = plan.convert_row([values.get(c.name) for c in plan.columns])
+        return row, tuple(row[position] for position in plan.key_positions)
+
+    def add(self, event):
+        """(BinlogEvent)
+
+        Take in an event: the changes of a row event, or the end of the
+        transaction they belong to.
+        """
+        if event.kind == 'commit':
+            for table, key, row in self.current:
+                self.changes.setdefault(table, {})[key] = row
+            self.pending += len(self.current)
+            self.current = []
+            self.position = (event.log_file, event.log_pos)
+            self.timestamp = event.timestamp
+            return
+        plan = self.plans.get(event.table)
+        if plan is None:
+            return
+        for values in event.rows:
+            if event.kind == 'update':
+                before, values = values
+                old_row, old_key = self.row(plan, before)
+                row, key = self.row(plan, values)
+                if old_key != key:
+                    self.current.append((plan.table, old_key, None))
+                self.current.append((plan.table, key, row))
+            elif event.kind == 'delete':
+                row, key = self.row(plan, values)
+                self.current.append((plan.table, key, None))
+            else:
+                row, key = self.row(plan, values)
+                self.current.append((plan.table, key, row))
+
+    def flush(self, pg_conn, options, caught_up=False):
+        """(Connection, Options, bool)
+
+        Apply the changes of the committed transactions, record their
+        position and commit.  caught_up says there are no later
+        changes, so the lag is nil.
+        """
+        for table in sorted(self.changes):
+            plan = self.plans[table]
+            changes = self.changes[table]
+            deleted = [key for key, row in changes.items() if row is None]
+            for i in range(0, len(deleted), options.batch_size):
+                pg_execute(pg_conn, options, plan.delete_sql,
+                           (tuple(deleted[i:i + options.batch_size]),))
+            loaded, failed = batch_insert_rows(
+                pg_conn, options, plan,
+                [row for row in changes.values() if row is not None])
+            self.applied += len(deleted) + loaded
+            self.errors += failed
+        record_binlog_position(pg_conn, options, self.schema, self.source,
+                               self.position)
+        pg_conn.commit()
+        if caught_up:
+            self.lag = 0.0
+        elif self.timestamp is not None:
+            self.lag = max(time.time() - self.timestamp, 0)
+        logging.info('Applied %i changes up to %s:%i, %s behind MySQL',
+                     self.pending, self.position[0], self.position[1],
+                     self.lag is None and 'unknown' or
+                     '%.1fs' % self.lag)
+        self.changes = {}
+        self.pending = 0
+
+
+def write_replication_metrics(filename, applier):
+    """(str, BinlogApplier)
+
+    Atomically replace the metrics file with the replication counters.
+    """
+    lines = []
+    for name, type, help, value in (
+            ('replication_changes_total', 'counter',
+             'Row changes applied from the binlog.', applier.applied),
+            ('replication_errors_total', 'counter',
+             'Row changes that failed to apply.', applier.errors),
+            ('replication_lag_seconds', 'gauge',
+             'How far behind MySQL the last applied change was.',
+             applier.lag or 0),
+            ('last_update_seconds', 'gauge',
+             'Time of the last update of this file.', time.time())):
+        lines.append('# HELP my2pg_%s %s' % (name, help))
+        lines.append('# TYPE my2pg_%s %s' % (name, type))
+        lines.append('my2pg_%s %r' % (name, float(value)))
+    tmp = filename + '.tmp'
+    f = open(tmp, 'w')
+    try:
+        f.write('\n'.join(lines) + '\n')
+    finally:
+        f.close()
+    os.rename(tmp, filename)
+
+
+def apply_binlog(pg_conn, options, plans, binlog, source, position):
+    """(Connection, Options, [TablePlan], MySQLBinlog, str, (str, int)):
+    BinlogApplier
+
+    Apply the changes to the tables of the plans read from the binlog
+    after position, in batches of up to --commit-rows changes or
+    --commit-seconds, and whenever MySQL goes quiet.  With --catch-up,
+    stop at the end of the binlog; otherwise run until interrupted,
+    which discards the batch under way.  Returns the applier, with the
+    counters.
+    """
+    schema = plans and plans[0].schema or 'public'
+    applier = BinlogApplier(plans, schema, source, position)
+    started = time.time()
+    try:
+        for event in binlog.events(position[0], position[1],
+                                   not options.catch_up):
+            # MySQL sends a heartbeat when it has nothing more to send.
+            caught_up = event.kind == 'heartbeat' and not applier.current
+            if event.kind != 'heartbeat':
+                applier.add(event)
+            elif caught_up and not applier.pending:
+                applier.lag = 0.0
+            if applier.pending and (
+                    event.kind == 'heartbeat' or
+                    applier.pending >= options.commit_rows or
+                    time.time() - started >= options.commit_seconds):
+                applier.flush(pg_conn, options, caught_up)
+                started = time.time()
+                if options.metrics_file:
+                    write_replication_metrics(options.metrics_file, applier)
+    except KeyboardInterrupt:
+        # What wasn't committed is read again from the recorded
+        # position by the next run.
+        logging.info('Replication interrupted')
+        pg_conn.rollback()
+        return applier
+    # The end of the binlog, with --catch-up.
+    if applier.pending:
+        applier.flush(pg_conn, options, not applier.current)
+    if options.metrics_file:
+        write_replication_metrics(options.metrics_file, applier)
+    return applier
+
+
+def replicate_database(options, mysql_host, mysql_db, pg_host, pg_db):
+    """(Options, str, str, str, str): int
+
+    Apply the changes in MySQL's binlog since the position recorded by
+    a conversion run with --binlog, or by an earlier replicate run.
+    Returns the number of changes that failed to apply, or -1 if
+    replication couldn't start.
+    """
+    if BinLogStreamReader is None:
+        logging.error('replicate needs the python-mysql-replication '
+                      'package')
+        return -1
+    schema = options.pg_schema or 'public'
+    source = '%s/%s' % (mysql_host, mysql_db)
+    mysql_conn = connect_mysql(options, mysql_host, mysql_db)
+    problem = check_binlog_settings(mysql_conn)
+    if problem is not None:
+        logging.error('Cannot replicate %s: %s', source, problem)
+        mysql_conn.close()
+        return -1
+    mysql_cur = mysql_conn.cursor(cursorclass=DictCursor)
+    plans = read_plans(mysql_cur, mysql_db, options, schema)
+    mysql_cur.close()
+    mysql_conn.close()
+
+    pg_conn = connect_pg(options, pg_host, pg_db)
+    create_binlog_table(pg_conn, options, schema)
+    position = read_recorded_position(pg_conn, options, schema, source)
+    if position is None:
+        logging.error('No binlog position is recorded for %s; convert '
+                      'it with --binlog first', source)
+        pg_conn.close()
+        return -1
+    logging.info('Replicating %s from %s:%i', source, position[0],
+                 position[1])
+    applier = apply_binlog(pg_conn, options, plans,
+                           MySQLBinlog(options, mysql_host, mysql_db),
+                           source, position)
+    pg_conn.close()
+    logging.info('Applied %i changes (%i errors)', applier.applied,
+                 applier.errors)
+    return applier.errors
+
+
+def limit_memory(megabytes):
+    """(int)
+
+    Limit the address space of this process, and of the processes it
+    starts, to 'megabytes' MB.  Going over it raises MemoryError, which
+    fails the table being converted, rather than letting the system run
+    out of memory.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limit = megabytes << 20
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+    logging.info('Memory limited to %i MB per process', limit >> 20)
+
+
+def end_step(steps, name, start):
+    """([(str, float)], str, float)
+
+    Log the time taken by a step of the run that began at 'start', and
+    add it to 'steps'.
+    """
+    seconds = time.time() - start
+    logging.info('Step "%s" took %.1fs', name, seconds)
+    steps.append((name, seconds))
+
+
+# Seconds between rewrites of the --metrics-file, and between progress
+# messages.
+METRICS_INTERVAL = 5
+PROGRESS_INTERVAL = 30
+
+
+def percentage(part, whole):
+    """(int, int): str
+
+    Format part as a percentage of whole.  Until the part is whole it
+    is shown as at most 99%, since MySQL's row counts are estimates.
+    """
+    if part >= whole:
+        return part and '100%' or '0%'
+    return '%i%%' % min(part * 100 // whole, 99)
+
+
+class RunReport(object):
+    """
+    Collects the TableStats sent by report_progress() during a run, in
+    any process, through a queue drained by a thread of the main
+    process.  While the run goes on, the metrics file (if any) is
+    rewritten every METRICS_INTERVAL seconds in the Prometheus text
+    format, for node_exporter's textfile collector, and progress() is
+    logged every PROGRESS_INTERVAL seconds; write_json() writes the
+    final report.
+
+    Instance attributes:
+    metrics_file : str
+    expected_rows : {str: int}
+    parts : {(str, (int, int), int): TableStats}
+    index_times : {str: float}
+    started : float
+    queue : multiprocessing.Queue
+
+    """
+
+    def __init__(self, metrics_file=None, expected_rows=None):
+        self.metrics_file = metrics_file
+        self.expected_rows = expected_rows or {}
+        self.parts = {}
+        self.index_times = {}
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.queue = multiprocessing.Queue()
+        self.thread = None
+
+    def start(self):
+        """()
+
+        Start collecting the reports of this process and of the worker
+        processes started after it.
+        """
+        _progress['queue'] = self.queue
+        self.thread = threading.Thread(target=self.collect,
+                                       name='run report')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def collect(self):
+        written = logged = time.time()
+        for stats in iter(self.queue.get, None):
+            self.lock.acquire()
+            try:
+                self.parts[stats.table, stats.key_range,
+                           stats.shard] = stats
+            finally:
+                self.lock.release()
+            if self.metrics_file and time.time() - written > METRICS_INTERVAL:
+                self.write_metrics()
+                written = time.time()
+            if time.time() - logged > PROGRESS_INTERVAL:
+                logging.info('Progress: %s', self.progress())
+                logged = time.time()
+
+    def stop(self):
+        """()
+
+        Wait for the reports sent so far, and update the metrics file.
+        """
+        _progress['queue'] = None
+        self.queue.put(None)
+        self.thread.join()
+        if self.metrics_file:
+            self.write_metrics()
+
+    def tables(self):
+        """(): {str: TableStats}
+
+        Return the counters of each table, adding up its parts.
+        """
+        self.lock.acquire()
+        try:
+            parts = self.parts.values()
+        finally:
+            self.lock.release()
+        tables = {}
+        for part in parts:
+            stats = tables.get(part.table)
+            if stats is None:
+                stats = tables[part.table] = TableStats(part.table)
+                stats.started = part.started
+                stats.updated = part.updated
+                stats.done = True
+            stats.add(part)
+            stats.done = stats.done and part.done
+        for table, seconds in self.index_times.items():
+            if table in tables:
+                tables[table].index_time = seconds
+        return tables
+
+    def eta(self, now=None):
+        """(float): (int, int, float, float)
+
+        Return the rows loaded so far, the rows expected in all, the
+        rows loaded per second since the first table was started, and
+        the estimated seconds left at that rate (None until it is
+        known), as of 'now' (by default the current time).  A table
+        that is done is expected to have the rows it has; the others at
+        least as many as MySQL's estimate.
+        """
+        tables = self.tables()
+        rows = sum(t.rows for t in tables.values())
+        expected = 0
+        for name in set(tables) | set(self.expected_rows):
+            stats = tables.get(name)
+            if stats is None:
+                expected += self.expected_rows[name]
+            elif stats.done:
+                expected += stats.rows
+            else:
+                expected += max(stats.rows, self.expected_rows.get(name, 0))
+        if now is None:
+            now = time.time()
+        elapsed = tables and now - min(t.started for t in tables.values())
+        rate = elapsed and rows / elapsed or 0.0
+        seconds = None
+        if rate:
+            seconds = (expected - rows) / rate
+        return rows, expected, rate, seconds
+
+    def progress(self, now=None):
+        """(float): str
+
+        Describe the progress of the run as of 'now', as eta() does:
+        the share of the expected rows loaded, the rate, the time left,
+        and the share loaded of each table under way.
+        """
+        rows, expected, rate, seconds = self.eta(now)
+        text = '%i of ~%i rows (%s), %.0f rows/s, ETA %s' % (
+            rows, expected, percentage(rows, expected), rate,
+            seconds is None and 'unknown' or
+            datetime.timedelta(seconds=int(seconds)))
+        tables = self.tables()
+        loading = ['%s %s' % (name, percentage(
+            tables[name].rows, self.expected_rows.get(name, 0)))
+                   for name in sorted(tables) if not tables[name].done]
+        if loading:
+            text += '; loading ' + ', '.join(loading)
+        return text
+
+    def write_metrics(self):
+        """()
+
+        Atomically replace the metrics file with the current counters.
+        """
+        tables = self.tables()
+        lines = []
+
+        def metric(name, type, help, values):
+            lines.append('# HELP my2pg_%s %s' % (name, help))
+            lines.append('# TYPE my2pg_%s %s' % (name, type))
+            for labels, value in values:
+                lines.append('my2pg_%s{%s} %r' % (
+                    name, ','.join('%s="%s"' % label for label in labels),
+                    float(value)))
+
+        def per_table(func):
+            return [((('table', name),), func(tables[name]))
+                    for name in sorted(tables)]
+
+        metric('rows_total', 'counter', 'Rows loaded into PostgreSQL.',
+               per_table(lambda t: t.rows))
+        metric('errors_total', 'counter', 'Rows that failed to load.',
+               per_table(lambda t: t.errors))
+        metric('bytes_total', 'counter', 'Estimated bytes of rows loaded.',
+               per_table(lambda t: t.bytes))
+        metric('stage_seconds_total', 'counter',
+               'Seconds spent in each stage of loading a table.',
+               [((('table', name), ('stage', stage)),
+                 getattr(tables[name], stage + '_time'))
+                for name in sorted(tables)
+                for stage in ('fetch', 'convert', 'write', 'commit',
+                              'index')])
+        metric('rows_per_second', 'gauge',
+               'Average rows per second since the table was started.',
+               per_table(lambda t: t.as_dict()['rows_per_second']))
+        metric('rows_remaining', 'gauge',
+               "Rows still to load, going by MySQL's estimate.",
+               [((('table', name),),
+                 max(expected - (name in tables and tables[name].rows or 0),
+                     0))
+                for name, expected in sorted(self.expected_rows.items())])
+        metric('table_done', 'gauge', '1 once a table has been loaded.',
+               per_table(lambda t: t.done))
+        metric('eta_seconds', 'gauge',
+               'Estimated seconds until all the rows are loaded.',
+               [((), self.eta()[3] or 0)])
+        metric('process_peak_rss_bytes', 'gauge',
+               'Peak memory so far of the process loading a table, '
+               'including the tables it loaded before.',
+               per_table(lambda t: t.peak_rss))
+        metric('last_update_seconds', 'gauge',
+               'Time of the last update of this file.',
+               [((), time.time())])
+
+        tmp = self.metrics_file + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            f.write('\n'.join(lines) + '\n')
+        finally:
+            f.close()
+        os.rename(tmp, self.metrics_file)
+
+    def write_json(self, filename, failed, steps=()):
+        """(str, [(str, str)], [(str, float)])
+
+        Write the run report, with the counters of every table, the
+        (table, message) pairs of the tables that failed, and the
+        (name, seconds) pairs of the steps of the run, as JSON.
+        """
+        tables = self.tables()
+        finished = time.time()
+        report = {
+            'started': datetime.datetime.fromtimestamp(
+                self.started).isoformat(),
+            'finished': datetime.datetime.fromtimestamp(finished).isoformat(),
+            'elapsed': finished - self.started,
+            'rows': sum(t.rows for t in tables.values()),
+            'errors': sum(t.errors for t in tables.values()),
+            'bytes': sum(t.bytes for t in tables.values()),
+            'peak_rss': max([t.peak_rss for t in tables.values()] or [0]),
+            'failed': dict(failed),
+            'steps': [{'name': name, 'seconds': seconds}
+                      for name, seconds in steps],
+            'tables': dict((name, t.as_dict()) for name, t in tables.items()),
+        }
+        f = open(filename, 'w')
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+def check_options(parser, options, command):
+    """(OptionParser, Options, str)
+
+    Reject combinations of options that can't work together, and set
+    the options others imply.
+    """
+    if options.resume:
+        options.checkpoint = True
+    if options.resume and options.drop_tables:
+        # The finished tables would be emptied and then skipped.
+        parser.error('--resume cannot be used with --drop-tables')
+    if options.incremental and options.checkpoint:
+        parser.error('--incremental cannot be used with --checkpoint '
+                     'or --resume')
+    if options.swap and (options.incremental or options.checkpoint or
+                         options.data_only):
+        parser.error('--swap cannot be used with --incremental, '
+                     '--checkpoint, --resume or --data-only')
+    if options.swap:
+        # The shadow tables get their indexes once they are loaded.
+        options.defer_indexes = True
+    if options.shards and (command or options.incremental or
+                           options.checkpoint or options.binlog):
+        parser.error('--shard cannot be used with dump, load, verify, '
+                     'replicate, --incremental, --checkpoint, --resume or '
+                     '--binlog')
+    if options.shard_column and not options.shards:
+        parser.error('--shard-column needs --shard')
+
+
+def main():
+    parser = optparse.OptionParser(
+        '%prog [options] mysql-host mysql-db pg-host pg-db\n'
+        '       %prog dump [options] mysql-host mysql-db directory\n'
+        '       %prog load [options] directory pg-host pg-db\n'
+        '       %prog verify [options] mysql-host mysql-db pg-host pg-db\n'
+        '       %prog replicate [options] mysql-host mysql-db pg-host pg-db')
+    parser.add_option('--data-only',
+                      action="store_true", default=False,
+                      dest="data_only",
+                      help="Assume the tables already exist, and only convert data")
+    parser.add_option('--drop-tables',
+                      action="store_true", default=False,
+                      dest="drop_tables",
+                      help="Drop existing PostgreSQL tables (if any) before creating")
+    parser.add_option('-n', '--dry-run',
+                      action="store_true", default=False,
+                      dest="dry_run",
+                      help="Make no changes to PostgreSQL database")
+    parser.add_option('--mysql-user',
+                      action="store",
+                      dest="mysql_user",
+                      help="User for login if not current user.")
+    parser.add_option('--mysql-password',
+                      action="store",
+                      dest="mysql_password",
+                      help="Password to use when connecting to server.")
+    parser.add_option('--pg-user',
+                      action="store",
+                      dest="pg_user",
+                      help="User for login if not current user.")
+    parser.add_option('--pg-schema',
+                      action="store",
+                      dest="pg_schema",
+                      help="PostgreSQL database target schema (if not public).")
+    parser.add_option('--pg-password',
+                      action="store", default='',
+                      dest="pg_password",
+                      help="Password to use when connecting to server.")
+    parser.add_option('--pickle=',
+                      action="store", default='',
+                      dest="pickle",
+                      help="File for storing a pickled version of the MySQL table structure; "
+                      "it is reused for tables whose structure hasn't changed.")
+    parser.add_option('--starting-table',
+                      action="store", default=None,
+                      dest="starting_table",
+                      help="Name of table to start conversion with")
+    parser.add_option('--loader',
+                      action="store", default='insert',
+                      type="choice", choices=sorted(LOADERS),
+                      dest="loader",
+                      help="How to load data rows: 'insert' (one INSERT per "
+                      "row, the default), 'batch' (multi-row INSERTs), "
+                      "'copy' (COPY FROM STDIN) or 'binary' (binary COPY "
+                      "where the column types allow)")
+    parser.add_option('--batch-size',
+                      action="store", default=1000, type="int",
+                      dest="batch_size",
+                      help="Number of rows per INSERT with --loader=batch")
+    parser.add_option('--fetch-rows',
+                      action="store", default=1000, type="int",
+                      dest="fetch_rows",
+                      help="Number of rows to fetch from MySQL at a time")
+    parser.add_option('--queue-rows',
+                      action="store", default=50000, type="int",
+                      dest="queue_rows",
+                      help="Maximum number of rows read ahead of PostgreSQL")
+    parser.add_option('--queue-mb',
+                      action="store", default=64, type="int",
+                      dest="queue_mb",
+                      help="Maximum size in MB of the rows read ahead of "
+                      "PostgreSQL")
+    parser.add_option('--commit-rows',
+                      action="store", default=1000000, type="int",
+                      dest="commit_rows",
+                      help="Maximum number of rows per transaction")
+    parser.add_option('--commit-mb',
+                      action="store", default=64, type="int",
+                      dest="commit_mb",
+                      help="Size in MB of the rows after which a "
+                      "transaction is committed")
+    parser.add_option('--commit-seconds',
+                      action="store", default=10.0, type="float",
+                      dest="commit_seconds",
+                      help="Time in seconds after which a transaction "
+                      "is committed")
+    parser.add_option('--max-memory-mb',
+                      action="store", default=0, type="int",
+                      dest="max_memory_mb",
+                      help="Limit the address space of each process to "
+                      "this many MB, so a table that needs more fails "
+                      "instead of the whole run")
+    parser.add_option('--segment-mb',
+                      action="store", default=256, type="int",
+                      dest="segment_mb",
+                      help="Size in MB of uncompressed COPY data per file "
+                      "written by 'dump'")
+    parser.add_option('--compress-level',
+                      action="store", default=6, type="int",
+                      dest="compress_level",
+                      help="gzip compression level (1-9) of the files "
+                      "written by 'dump'")
+    parser.add_option('--table-order',
+                      action="store", default="size",
+                      type="choice", choices=['name', 'size'],
+                      dest="table_order",
+                      help="Order to convert tables in: 'size' (largest "
+                      "first, the default) or 'name'")
+    parser.add_option('--report',
+                      action="store", default=None,
+                      dest="report",
+                      help="File to write a JSON report of the run to")
+    parser.add_option('--metrics-file',
+                      action="store", default=None,
+                      dest="metrics_file",
+                      help="Prometheus textfile to update with progress "
+                      "metrics during the run")
+    parser.add_option('--reject-file',
+                      action="store", default=None,
+                      dest="reject_file",
+                      help="File to append rows that fail to load to")
+    parser.add_option('-j', '--jobs',
+                      action="store", default=1, type="int",
+                      dest="jobs",
+                      help="Number of tables to convert concurrently")
+    parser.add_option('--shard',
+                      action="append", default=[],
+                      dest="shards",
+                      help="Another MySQL source, 'host' or 'host/database', "
+                      "with the same tables, to load into the same "
+                      "PostgreSQL tables at the same time; repeat for each "
+                      "shard")
+    parser.add_option('--shard-column',
+                      action="store", default=None,
+                      dest="shard_column",
+                      help="With --shard, add an integer column of this name "
+                      "holding the number of each row's source (1 for "
+                      "mysql-host, then the --shard ones in order) to the "
+                      "tables and their primary keys")
+    parser.add_option('--chunk-rows',
+                      action="store", default=0, type="int",
+                      dest="chunk_rows",
+                      help="With --jobs, split tables with an integer primary "
+                      "key into ranges of about this many rows that are "
+                      "converted concurrently")
+    parser.add_option('--defer-indexes',
+                      action="store_true", default=False,
+                      dest="defer_indexes",
+                      help="Create primary keys and indexes after loading "
+                      "the data, then ANALYZE the tables")
+    parser.add_option('--unique-indexes',
+                      action="store_true", default=False,
+                      dest="unique_indexes",
+                      help="Create MySQL's unique indexes as unique indexes "
+                      "(by default they are created as plain indexes)")
+    parser.add_option('--fast-load',
+                      action="store_true", default=False,
+                      dest="fast_load",
+                      help="Create tables UNLOGGED and load them with "
+                      "synchronous_commit off, then switch them to LOGGED "
+                      "and ANALYZE them (needs PostgreSQL 9.5)")
+    parser.add_option('--work-mem',
+                      action="store", default='256MB',
+                      dest="work_mem",
+                      help="work_mem setting for --fast-load sessions "
+                      "(default %default)")
+    parser.add_option('--swap',
+                      action="store_true", default=False,
+                      dest="swap",
+                      help="Load each table into a shadow table, index it, "
+                      "and then swap it in place of the existing table")
+    parser.add_option('--index-jobs',
+                      action="store", default=0, type="int",
+                      dest="index_jobs",
+                      help="Number of indexes to build concurrently with "
+                      "--defer-indexes (default: the --jobs value)")
+    parser.add_option('--maintenance-work-mem',
+                      action="store", default=None,
+                      dest="maintenance_work_mem",
+                      help="maintenance_work_mem setting for index builds, "
+                      "e.g. 1GB")
+    parser.add_option('--checkpoint',
+                      action="store_true", default=False,
+                      dest="checkpoint",
+                      help="Record progress in a my2pg_progress table in the "
+                      "target schema with every commit")
+    parser.add_option('--resume',
+                      action="store_true", default=False,
+                      dest="resume",
+                      help="Continue an interrupted --checkpoint run, skipping "
+                      "finished tables and resuming from the last committed "
+                      "primary key, in the tables it created (implies "
+                      "--checkpoint)")
+    parser.add_option('--incremental',
+                      action="store_true", default=False,
+                      dest="incremental",
+                      help="Only convert rows added or changed since the "
+                      "last --incremental run, and upsert them by primary "
+                      "key (needs PostgreSQL 9.5)")
+    parser.add_option('--updated-column',
+                      action="store", default=None,
+                      dest="updated_column",
+                      help="Name of a timestamp column that shows when rows "
+                      "were last changed, for --incremental")
+    parser.add_option('--binlog',
+                      action="store_true", default=False,
+                      dest="binlog",
+                      help="Record the MySQL binlog position before "
+                      "converting data, for the replicate command to "
+                      "continue from")
+    parser.add_option('--server-id',
+                      action="store", default=4242, type="int",
+                      dest="server_id",
+                      help="Replica server ID for replicate to read the "
+                      "binlog with (default 4242); it must differ from "
+                      "those of the MySQL servers")
+    parser.add_option('--catch-up',
+                      action="store_true", default=False,
+                      dest="catch_up",
+                      help="Make replicate stop at the end of the binlog "
+                      "instead of waiting for more changes")
+    parser.add_option('--date-conversion',
+                      action="store", default='server',
+                      type="choice", choices=['server', 'client'],
+                      dest="date_conversion",
+                      help="Where to replace MySQL zero dates: 'server' "
+                      "(in the SELECT, the default) or 'client' (in Python, "
+                      "keeping the MySQL server's load down)")
+    parser.add_option('--geometry',
+                      action="store", default='wkt',
+                      type="choice", choices=['wkt', 'wkb'],
+                      dest="geometry",
+                      help="How to transfer geometry values: 'wkt' (text, "
+                      "the default) or 'wkb' (MySQL's binary format, loaded "
+                      "as EWKB; needs MySQL 5.6)")
+    parser.add_option('-v', '--verbose',
+                      action="count", default=0,
+                      dest="verbose",
+                      help="Display more output as the script runs")
+
+    options, args = parser.parse_args()
+    command = None
+    if args and args[0] in ('dump', 'load', 'verify', 'replicate'):
+        command = args.pop(0)
+    if len(args) != (command in ('dump', 'load') and 3 or 4):
+        parser.print_help()
+        sys.exit(1)
+    check_options(parser, options, command)
+
+    # Set logging level.
+    if options.verbose:
+        logging.basicConfig(level=logging.INFO)
+        if options.verbose > 1:
+            logging.basicConfig(level=logging.DEBUG)
+    if options.max_memory_mb:
+        limit_memory(options.max_memory_mb)
+
+    if command == 'dump':
+        mysql_host, mysql_db, directory = args
+        if dump_database(options, mysql_host, mysql_db, directory):
+            sys.exit(1)
+        return
+    elif command == 'load':
+        directory, pg_host, pg_db = args
+        if load_dump(options, directory, pg_host, pg_db):
+            sys.exit(1)
+        return
+    elif command == 'verify':
+        if verify_database(options, *args):
+            sys.exit(1)
+        return
+    elif command == 'replicate':
+        if replicate_database(options, *args):
+            sys.exit(1)
+        return
+
+    mysql_host, mysql_db, pg_host, pg_db = args
+
+    # Set up connections
+    logging.info('Connecting to databases')
+
+    mysql_conn = connect_mysql(options, mysql_host, mysql_db)
+    pg_conn = connect_pg(options, pg_host, pg_db)
+    mysql_cur = mysql_conn.cursor(cursorclass=DictCursor)
+
+    # Schema
+    if not options.pg_schema:
+        schema = "public"
+    else:
+        schema = options.pg_schema
+
+    # Make list of tables to process.
+    plans = read_plans(mysql_cur, mysql_db, options, schema)
+    sizes = read_table_sizes(mysql_cur, mysql_db)
+    for plan in plans:
+        plan.data_length, plan.avg_row_length = sizes.get(plan.table, (0, 0))
+    if options.table_order == 'size':
+        plans = order_by_size(plans)
+
+    # The MySQL sources: the one given by the arguments, then any shards.
+    sources = [(mysql_host, mysql_db)]
+    sources.extend(parse_shard(shard, mysql_db) for shard in options.shards)
+    if len(sources) > 1:
+        estimates = check_shards(options, mysql_cur, sources, plans)
+        if estimates is None:
+            logging.error('The shards have different structures')
+            sys.exit(1)
+    else:
+        estimates = read_table_estimates(mysql_cur, mysql_db)
+
+    source_plans = plans
+    if options.shard_column:
+        for plan in plans:
+            if options.shard_column in [c.name for c in plan.columns]:
+                logging.error('Table %s already has a column %s',
+                              plan.table, options.shard_column)
+                sys.exit(1)
+        plans = [plan.for_shard(options.shard_column, 1) for plan in plans]
+    live_plans = plans
+    if options.swap:
+        plans = [plan.for_shadow() for plan in plans]
+
+    report = RunReport(options.metrics_file,
+                       dict((plan.table, estimates.get(plan.table, 0))
+                            for plan in plans))
+    report.start()
+    steps = []
+    if options.fast_load:
+        logging.info('Fast load: UNLOGGED tables, synchronous_commit off, '
+                     'work_mem %s', options.work_mem)
+
+    #
+    # Convert the table structure.  A resumed run's tables already
+    # exist.
+    #
+    if not options.data_only and not options.resume:
+        start = time.time()
+        create_tables(pg_conn, options, plans)
+        end_step(steps, 'create tables', start)
 
     #
     # Convert data.
     #
 
-    mysql_cur.close()
-    mysql_cur = mysql_conn.cursor(cursorclass=SSCursor)
+    if options.binlog:
+        # Changes logged from here on are applied by replicate; those the
+        # conversion sees as well are applied again, harmlessly.
+        problem = check_binlog_settings(mysql_conn)
+        if problem is not None:
+            logging.error('--binlog cannot be used: %s', problem)
+            sys.exit(1)
+        source = '%s/%s' % (mysql_host, mysql_db)
+        create_binlog_table(pg_conn, options, schema)
+        position = None
+        if options.resume:
+            # The tables finished before were copied from the first
+            # run's position, so replication has to start there.
+            position = read_recorded_position(pg_conn, options, schema,
+                                              source)
+        if position is None:
+            if options.resume:
+                logging.warning('The interrupted run recorded no binlog '
+                                'position; later changes to the tables it '
+                                'finished will not be replicated')
+            position = read_binlog_position(mysql_conn)
+            record_binlog_position(pg_conn, options, schema, source,
+                                   position)
+            pg_conn.commit()
+            logging.info('Recorded binlog position %s:%i', *position)
+        else:
+            logging.info('Keeping binlog position %s:%i', *position)
 
     logging.info('Converting data')
-    for table in tables:
-        # Convert data.
-        logging.info('Converting data in table %s', table)
-        pg_table = fix_reserved_word(table)
-        cols = table_cols[table]
+    start = time.time()
+    progress = {}
+    if options.checkpoint:
+        create_checkpoint_table(pg_conn, options, schema)
+        if options.resume:
+            progress = read_checkpoints(pg_conn, schema)
 
-        # Assemble the INSERT statement once.
-        ins_sql = ('INSERT INTO "%s".%s (%s) VALUES (%s);' %
-                   (schema, pg_table,
-                    ', '.join('"%s"' % c.name for c in cols),
-                    ','.join(['%s'] * len(cols))))
+    if options.incremental:
+        create_sync_table(pg_conn, options, schema)
+        if not options.data_only:
+            # The tables were just created, so load them in full.
+            pg_execute(pg_conn, options,
+                       'DELETE FROM "%s".my2pg_sync' % schema)
+            pg_conn.commit()
 
-        # Ensure the table is empty.
-        pg_execute(pg_conn, options, 'DELETE FROM "%s".%s' % (schema, pg_table))
+    if len(sources) > 1:
+        mysql_cur.close()
+        mysql_conn.close()
+        results = convert_shards(options, pg_conn, (pg_host, pg_db), sources,
+                                 source_plans)
+    else:
+        # Work out how each table will be converted: in key range chunks,
+        # (plan, chunks, resume), or whole, (plan, resume).
+        chunked = []
+        whole = []
+        for plan in plans:
+            state = progress.get(plan.table)
+            if state and all(done for _, _, _, _, done in state):
+                logging.info('Table %s was already converted', plan.table)
+                continue
+            if state and plan.primary_key is not None:
+                ranges = [(lo, hi, last_key, row_count)
+                          for lo, hi, last_key, row_count, done in state
+                          if lo is not None and not done]
+                if ranges:
+                    chunked.append((plan, ranges, True))
+                    continue
+                lo, hi, last_key, row_count, done = state[0]
+                if last_key is not None:
+                    whole.append((plan, (last_key, row_count)))
+                    continue
 
-        mysql_cur.execute("SELECT %s FROM %s" % (', '.join(convert_column_data(c) for c in cols), table))
+            chunks = []
+            if (options.jobs > 1 and options.chunk_rows and
+                plan.primary_key is not None and not options.incremental):
+                chunks = primary_key_chunks(mysql_cur, plan.table,
+                                            plan.primary_key,
+                                            options.chunk_rows)
+            if len(chunks) > 1:
+                chunked.append((plan, [(first, last, None, 0)
+                                       for first, last in chunks], False))
+            else:
+                whole.append((plan, None))
+        mysql_cur.close()
 
-        # We don't do a fetchall() since the table contents are
-        # very likely to not fit into memory.
-        row_count = 0
-        errors = 0
+        db_args = (mysql_host, mysql_db, pg_host, pg_db)
+        results = []
+        for plan, chunks, resume in chunked:
+            results.append(convert_table_chunked(mysql_conn, pg_conn,
+                                                 options, db_args, plan,
+                                                 chunks, resume))
+        mysql_conn.close()
+        if options.jobs > 1:
+            results.extend(convert_tables_parallel(options, db_args, whole))
+        else:
+            results.extend(convert_tables_serial(options, db_args, whole))
 
-        while True:
-            row = mysql_cur.fetchone()
-            if row is None:
-                break
+    failed = [(table, failure) for table, _, _, failure in results
+              if failure is not None]
+    logging.info("Converted %i rows in %i tables (%i errors)",
+                 sum(r[1] for r in results), len(results) - len(failed),
+                 sum(r[2] for r in results))
+    for table, failure in sorted(failed):
+        logging.error("Table %s was not converted: %s", table, failure)
+    end_step(steps, 'convert data', start)
 
-            # Assemble a list of the output data that we'll subsequently
-            # convert to a tuple.
-            output_L = map(lambda x: convert_data(x.type, row[x.index]), cols)
+    # A table left UNLOGGED or without its indexes fails the run too,
+    # and isn't swapped in.
+    step_failed = set()
+    if options.fast_load and not options.data_only:
+        start = time.time()
+        step_failed |= set_tables_logged(options, (pg_host, pg_db), plans)
+        end_step(steps, 'set tables logged', start)
+    if options.defer_indexes and not options.data_only:
+        start = time.time()
+        step_failed |= build_indexes(options, (pg_host, pg_db), plans,
+                                     report.index_times)
+        end_step(steps, 'build indexes', start)
+    elif options.fast_load:
+        start = time.time()
+        step_failed |= analyze_tables(options, (pg_host, pg_db), plans)
+        end_step(steps, 'analyze tables', start)
 
-            try:
-                pg_execute(pg_conn, options, ins_sql, output_L)
-            except InternalError, KeyboardInterrupt:
-                raise
-            except:
-                logging.error('Failure inserting row into table %s', table,
-                              exc_info=True)
-                errors += 1
-            else:
-                row_count += 1
-                if (row_count % COMMIT_AFTER_ROWS) == 0:
-                    logging.info('Committing transaction after %i rows', row_count)
-                    pg_conn.commit()
+    if options.swap:
+        start = time.time()
+        skipped = dict.fromkeys(step_failed,
+                                'it could not be made LOGGED or indexed')
+        skipped.update((table, 'it was not fully converted')
+                       for table, failure in failed)
+        swap_tables(pg_conn, options, plans, skipped)
+        end_step(steps, 'swap tables', start)
 
-        logging.info("Table %s: %i rows converted (%i errors)",
-                     table, row_count, errors)
-        pg_conn.commit()
+    # AUTO_INCREMENT is read after the data, so it is past every key
+    # that was converted.  With shards, the sequences continue from the
+    # highest value of any of them.
+    start = time.time()
+    auto_increments = {}
+    for host, db in sources:
+        mysql_conn = connect_mysql(options, host, db)
+        mysql_cur = mysql_conn.cursor(cursorclass=DictCursor)
+        for table, value in read_auto_increments(mysql_cur, db).items():
+            auto_increments[table] = max(value,
+                                         auto_increments.get(table, 0))
+        mysql_conn.close()
+    reset_sequences(pg_conn, options, live_plans, auto_increments)
+    end_step(steps, 'reset sequences', start)
 
-    # Update sequences to their table max values
-    pg_execute(pg_conn, options, '''
-        CREATE OR REPLACE FUNCTION sequence_max_value(oid) RETURNS bigint
-        VOLATILE STRICT LANGUAGE plpgsql AS  $$
-        DECLARE
-         tabrelid oid;
-         colname name;
-         r record;
-         newmax bigint;
-        BEGIN
-         FOR tabrelid, colname IN SELECT attrelid, attname
-                       FROM pg_attribute
-                      WHERE (attrelid, attnum) IN (
-                              SELECT adrelid::regclass,adnum
-                                FROM pg_attrdef
-                               WHERE oid IN (SELECT objid
-                                               FROM pg_depend
-                                              WHERE refobjid = $1
-                                                    AND classid = 'pg_attrdef'::regclass
-                                            )
-                  ) LOOP
-              FOR r IN EXECUTE 'SELECT max(' || quote_ident(colname) || ') FROM ' || tabrelid::regclass LOOP
-                  IF newmax IS NULL OR r.max > newmax THEN
-                      newmax := r.max;
-                  END IF;
-              END LOOP;
-          END LOOP;
-          RETURN newmax;
-        END; $$ ;
-    ''')
-    pg_execute(pg_conn, options, '''
-        SELECT relname, setval(oid, sequence_max_value(oid))
-        FROM pg_class
-        WHERE relkind = 'S';
-    ''')
+    report.stop()
+    if options.report:
+        report.write_json(options.report, failed, steps)
 
     # Close connections
     logging.info('Closing database connections')
-    mysql_conn.close()
     pg_conn.close()
 
+    if failed or step_failed:
+        sys.exit(1)
+
 
 if __name__ == '__main__':
     main()
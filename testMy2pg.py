@@ -1,5 +1,23 @@
 #!/usr/bin/env python
 import unittest
+import binascii
+import datetime
+import gzip
+import hashlib
+import itertools
+import json
+import optparse
+import os
+import re
+import shutil
+import signal
+import struct
+import pickle
+import StringIO
+import tempfile
+import time
+
+import psycopg2
 import my2pg
 
 
@@ -24,5 +42,1731 @@ class TypeConversionTestCase(unittest.TestCase):
         self.assertEqual(my2pg.convert_type('tinytext'), 'text')
 
 
+def make_column(name, type, **kw):
+    attrs = dict(name=name, type=type, default=None, is_nullable=True,
+                 auto_increment=False)
+    attrs.update(kw)
+    return my2pg.Column(**attrs)
+
+
+class TablePlanTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cols = [make_column('id', 'int(11)', is_nullable=False,
+                                 auto_increment=True),
+                     make_column('data', 'blob'),
+                     make_column('location', 'point')]
+        self.indexes = [my2pg.Index(name='PRIMARY', table='t',
+                                    column_names=['id'])]
+
+    def test_identity_rows(self):
+        plan = my2pg.TablePlan('public', 't', self.cols[:1], self.indexes)
+        self.assertEqual(plan.converters, ())
+        row = (1,)
+        self.assertTrue(plan.convert_row(row) is row)
+
+    def test_converted_rows(self):
+        plan = my2pg.TablePlan('public', 't', self.cols, self.indexes)
+        self.assertEqual([pos for pos, f in plan.converters], [1, 2])
+        row = plan.convert_row((1, 'A', 'POINT(1 2)'))
+        self.assertEqual(row[0], 1)
+        self.assertEqual(row[1].adapted, 'A')
+        self.assertEqual(row[2].text, 'POINT(1 2)')
+
+    def test_sql(self):
+        plan = my2pg.TablePlan('public', 'user', self.cols, self.indexes)
+        self.assertEqual(plan.select_sql,
+                         'SELECT `id`, `data`, asText(location) as `location` '
+                         'FROM user')
+        self.assertEqual(plan.copy_sql, 'COPY "public"."user" '
+                         '("id", "data", "location") FROM STDIN')
+        self.assertTrue('PRIMARY KEY ("id")' in plan.create_sql)
+        plan = my2pg.TablePlan('public', 'user', self.cols, self.indexes,
+                               wkb_geometry=True)
+        self.assertEqual(plan.select_sql,
+                         'SELECT `id`, `data`, `location` FROM user')
+        self.assertTrue(plan.converters[1][1] is my2pg.convert_geometry)
+
+    def test_deferred_indexes(self):
+        indexes = self.indexes + [
+            my2pg.Index(name='id_copy', table='t', type='BTREE',
+                        column_names=['id'], non_unique=False),
+            my2pg.Index(name='data_idx', table='t', type='BTREE',
+                        column_names=['data'], non_unique=True),
+            my2pg.Index(name='data_uniq', table='t', type='BTREE',
+                        column_names=['data'], non_unique=False)]
+        self.assertEqual([i.name for i in my2pg.distinct_indexes(indexes)],
+                         ['PRIMARY', 'data_uniq'])
+        plan = my2pg.TablePlan('public', 't', self.cols, indexes)
+        self.assertFalse('PRIMARY KEY' in plan.bare_create_sql)
+        self.assertEqual(plan.primary_key_sql,
+                         'ALTER TABLE "public".t ADD PRIMARY KEY ("id")')
+        self.assertEqual(plan.index_sql,
+                         ['CREATE INDEX data_uniq ON "public"."t" ("data")'])
+        plan = my2pg.TablePlan('public', 't', self.cols, indexes,
+                               unique_indexes=True)
+        self.assertEqual(plan.index_sql,
+                         ['CREATE UNIQUE INDEX data_uniq '
+                          'ON "public"."t" ("data")'])
+        self.assertEqual(plan.for_shadow().index_sql,
+                         ['CREATE UNIQUE INDEX my2pg_new_data_uniq '
+                          'ON "public"."my2pg_new_t" ("data")'])
+        # Without its unique twin, the non-unique index is kept.
+        plan = my2pg.TablePlan('public', 't', self.cols, indexes[:-1])
+        self.assertEqual(plan.index_sql,
+                         ['CREATE INDEX data_idx ON "public"."t" ("data")'])
+
+    def test_upsert(self):
+        plan = my2pg.TablePlan('public', 't', self.cols[:2], self.indexes)
+        upsert = plan.for_upsert()
+        conflict = ' ON CONFLICT ("id") DO UPDATE SET "data" = EXCLUDED."data"'
+        self.assertEqual(upsert.insert_sql, 'INSERT INTO "public".t '
+                         '("id", "data") VALUES (%s,%s)' + conflict + ';')
+        self.assertEqual(upsert.copy_sql, 'COPY "my2pg_stage_t" '
+                         '("id", "data") FROM STDIN')
+        self.assertEqual(upsert.merge_sql,
+                         'WITH staged AS (DELETE FROM "my2pg_stage_t" '
+                         'RETURNING *) INSERT INTO "public".t '
+                         '("id", "data") SELECT "id", "data" '
+                         'FROM staged' + conflict)
+        # The original plan is unchanged.
+        self.assertEqual(plan.conflict_sql, '')
+        self.assertEqual(plan.merge_sql, None)
+        key_only = my2pg.TablePlan('public', 't', self.cols[:1],
+                                   self.indexes).for_upsert()
+        self.assertEqual(key_only.conflict_sql, ' ON CONFLICT ("id") DO NOTHING')
+
+    def test_pickle(self):
+        plan = my2pg.TablePlan('public', 't', self.cols, self.indexes)
+        copy = pickle.loads(pickle.dumps([plan]))[0]
+        self.assertEqual(copy.create_sql, plan.create_sql)
+        self.assertEqual(copy.converters, plan.converters)
+
+
+class ClientDatesTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cols = [make_column('born', 'date'),
+                     make_column('created', 'datetime', is_nullable=False),
+                     make_column('name', 'varchar(10)')]
+
+    def test_select_list(self):
+        plan = my2pg.TablePlan('public', 't', self.cols, [], client_dates=True)
+        self.assertEqual(plan.select_sql,
+                         'SELECT `born`, `created`, `name` FROM t')
+        plan = my2pg.TablePlan('public', 't', self.cols, [])
+        self.assertTrue('DATE_FORMAT' in plan.select_sql)
+        self.assertEqual(plan.converters, ())
+
+    def test_zero_dates(self):
+        plan = my2pg.TablePlan('public', 't', self.cols, [], client_dates=True)
+        zero = my2pg.ZERO_DATE
+        self.assertEqual(plan.convert_row((zero, zero, 'x')),
+                         [None, datetime.datetime(1970, 1, 1), 'x'])
+        # MySQLdb gives None for invalid dates like '2010-00-00'.
+        self.assertEqual(plan.convert_row((None, None, 'x')),
+                         [None, datetime.datetime(1970, 1, 1), 'x'])
+        day = datetime.date(2010, 5, 1)
+        self.assertEqual(plan.convert_row((day, day, 'x')), [day, day, 'x'])
+
+    def test_driver_conversion(self):
+        convert = my2pg.zero_date_or(lambda s: 'converted ' + s)
+        self.assertTrue(convert('0000-00-00 00:00:00') is my2pg.ZERO_DATE)
+        self.assertEqual(convert('2010-05-01'), 'converted 2010-05-01')
+
+
+class CopyFormatTestCase(unittest.TestCase):
+    def test_values(self):
+        self.assertEqual(my2pg.copy_format(None), '\\N')
+        self.assertEqual(my2pg.copy_format(42), '42')
+        self.assertEqual(my2pg.copy_format(1.5), '1.5')
+        self.assertEqual(my2pg.copy_format(u'caf\xe9'), 'caf\xc3\xa9')
+        self.assertEqual(my2pg.copy_format('a\tb\nc\\d'), 'a\\tb\\nc\\\\d')
+        self.assertEqual(my2pg.copy_format(datetime.timedelta(0, 3661)),
+                         '0 days 3661.000000 seconds')
+
+    def test_geometry(self):
+        self.assertEqual(my2pg.copy_format(my2pg.GeometryText('POINT(1 2)')),
+                         'SRID=4326;POINT(1 2)')
+        self.assertEqual(my2pg.copy_format(my2pg.GeometryText(None)), '\\N')
+
+    def test_geometry_wkb(self):
+        # POINT(1 2) as MySQL stores it, without an SRID and with one.
+        wkb = '\x01\x01\x00\x00\x00' + struct.pack('<dd', 1, 2)
+        geom = my2pg.convert_geometry('\x00' * 4 + wkb)
+        self.assertEqual(binascii.hexlify(geom.ewkb),
+                         '0101000020e6100000' + binascii.hexlify(wkb[5:]))
+        self.assertEqual(my2pg.copy_format(geom),
+                         binascii.hexlify(geom.ewkb))
+        self.assertEqual(my2pg.adapt(geom).getquoted(),
+                         "'%s'::geometry" % binascii.hexlify(geom.ewkb))
+        geom = my2pg.convert_geometry(struct.pack('<I', 3857) + wkb)
+        self.assertEqual(binascii.hexlify(geom.ewkb[:9]), '0101000020110f0000')
+        # Big-endian WKB stays big-endian.
+        wkb = '\x00\x00\x00\x00\x01' + struct.pack('>dd', 1, 2)
+        geom = my2pg.convert_geometry('\x00' * 4 + wkb)
+        self.assertEqual(binascii.hexlify(geom.ewkb[:9]), '0020000001000010e6')
+        self.assertEqual(my2pg.convert_geometry(None), None)
+
+    def test_bytea(self):
+        # bytea's hex format, with the backslash escaped for COPY.
+        data = my2pg.convert_data('blob', 'A\n\\')
+        self.assertEqual(my2pg.copy_format(data), '\\\\x410a5c')
+        self.assertEqual(my2pg.copy_format(my2pg.convert_data('blob', '')),
+                         '\\\\x')
+        self.assertEqual(my2pg.convert_data('blob', None), None)
+
+    def test_stream(self):
+        stream = my2pg.CopyRowStream([[1, None], [2, u'x']], keep_rows=True)
+        self.assertEqual(stream.read(), '1\t\\N\n2\tx\n')
+        self.assertEqual(stream.read(), '')
+        self.assertEqual(stream.row_count, 2)
+        self.assertEqual(stream.sent, [[1, None], [2, u'x']])
+        # A row that can't be formatted is still kept for the fallback.
+        class Unformattable(object):
+            def __unicode__(self):
+                raise ValueError('bad value')
+        stream = my2pg.CopyRowStream([[1], [Unformattable()]],
+                                     keep_rows=True)
+        self.assertRaises(ValueError, stream.read)
+        self.assertEqual(len(stream.sent), 2)
+
+
+def decode_binary_copy(data, pg_types):
+    """Parse binary COPY data back into rows of Python values."""
+    epoch = datetime.datetime(2000, 1, 1)
+    decoders = {
+        'smallint': lambda v: struct.unpack('>h', v)[0],
+        'integer': lambda v: struct.unpack('>i', v)[0],
+        'bigint': lambda v: struct.unpack('>q', v)[0],
+        'real': lambda v: struct.unpack('>f', v)[0],
+        'double precision': lambda v: struct.unpack('>d', v)[0],
+        'date': lambda v: (epoch + datetime.timedelta(
+            struct.unpack('>i', v)[0])).date(),
+        'timestamp': lambda v: epoch + datetime.timedelta(
+            microseconds=struct.unpack('>q', v)[0]),
+        'interval': lambda v: datetime.timedelta(
+            struct.unpack('>qii', v)[1],
+            microseconds=struct.unpack('>qii', v)[0]),
+        'text': lambda v: v.decode('utf-8'),
+        'bytea': lambda v: v,
+    }
+    assert data.startswith(my2pg.BINARY_COPY_HEADER)
+    pos = len(my2pg.BINARY_COPY_HEADER)
+    rows = []
+    while True:
+        count, = struct.unpack_from('>h', data, pos)
+        pos += 2
+        if count == -1:
+            assert pos == len(data)
+            return rows
+        assert count == len(pg_types)
+        row = []
+        for pg_type in pg_types:
+            length, = struct.unpack_from('>i', data, pos)
+            pos += 4
+            if length == -1:
+                row.append(None)
+                continue
+            row.append(decoders[pg_type](data[pos:pos + length]))
+            pos += length
+        rows.append(tuple(row))
+
+
+class BinaryCopyTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'bigint(20)'),
+                            make_column('n', 'int(11)'),
+                            make_column('s', 'tinyint(4)'),
+                            make_column('x', 'double'),
+                            make_column('f', 'float'),
+                            make_column('d', 'date'),
+                            make_column('ts', 'datetime'),
+                            make_column('t', 'time'),
+                            make_column('name', 'varchar(10)'),
+                            make_column('data', 'blob')], [])
+        encoder = my2pg.binary_copy_encoder(plan)
+        rows = [
+            (2 ** 40, -7, 3, 0.1, 0.5, '1999-12-31', '2000-01-01 00:00:01',
+             datetime.timedelta(-1, 86399), u'caf\xe9', 'a\x00\\'),
+            (1, None, None, None, None, None, None, None, None, None),
+            (2, 0, -1, -2.5, None, datetime.date(2024, 2, 29),
+             datetime.datetime(1969, 7, 20, 20, 17, 40, 123456),
+             datetime.timedelta(0, 3661), 'x', ''),
+        ]
+        converted = [plan.convert_row(row) for row in rows]
+        stream = my2pg.BinaryCopyRowStream(converted, encoder,
+                                           keep_rows=True)
+        data = ''
+        while True:
+            chunk = stream.read(1)
+            if not chunk:
+                break
+            data += chunk
+        self.assertEqual(stream.row_count, 3)
+        self.assertEqual(stream.sent, converted)
+        decoded = decode_binary_copy(
+            data, ['bigint', 'integer', 'smallint', 'double precision',
+                   'real', 'date', 'timestamp', 'interval', 'text',
+                   'bytea'])
+        self.assertEqual(decoded, [
+            (2 ** 40, -7, 3, 0.1, 0.5, datetime.date(1999, 12, 31),
+             datetime.datetime(2000, 1, 1, 0, 0, 1),
+             datetime.timedelta(-1, 86399), u'caf\xe9', 'a\x00\\'),
+            (1, None, None, None, None, None, None, None, None, None),
+            (2, 0, -1, -2.5, None, datetime.date(2024, 2, 29),
+             datetime.datetime(1969, 7, 20, 20, 17, 40, 123456),
+             datetime.timedelta(0, 3661), u'x', ''),
+        ])
+
+    def test_unsupported(self):
+        # numeric, and geometry as WKT, have no binary encoding here.
+        for type in ('decimal(10,2)', 'point', 'year(4)'):
+            plan = my2pg.TablePlan('public', 't',
+                                   [make_column('id', 'int(11)'),
+                                    make_column('v', type)], [])
+            self.assertEqual(my2pg.binary_copy_encoder(plan), None)
+        self.assertRaises(ValueError, my2pg.BinaryCopyEncoder, ['numeric'])
+        self.assertRaises(struct.error,
+                          my2pg.BinaryCopyEncoder(['integer']).encode,
+                          [2 ** 31])
+
+    def test_encoder_cached(self):
+        plan = my2pg.TablePlan('public', 't', [make_column('id', 'int(11)')],
+                               [])
+        encoder = plan.binary_encoder()
+        self.assertTrue(plan.binary_encoder() is encoder)
+        plan = pickle.loads(pickle.dumps(plan))
+        self.assertFalse('_binary_encoder' in plan.__dict__)
+        self.assertEqual(plan.binary_encoder().encode([1]),
+                         encoder.encode([1]))
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql, args=()):
+        self.conn.statements.append(sql)
+        self.conn.executed.append((sql, args))
+        if 'bad' in args:
+            raise psycopg2.DataError('bad value')
+        if 'unadaptable' in args:
+            raise TypeError("can't adapt")
+        if 'lost' in args:
+            raise psycopg2.OperationalError('server closed the connection')
+        if sql.strip().startswith('INSERT'):
+            self.conn.inserted.extend(v for v in args)
+
+
+class FakeConnection(object):
+    def __init__(self):
+        self.statements = []
+        self.executed = []
+        self.inserted = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeMySQLCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, sql):
+        self.conn.queries.append(sql)
+        self.rows = iter(self.conn.rows)
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchmany(self, size):
+        return list(itertools.islice(self.rows, size))
+
+    def close(self):
+        pass
+
+
+class FakeMySQLConnection(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self, cursorclass=None):
+        return FakeMySQLCursor(self)
+
+
+class BatchInsertTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.reject_file = tempfile.mkstemp()
+        os.close(fd)
+        self.options = optparse.Values({'dry_run': False, 'batch_size': 4,
+                                        'reject_file': self.reject_file})
+
+    def tearDown(self):
+        os.unlink(self.reject_file)
+
+    def test_bisection(self):
+        plan = my2pg.TablePlan('public', 't', [make_column('v', 'char(3)')],
+                               [])
+        rows = [[v] for v in ('a', 'b', 'bad', 'c', 'd', 'e', 'bad')]
+        conn = FakeConnection()
+        result = my2pg.batch_insert_rows(conn, self.options, plan, rows)
+        self.assertEqual(result, (5, 2))
+        self.assertEqual(sorted(conn.inserted), ['a', 'b', 'c', 'd', 'e'])
+        rejects = open(self.reject_file).read().splitlines()
+        self.assertEqual(rejects, ['t\tbad value\tbad'] * 2)
+
+    def test_adaptation_error(self):
+        # Values psycopg2 can't adapt are rejected like bad ones, but a
+        # lost connection ends the load.
+        plan = my2pg.TablePlan('public', 't', [make_column('v', 'char(3)')],
+                               [])
+        rows = [[v] for v in ('a', 'unadaptable', 'b')]
+        conn = FakeConnection()
+        result = my2pg.batch_insert_rows(conn, self.options, plan, rows)
+        self.assertEqual(result, (2, 1))
+        self.assertEqual(sorted(conn.inserted), ['a', 'b'])
+        rejects = open(self.reject_file).read().splitlines()
+        self.assertEqual(rejects, ["t\tcan't adapt\tunadaptable"])
+        self.assertRaises(psycopg2.OperationalError, my2pg.batch_insert_rows,
+                          FakeConnection(), self.options, plan,
+                          [['a'], ['lost']])
+
+
+class CheckpointTestCase(unittest.TestCase):
+    def test_progress_committed_with_rows(self):
+        options = optparse.Values({'dry_run': False, 'batch_size': 10,
+                                   'reject_file': None, 'loader': 'batch',
+                                   'checkpoint': True, 'fetch_rows': 3,
+                                   'queue_rows': 6, 'queue_mb': 1,
+                                   'commit_rows': 2, 'commit_mb': 64,
+                                   'commit_seconds': 10.0})
+        plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)'),
+                            make_column('v', 'char(3)')],
+            [my2pg.Index(name='PRIMARY', table='t', type='BTREE',
+                         column_names=['id'])])
+        mysql_conn = FakeMySQLConnection([(i, 'x') for i in range(11, 16)])
+        pg_conn = FakeConnection()
+        result = my2pg.load_table_rows(mysql_conn, pg_conn, options, plan,
+                                       (1, 100), after_key=10, rows_before=10)
+        self.assertEqual(result, (5, 0))
+        self.assertEqual(mysql_conn.queries[0],
+                         plan.select_sql + ' WHERE `id` BETWEEN 1 AND 100 '
+                         'AND `id` > 10 ORDER BY `id`')
+        # Three batches of at most two rows, plus the final commit.
+        self.assertEqual(pg_conn.commits, 4)
+        progress = [sql for sql in pg_conn.statements
+                    if 'INSERT INTO "public".my2pg_progress' in sql]
+        self.assertEqual(len(progress), 4)
+        # The final record: range, last key, rows including the earlier
+        # run's, done.
+        self.assertEqual(pg_conn.inserted[-6:], ['t', 1, 100, 15, 15, True])
+
+    def test_resume_options(self):
+        parser = optparse.OptionParser()
+        options = optparse.Values({
+            'resume': True, 'checkpoint': False, 'drop_tables': False,
+            'incremental': False, 'swap': False, 'data_only': False,
+            'shards': [], 'shard_column': None, 'binlog': False})
+        my2pg.check_options(parser, options, None)
+        self.assertTrue(options.checkpoint)
+        # Dropping the tables would leave the finished ones empty.
+        options.drop_tables = True
+        errors = []
+        parser.error = errors.append
+        my2pg.check_options(parser, options, None)
+        self.assertEqual(errors,
+                         ['--resume cannot be used with --drop-tables'])
+
+
+class SyncSource(my2pg.MemorySource):
+    """A MemorySource that also answers the high-water mark query."""
+    def cursor(self, cursorclass=None):
+        return SyncSourceCursor(self)
+
+    def literal(self, value):
+        return "'%s'" % value
+
+
+class SyncSourceCursor(my2pg.MemorySourceCursor):
+    def execute(self, sql, args=None):
+        my2pg.MemorySourceCursor.execute(self, sql, args)
+        if sql.startswith('SELECT MAX('):
+            self.rows = iter([(max(row[0] for row in self.rows),)])
+
+
+class SyncCursor(FakeCursor):
+    def fetchone(self):
+        return self.conn.mark is not None and (self.conn.mark,) or None
+
+    def copy_expert(self, sql, stream, size=my2pg.COPY_BUFFER_SIZE):
+        self.conn.statements.append(sql)
+        while stream.read(size):
+            pass
+
+    def close(self):
+        pass
+
+
+class SyncConnection(FakeConnection):
+    def __init__(self, mark):
+        FakeConnection.__init__(self)
+        self.mark = mark
+
+    def cursor(self):
+        return SyncCursor(self)
+
+
+class SyncTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({
+            'dry_run': False, 'batch_size': 10, 'reject_file': None,
+            'checkpoint': False, 'fast_load': False, 'loader': 'batch',
+            'fetch_rows': 10, 'queue_rows': 100, 'queue_mb': 1,
+            'commit_rows': 1000, 'commit_mb': 64, 'commit_seconds': 10.0,
+            'updated_column': None})
+        self.plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)', auto_increment=True),
+                            make_column('v', 'text')],
+            [my2pg.Index(name='PRIMARY', table='t', type='BTREE',
+                         column_names=['id'])])
+
+    def sync(self, mark, rows):
+        source = SyncSource({'t': rows})
+        pg_conn = SyncConnection(mark)
+        result = my2pg.sync_table_data(source, pg_conn, self.options,
+                                       self.plan)
+        return source, pg_conn, result
+
+    def recorded_marks(self, pg_conn):
+        return [args[2] for sql, args in pg_conn.executed
+                if 'INSERT INTO "public".my2pg_sync' in sql]
+
+    def test_upsert_past_mark(self):
+        source, pg_conn, result = self.sync('10', [(11, 'a'), (12, 'b')])
+        self.assertEqual(result, (2, 0))
+        self.assertTrue(source.queries[-1].endswith(" WHERE `id` > '10'"))
+        upserts = [sql for sql in pg_conn.statements
+                   if sql.startswith('INSERT INTO "public".t ')]
+        self.assertEqual(len(upserts), 1)
+        self.assertTrue(upserts[0].endswith(
+            'ON CONFLICT ("id") DO UPDATE SET "v" = EXCLUDED."v"'))
+        self.assertFalse([sql for sql in pg_conn.statements
+                          if sql.startswith('DELETE FROM "public".t')])
+        self.assertEqual(self.recorded_marks(pg_conn), [u'12'])
+
+    def test_reload_without_mark(self):
+        source, pg_conn, result = self.sync(None, [(1, 'a'), (2, 'b')])
+        self.assertEqual(result, (2, 0))
+        self.assertTrue('DELETE FROM "public".t' in pg_conn.statements)
+        self.assertEqual(self.recorded_marks(pg_conn), [u'2'])
+
+    def test_failed_rows_keep_mark(self):
+        # Rows that failed are read again by the next run.
+        source, pg_conn, result = self.sync('10', [(11, 'a'), (12, 'bad')])
+        self.assertEqual(result, (1, 1))
+        self.assertEqual(self.recorded_marks(pg_conn), [])
+
+    def test_copy_through_staging_table(self):
+        self.options.loader = 'copy'
+        source, pg_conn, result = self.sync('10', [(11, 'a'), (12, 'b')])
+        self.assertEqual(result, (2, 0))
+        upsert = self.plan.for_upsert()
+        statements = [sql for sql in pg_conn.statements
+                      if sql in (upsert.staging_sql, upsert.copy_sql,
+                                 upsert.merge_sql)]
+        self.assertEqual(statements, [upsert.staging_sql, upsert.copy_sql,
+                                      upsert.merge_sql])
+        self.assertEqual(self.recorded_marks(pg_conn), [u'12'])
+
+
+class RowPipelineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)'),
+                            make_column('v', 'text')], [])
+
+    def test_rows_in_order_within_bounds(self):
+        conn = FakeMySQLConnection([(i, 'x' * 10) for i in range(100)])
+        cur = conn.cursor()
+        cur.execute(self.plan.select_sql)
+        pipeline = my2pg.RowPipeline(cur, self.plan, 3, 7, 1000)
+        rows = []
+        for row in pipeline:
+            rows.append(row)
+            self.assertTrue(pipeline.queued_rows <= 7)
+            self.assertTrue(pipeline.queued_bytes <= 1000)
+        self.assertEqual(rows, conn.rows)
+        pipeline.thread.join()
+
+    def test_byte_bound(self):
+        conn = FakeMySQLConnection([(i, 'x' * 100) for i in range(20)])
+        cur = conn.cursor()
+        cur.execute(self.plan.select_sql)
+        pipeline = my2pg.RowPipeline(cur, self.plan, 2, 1000, 250)
+        for row in pipeline:
+            # Two rows of 108 bytes fit, a second batch doesn't.
+            self.assertTrue(pipeline.queued_bytes <= 250)
+        self.assertEqual(pipeline.queued_rows, 0)
+
+    def test_reader_error(self):
+        def fail(row):
+            if row[0] == 5:
+                raise ValueError('bad row')
+            return row
+        self.plan.convert_row = fail
+        conn = FakeMySQLConnection([(i, 'x') for i in range(10)])
+        cur = conn.cursor()
+        cur.execute(self.plan.select_sql)
+        pipeline = my2pg.RowPipeline(cur, self.plan, 2, 100, 1000)
+        rows = []
+        try:
+            for row in pipeline:
+                rows.append(row)
+        except ValueError:
+            pass
+        else:
+            self.fail('reader error not raised')
+        self.assertEqual([r[0] for r in rows], [0, 1, 2, 3])
+
+    def test_close(self):
+        conn = FakeMySQLConnection([(i, 'x') for i in range(1000)])
+        cur = conn.cursor()
+        cur.execute(self.plan.select_sql)
+        pipeline = my2pg.RowPipeline(cur, self.plan, 10, 20, 1000)
+        self.assertEqual(next(iter(pipeline)), (0, 'x'))
+        pipeline.close()
+        self.assertFalse(pipeline.thread.is_alive())
+        self.assertTrue(pipeline.queued_rows <= 20)
+
+    def test_close_waits_for_fetch(self):
+        # After a writer error, close() returns only once the reader is
+        # out of fetchmany(), so the connection is free again.
+        conn = FakeMySQLConnection([(i, 'x') for i in range(1000)])
+        cur = conn.cursor()
+        fetching = []
+        fetchmany = cur.fetchmany
+        def slow_fetch(size):
+            fetching.append(True)
+            time.sleep(0.05)
+            rows = fetchmany(size)
+            fetching.pop()
+            return rows
+        cur.fetchmany = slow_fetch
+        cur.execute(self.plan.select_sql)
+        pipeline = my2pg.RowPipeline(cur, self.plan, 10, 1000, 100000)
+        try:
+            for row in pipeline:
+                raise psycopg2.DataError('write failed')
+        except psycopg2.DataError:
+            pipeline.close()
+        self.assertFalse(pipeline.thread.is_alive())
+        self.assertEqual(fetching, [])
+
+    def test_fetch_size_follows_row_size(self):
+        self.plan.avg_row_length = 1000
+        conn = FakeMySQLConnection([(i, 'x' * 1000) for i in range(50)])
+        cur = conn.cursor()
+        sizes = []
+        fetchmany = cur.fetchmany
+        def record(size):
+            sizes.append(size)
+            return fetchmany(size)
+        cur.fetchmany = record
+        cur.execute(self.plan.select_sql)
+        pipeline = my2pg.RowPipeline(cur, self.plan, 100, 1000, 20000)
+        self.assertEqual(len(list(pipeline)), 50)
+        # A quarter of 20000 bytes holds four rows of about 1000 bytes.
+        self.assertEqual(sizes[0], 5)
+        self.assertEqual(max(sizes[1:]), 4)
+
+
+class CommitBudgetTestCase(unittest.TestCase):
+    def test_batch_rows(self):
+        budget = my2pg.CommitBudget(1000000, 64 << 20, 10.0)
+        self.assertEqual(budget.batch_rows(), my2pg.COMMIT_FIRST_ROWS)
+        # MB-sized rows make small transactions, tiny rows large ones.
+        budget = my2pg.CommitBudget(1000000, 64 << 20, 10.0, 1 << 20)
+        self.assertEqual(budget.batch_rows(), 64)
+        budget = my2pg.CommitBudget(1000000, 64 << 20, 10.0, 20)
+        self.assertEqual(budget.batch_rows(), 1000000)
+        budget = my2pg.CommitBudget(1000000, 64 << 20, 10.0, 100 << 20)
+        self.assertEqual(budget.batch_rows(), 1)
+
+    def test_update(self):
+        budget = my2pg.CommitBudget(1000000, 1000000, 10.0, 100)
+        budget.update(1000, 1000000, 1.0)
+        self.assertEqual(budget.row_bytes, 550)
+        self.assertEqual(budget.batch_rows(), 1818)
+        # Slow writes shorten transactions too: 10 rows/s for 10s.
+        budget = my2pg.CommitBudget(1000000, 1000000, 10.0, 100)
+        budget.update(1000, 100000, 100.0)
+        self.assertEqual(budget.batch_rows(), 100)
+
+    def test_take_stops_at_byte_budget(self):
+        plan = my2pg.TablePlan('public', 't', [make_column('v', 'text')], [])
+        rows = [('x' * 1000,)] * 10 + [('y' * 100000,)] + [('z',)] * 10
+        cur = FakeMySQLConnection(rows).cursor()
+        cur.execute(plan.select_sql)
+        pipeline = my2pg.RowPipeline(cur, plan, 1, 100, 1 << 20)
+        budget = my2pg.CommitBudget(1000, 50000, 10.0, 10)
+        rows = iter(pipeline)
+        batches = [len(list(budget.take(itertools.chain([first], rows),
+                                        pipeline)))
+                   for first in rows]
+        # The outsized row ends its transaction.
+        self.assertEqual(batches, [11, 10])
+
+
+class StandInTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({
+            'dry_run': False, 'batch_size': 2, 'reject_file': None,
+            'checkpoint': False, 'fetch_rows': 2, 'queue_rows': 10,
+            'queue_mb': 1, 'commit_rows': 1000, 'commit_mb': 64,
+            'commit_seconds': 10.0})
+        self.plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)'),
+                            make_column('body', 'text'),
+                            make_column('data', 'blob'),
+                            make_column('shape', 'point')], [])
+        self.source = my2pg.MemorySource({'t': [
+            (1, u'caf\xe9\tbar', 'ab', 'POINT(1 2)'),
+            (2, None, None, None),
+            (3, 'x', '', 'POINT(0 0)'),
+        ]})
+
+    def load(self, loader):
+        self.options.loader = loader
+        out = StringIO.StringIO()
+        sink = my2pg.FileSink(out)
+        result = my2pg.load_table_rows(self.source, sink, self.options,
+                                       self.plan)
+        sink.close()
+        self.assertEqual(result, (3, 0))
+        self.assertEqual(self.source.queries, [self.plan.select_sql])
+        self.assertEqual(sink.bytes_written, len(out.getvalue()))
+        return out.getvalue()
+
+    def test_copy(self):
+        script = self.load('copy')
+        self.assertTrue(script.startswith('BEGIN;\n'))
+        self.assertTrue(script.endswith('COMMIT;\n'))
+        self.assertTrue(self.plan.copy_sql + ';\n'
+                        '1\tcaf\xc3\xa9\\tbar\t\\\\x6162\t'
+                        'SRID=4326;POINT(1 2)\n'
+                        '2\t\\N\t\\N\t\\N\n'
+                        '3\tx\t\\\\x\tSRID=4326;POINT(0 0)\n'
+                        '\\.\n' in script)
+
+    def test_binary_fallback(self):
+        # The WKT geometry column can't be sent in binary, so the whole
+        # table goes as text.
+        script = self.load('binary')
+        self.assertFalse('FORMAT binary' in script)
+        self.assertTrue(self.plan.copy_sql + ';\n1\tcaf\xc3\xa9' in script)
+
+    def test_failure_closes_cursor(self):
+        closed = []
+
+        class Cursor(my2pg.MemorySourceCursor):
+            def fetchmany(self, size):
+                raise IOError('lost connection')
+
+            def close(self):
+                closed.append(self)
+
+        self.source.cursor = lambda cursorclass=None: Cursor(self.source)
+        self.options.loader = 'copy'
+        self.assertRaises(IOError, my2pg.load_table_rows, self.source,
+                          my2pg.FileSink(), self.options, self.plan)
+        self.assertEqual(len(closed), 1)
+
+    def test_batch(self):
+        script = self.load('batch')
+        self.assertEqual(script.count('INSERT INTO'), 2)
+        self.assertTrue("(1,'caf\xc3\xa9\tbar'," in script)
+        self.assertTrue("ST_GeomFromText('POINT(1 2)', 4326)" in script)
+        self.assertTrue('(2,NULL,NULL,NULL)' in script)
+
+
+class CopyCursor(FakeCursor):
+    def copy_expert(self, sql, stream, size=my2pg.COPY_BUFFER_SIZE):
+        self.conn.statements.append(sql)
+        data = ''
+        while True:
+            chunk = stream.read(size)
+            if not chunk:
+                break
+            data += chunk
+        self.conn.copied.append(data)
+        if 'bad' in data:
+            raise psycopg2.DataError('bad value')
+
+
+class CopyConnection(FakeConnection):
+    def __init__(self):
+        FakeConnection.__init__(self)
+        self.copied = []
+
+    def cursor(self):
+        return CopyCursor(self)
+
+
+class CopyRowsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({
+            'dry_run': False, 'batch_size': 10, 'reject_file': None})
+        self.plan = my2pg.TablePlan('public', 't',
+                                    [make_column('id', 'int(11)'),
+                                     make_column('v', 'text')], [])
+        self.limits = my2pg.COPY_REPLAY_ROWS, my2pg.COPY_REPLAY_BYTES
+        my2pg.COPY_REPLAY_ROWS = 3
+
+    def tearDown(self):
+        my2pg.COPY_REPLAY_ROWS, my2pg.COPY_REPLAY_BYTES = self.limits
+
+    def test_replay_limit(self):
+        # Only the rows of the failed COPY are kept and inserted.
+        conn = CopyConnection()
+        rows = [(i, i == 4 and 'bad' or 'ok') for i in range(8)]
+        self.assertEqual(my2pg.copy_rows(conn, self.options, self.plan, rows),
+                         (7, 1))
+        self.assertEqual([data.count('\n') for data in conn.copied],
+                         [3, 3, 2])
+        self.assertEqual(conn.inserted, [3, 'ok', 5, 'ok'])
+        self.assertEqual(conn.statements.count(self.plan.copy_sql), 3)
+
+    def test_byte_limit(self):
+        my2pg.COPY_REPLAY_BYTES = 10
+        conn = CopyConnection()
+        rows = [(1, 'x' * 20), (2, 'y'), (3, 'z')]
+        self.assertEqual(my2pg.copy_rows(conn, self.options, self.plan, rows),
+                         (3, 0))
+        self.assertEqual(conn.copied, ['1\t' + 'x' * 20 + '\n',
+                                       '2\ty\n3\tz\n'])
+
+
+class WorkerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({
+            'dry_run': False, 'batch_size': 10, 'reject_file': None,
+            'checkpoint': False, 'incremental': False, 'fast_load': False,
+            'loader': 'batch', 'fetch_rows': 10, 'queue_rows': 100,
+            'queue_mb': 1, 'commit_rows': 1000, 'commit_mb': 64,
+            'commit_seconds': 10.0})
+        self.plan = my2pg.TablePlan('public', 't',
+                                    [make_column('id', 'int(11)')], [])
+        self.saved = dict(my2pg._worker)
+
+    def tearDown(self):
+        my2pg._worker.clear()
+        my2pg._worker.update(self.saved)
+
+    def test_init_worker(self):
+        handler = signal.getsignal(signal.SIGINT)
+        try:
+            my2pg.init_worker(self.options, ('m', 'mdb', 'p', 'pdb'))
+            self.assertEqual(signal.getsignal(signal.SIGINT),
+                             signal.SIG_IGN)
+        finally:
+            signal.signal(signal.SIGINT, handler)
+        self.assertTrue(my2pg._worker['options'] is self.options)
+        self.assertEqual(my2pg._worker['db_args'], ('m', 'mdb', 'p', 'pdb'))
+        self.assertFalse('mysql_conn' in my2pg._worker)
+
+    def test_worker(self):
+        source = my2pg.MemorySource({'t': [(1,), (2,)]})
+        my2pg._worker.update(options=self.options,
+                             db_args=('m', 'mdb', 'p', 'pdb'),
+                             mysql_conn=source, pg_conn=my2pg.FileSink())
+        self.assertEqual(my2pg.convert_table_worker((self.plan, None)),
+                         ('t', 2, 0, None))
+        # A failure is reported, and the connections are dropped so the
+        # next table gets new ones.
+        plan = my2pg.TablePlan('public', 'missing',
+                               [make_column('id', 'int(11)')], [])
+        table, row_count, errors, failure = my2pg.convert_table_worker(
+            (plan, None))
+        self.assertEqual((table, row_count, errors), ('missing', 0, 0))
+        self.assertEqual(failure, "'missing'")
+        self.assertFalse('mysql_conn' in my2pg._worker)
+        self.assertFalse('pg_conn' in my2pg._worker)
+
+
+class FastLoadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)')],
+            [my2pg.Index(name='PRIMARY', table='t', type='BTREE',
+                         column_names=['id'])])
+
+    def options(self, **kw):
+        attrs = dict(dry_run=False, drop_tables=False, defer_indexes=False,
+                     fast_load=True, swap=False)
+        attrs.update(kw)
+        return optparse.Values(attrs)
+
+    def test_unlogged_tables(self):
+        for defer_indexes in (False, True):
+            conn = FakeConnection()
+            options = self.options(defer_indexes=defer_indexes)
+            my2pg.create_tables(conn, options, [self.plan])
+            self.assertTrue(conn.statements[0].startswith(
+                'CREATE UNLOGGED TABLE "public".t ('))
+            self.assertEqual(
+                'PRIMARY KEY' in conn.statements[0], not defer_indexes)
+
+    def test_empty_table(self):
+        conn = FakeConnection()
+        my2pg.empty_table(conn, self.options(), self.plan)
+        my2pg.empty_table(conn, self.options(fast_load=False), self.plan)
+        self.assertEqual(conn.statements, ['TRUNCATE "public".t',
+                                           'DELETE FROM "public".t'])
+
+
+class SwapCursor(FakeCursor):
+    def execute(self, sql, args=()):
+        FakeCursor.execute(self, sql, args)
+        self.sql = sql
+        self.args = args
+        if sql == 'DROP TABLE "public".t' and self.conn.fail_drop:
+            raise psycopg2.InternalError('other objects depend on it')
+        if sql.startswith('ALTER TABLE') and self.conn.fail_rename:
+            raise psycopg2.ProgrammingError('permission denied')
+
+    def fetchall(self):
+        if 'aclexplode' in self.sql and self.args[0].endswith('_seq'):
+            return [('USAGE', 'writer', False)]
+        if 'aclexplode' in self.sql:
+            return [('SELECT', 'reader', False), ('INSERT', 'writer', True)]
+        return self.conn.exists and [(1,)] or []
+
+    def fetchone(self):
+        if 'relowner' in self.sql:
+            return ('app',)
+        return ('public.my2pg_new_t_id_seq', 'public.t_id_seq')
+
+    def close(self):
+        pass
+
+
+class SwapConnection(FakeConnection):
+    def __init__(self, fail_drop=False, fail_rename=False, exists=True):
+        FakeConnection.__init__(self)
+        self.fail_drop = fail_drop
+        self.fail_rename = fail_rename
+        self.exists = exists
+        self.rollbacks = 0
+
+    def cursor(self):
+        return SwapCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class SwapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({'dry_run': False})
+        self.plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)', auto_increment=True),
+                            make_column('v', 'text')],
+            [my2pg.Index(name='PRIMARY', table='t', type='BTREE',
+                         column_names=['id']),
+             my2pg.Index(name='v_idx', table='t', type='BTREE',
+                         column_names=['v'])]).for_shadow()
+
+    def test_shadow_plan(self):
+        plan = self.plan
+        self.assertEqual(plan.table, 't')
+        self.assertEqual(plan.pg_table, 'my2pg_new_t')
+        self.assertEqual(plan.live_table, 't')
+        self.assertTrue(plan.select_sql.endswith(' FROM t'))
+        self.assertTrue(plan.copy_sql.startswith(
+            'COPY "public".my2pg_new_t '))
+        self.assertEqual(plan.index_sql, [
+            'CREATE INDEX my2pg_new_v_idx ON "public"."my2pg_new_t" ("v")'])
+        self.assertEqual(plan.primary_key_sql,
+                         'ALTER TABLE "public".my2pg_new_t ADD PRIMARY KEY '
+                         '("id")')
+        self.assertEqual(plan.index_renames,
+                         [('my2pg_new_v_idx', 'v_idx'),
+                          ('my2pg_new_t_pkey', '"t_pkey"')])
+
+    def test_swap(self):
+        conn = SwapConnection()
+        self.assertTrue(my2pg.swap_table(conn, self.options, self.plan))
+        grants = [sql for sql in conn.statements
+                  if sql.startswith(('GRANT', 'ALTER TABLE "public".my2pg'))]
+        self.assertEqual(grants, [
+            'GRANT SELECT ON TABLE "public".my2pg_new_t TO reader',
+            'GRANT INSERT ON TABLE "public".my2pg_new_t TO writer '
+            'WITH GRANT OPTION',
+            'GRANT USAGE ON SEQUENCE public.my2pg_new_t_id_seq TO writer',
+            'ALTER TABLE "public".my2pg_new_t OWNER TO app',
+            'ALTER TABLE "public".my2pg_new_t RENAME TO t'])
+        self.assertEqual(conn.statements[-5:], [
+            'DROP TABLE "public".t',
+            'ALTER TABLE "public".my2pg_new_t RENAME TO t',
+            'ALTER INDEX "public".my2pg_new_v_idx RENAME TO v_idx',
+            'ALTER INDEX "public".my2pg_new_t_pkey RENAME TO "t_pkey"',
+            'ALTER SEQUENCE public.my2pg_new_t_id_seq RENAME TO t_id_seq'])
+        self.assertEqual(conn.rollbacks, 0)
+
+    def test_copy_fallback(self):
+        conn = SwapConnection(fail_drop=True)
+        self.assertFalse(my2pg.swap_table(conn, self.options, self.plan))
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual(conn.statements[-3:], [
+            'TRUNCATE "public".t',
+            'INSERT INTO "public".t ("id", "v") SELECT "id", "v" '
+            'FROM "public".my2pg_new_t',
+            'DROP TABLE "public".my2pg_new_t'])
+
+    def test_rename_fails_without_live_table(self):
+        # With no live table to copy into, the rows stay in the shadow.
+        conn = SwapConnection(fail_rename=True, exists=False)
+        self.assertFalse(my2pg.swap_table(conn, self.options, self.plan))
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertFalse([sql for sql in conn.statements
+                          if sql.startswith(('TRUNCATE', 'DROP'))])
+
+
+    def test_swap_skips_tables(self):
+        conn = SwapConnection()
+        self.assertEqual(my2pg.swap_tables(conn, self.options, [self.plan],
+                                           {'t': 'it was not indexed'}), 0)
+        self.assertEqual(conn.statements, [])
+        self.assertEqual(my2pg.swap_tables(conn, self.options, [self.plan],
+                                           {}), 1)
+
+
+class FailingStatementConnection(FakeConnection):
+    def cursor(self):
+        cursor = FakeCursor(self)
+        execute = cursor.execute
+
+        def fail_bad(sql, args=()):
+            execute(sql, args)
+            if 'bad' in sql:
+                raise psycopg2.ProgrammingError('bad statement')
+        cursor.execute = fail_bad
+        return cursor
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class StatementsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({
+            'dry_run': False, 'maintenance_work_mem': None,
+            'index_jobs': 2, 'jobs': 1})
+        self.conn = FailingStatementConnection()
+        self.connect_pg = my2pg.connect_pg
+        my2pg.connect_pg = lambda options, host, db: self.conn
+
+    def tearDown(self):
+        my2pg.connect_pg = self.connect_pg
+
+    def test_failed_tables(self):
+        times = {}
+        failed = my2pg.run_statements(
+            self.options, ('p', 'pdb'),
+            [('a', 'ANALYZE a'), ('b', 'CREATE INDEX bad ON b (v)'),
+             ('b', 'ANALYZE b')], 2, times)
+        self.assertEqual(failed, set(['b']))
+        self.assertEqual(sorted(times), ['a', 'b'])
+        self.assertEqual(sorted(self.conn.statements),
+                         ['ANALYZE a', 'ANALYZE b',
+                          'CREATE INDEX bad ON b (v)'])
+
+    def test_set_tables_logged(self):
+        plans = [my2pg.TablePlan('public', name,
+                                 [make_column('id', 'int(11)')], [])
+                 for name in ('good', 'bad')]
+        self.assertEqual(my2pg.set_tables_logged(self.options, ('p', 'pdb'),
+                                                 plans), set(['bad']))
+
+
+class ShardTestCase(unittest.TestCase):
+    def test_parse_shard(self):
+        self.assertEqual(my2pg.parse_shard('db2', 'app'), ('db2', 'app'))
+        self.assertEqual(my2pg.parse_shard('db2/app_eu', 'app'),
+                         ('db2', 'app_eu'))
+
+    def test_for_shard(self):
+        plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)', is_nullable=False,
+                                        auto_increment=True),
+                            make_column('data', 'blob')],
+            [my2pg.Index(name='PRIMARY', table='t', column_names=['id']),
+             my2pg.Index(name='data_idx', table='t', type='BTREE',
+                         column_names=['data'], non_unique=True)])
+        plan.data_length = 1000
+        shard = plan.for_shard('shard_id', 3)
+        self.assertEqual(shard.select_sql,
+                         'SELECT 3 AS `shard_id`, `id`, `data` FROM t')
+        self.assertTrue('"shard_id" integer NOT NULL' in shard.create_sql)
+        self.assertTrue('PRIMARY KEY ("shard_id","id")' in shard.create_sql)
+        self.assertEqual(shard.index_sql, plan.index_sql)
+        self.assertEqual([pos for pos, f in shard.converters], [2])
+        self.assertEqual(shard.data_length, 1000)
+        # The original plan is left alone.
+        self.assertEqual(plan.indexes[0].column_names, ['id'])
+        self.assertEqual(shard.for_shadow().select_sql, shard.select_sql)
+
+
+class SequenceCursor(FakeCursor):
+    def fetchall(self):
+        return self.conn.tables
+
+    def close(self):
+        pass
+
+
+class SequenceConnection(FakeConnection):
+    def __init__(self, tables):
+        FakeConnection.__init__(self)
+        self.tables = tables
+
+    def cursor(self):
+        return SequenceCursor(self)
+
+
+class SequenceTestCase(unittest.TestCase):
+    def test_reset_sequences(self):
+        options = optparse.Values({'dry_run': False})
+        plans = [
+            my2pg.TablePlan('public', 'a', [
+                make_column('id', 'int(11)', auto_increment=True),
+                make_column('v', 'text')], []),
+            my2pg.TablePlan('public', 'user', [
+                make_column('uid', 'bigint(20) unsigned',
+                            auto_increment=True)], []),
+            my2pg.TablePlan('public', 'c', [make_column('id', 'int(11)')], []),
+        ]
+        tables = [('public', 'a'), ('public', 'user'), ('public', 'c')]
+        conn = SequenceConnection(tables)
+        my2pg.reset_sequences(conn, options, plans, {'a': 42, 'c': 7})
+        self.assertEqual(conn.statements[1:], [
+            'SELECT setval(pg_get_serial_sequence(%s, %s), %s, false), '
+            'setval(pg_get_serial_sequence(%s, %s), COALESCE((SELECT '
+            'max("uid") FROM "public"."user"), 0) + 1, false)'])
+        self.assertEqual(conn.commits, 1)
+
+        conn = SequenceConnection(tables)
+        my2pg.reset_sequences(conn, options, plans[2:], {'c': 7})
+        self.assertEqual(conn.statements[1:], [])
+
+        # A table that wasn't created is left out.
+        conn = SequenceConnection(tables[1:])
+        my2pg.reset_sequences(conn, options, plans, {'a': 42})
+        self.assertEqual(conn.statements[1:], [
+            'SELECT setval(pg_get_serial_sequence(%s, %s), COALESCE((SELECT '
+            'max("uid") FROM "public"."user"), 0) + 1, false)'])
+
+
+class RunReportTestCase(unittest.TestCase):
+    def setUp(self):
+        fd, self.metrics_file = tempfile.mkstemp()
+        os.close(fd)
+        fd, self.report_file = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.metrics_file)
+        os.unlink(self.report_file)
+
+    def test_report(self):
+        options = optparse.Values({
+            'dry_run': False, 'batch_size': 10, 'reject_file': None,
+            'checkpoint': False, 'fetch_rows': 2, 'queue_rows': 10,
+            'queue_mb': 1, 'loader': 'copy', 'commit_rows': 2,
+            'commit_mb': 64, 'commit_seconds': 10.0})
+        plan = my2pg.TablePlan('public', 't', [make_column('v', 'text')], [])
+        source = my2pg.MemorySource({'t': [('abc',)] * 5})
+        report = my2pg.RunReport(self.metrics_file, {'t': 5, 'u': 100})
+        report.start()
+        my2pg.load_table_rows(source, my2pg.FileSink(), options, plan)
+        # A table converted in two key ranges, one of them unfinished.
+        for key_range, done in (((1, 10), True), ((11, 20), False)):
+            stats = my2pg.TableStats('u', key_range)
+            stats.rows = 10
+            stats.done = done
+            my2pg.report_progress(stats)
+        report.index_times['t'] = 1.5
+        report.stop()
+
+        tables = report.tables()
+        self.assertEqual(tables['t'].rows, 5)
+        self.assertEqual(tables['t'].bytes, 15)
+        self.assertTrue(tables['t'].done)
+        self.assertEqual(tables['u'].rows, 20)
+        self.assertFalse(tables['u'].done)
+
+        metrics = open(self.metrics_file).read().splitlines()
+        self.assertTrue('my2pg_rows_total{table="t"} 5.0' in metrics)
+        self.assertTrue('my2pg_rows_remaining{table="u"} 80.0' in metrics)
+        self.assertTrue('my2pg_stage_seconds_total{table="t",stage="index"} '
+                        '1.5' in metrics)
+        self.assertTrue('my2pg_table_done{table="u"} 0.0' in metrics)
+
+        report.write_json(self.report_file, [('v', 'no such table')],
+                          [('convert data', 2.5)])
+        result = json.load(open(self.report_file))
+        self.assertEqual(result['rows'], 25)
+        self.assertEqual(result['failed'], {'v': 'no such table'})
+        self.assertEqual(result['tables']['t']['index_time'], 1.5)
+        self.assertEqual(result['steps'],
+                         [{'name': 'convert data', 'seconds': 2.5}])
+
+    def test_eta(self):
+        report = my2pg.RunReport(None, {'t': 100, 'u': 1000, 'v': 500})
+        now = time.time()
+        for table, rows, done in (('t', 120, True), ('u', 380, False)):
+            stats = my2pg.TableStats(table)
+            stats.rows = rows
+            stats.started = now - 10
+            stats.done = done
+            report.parts[table, None, None] = stats
+        rows, expected, rate, seconds = report.eta(now)
+        # t turned out to have 120 rows; v hasn't been started.
+        self.assertEqual((rows, expected), (500, 1620))
+        self.assertAlmostEqual(rate, 50)
+        self.assertAlmostEqual(seconds, 22.4)
+        self.assertEqual(report.progress(now),
+                         '500 of ~1620 rows (30%), 50 rows/s, ETA 0:00:22; '
+                         'loading u 38%')
+        self.assertEqual(my2pg.percentage(0, 0), '0%')
+        self.assertEqual(my2pg.percentage(999, 1000), '99%')
+        self.assertEqual(my2pg.percentage(1200, 1000), '100%')
+
+    def test_order_by_size(self):
+        plans = [my2pg.TablePlan('public', name, [make_column('v', 'text')],
+                                 [])
+                 for name in ('a', 'b', 'c', 'z')]
+        for plan, size in zip(plans, (10, 0, 10, 5000)):
+            plan.data_length = size
+        self.assertEqual([p.table for p in my2pg.order_by_size(plans)],
+                         ['z', 'a', 'c', 'b'])
+
+
+class DumpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.options = optparse.Values({
+            'dry_run': False, 'fetch_rows': 100, 'queue_rows': 1000,
+            'queue_mb': 4, 'segment_mb': 1, 'compress_level': 1})
+        self.plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)'),
+                            make_column('v', 'text')], [])
+        self.rows = [(i, 'x' * 1000) for i in range(2500)]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_segments(self):
+        source = my2pg.MemorySource({'t': self.rows})
+        segments = my2pg.dump_table(source, self.options, self.plan,
+                                    self.directory)
+        self.assertEqual(len(segments), 3)
+        self.assertEqual([s['file'] for s in segments],
+                         ['t.0000.copy.gz', 't.0001.copy.gz',
+                          't.0002.copy.gz'])
+        self.assertEqual(sum(s['rows'] for s in segments), 2500)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         [s['file'] for s in segments])
+        data = []
+        for segment in segments:
+            f = gzip.open(os.path.join(self.directory, segment['file']))
+            lines = f.read().splitlines()
+            f.close()
+            self.assertEqual(len(lines), segment['rows'])
+            self.assertEqual(sum(len(line) + 1 for line in lines),
+                             segment['bytes'])
+            data.extend(lines)
+        self.assertEqual(data, ['%i\t%s' % row for row in self.rows])
+
+    def test_failure_closes_cursor(self):
+        closed = []
+
+        class Cursor(my2pg.MemorySourceCursor):
+            def fetchmany(self, size):
+                raise IOError('lost connection')
+
+            def close(self):
+                closed.append(self)
+
+        source = my2pg.MemorySource({'t': self.rows})
+        source.cursor = lambda cursorclass=None: Cursor(source)
+        self.assertRaises(IOError, my2pg.dump_table, source,
+                          self.options, self.plan, self.directory)
+        self.assertEqual(len(closed), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_load_segment(self):
+        source = my2pg.MemorySource({'t': self.rows[:3]})
+        segment, = my2pg.dump_table(source, self.options, self.plan,
+                                    self.directory)
+        out = StringIO.StringIO()
+        my2pg._worker.update(options=self.options,
+                             db_args=(None, None, 'pg', 'db'),
+                             pg_conn=my2pg.FileSink(out))
+        try:
+            result = my2pg.load_segment_worker(
+                ('t', self.plan.copy_sql,
+                 os.path.join(self.directory, segment['file']), 3))
+        finally:
+            my2pg._worker.clear()
+        self.assertEqual(result[2:], (3, None))
+        self.assertEqual(out.getvalue(),
+                         'BEGIN;\n' + self.plan.copy_sql + ';\n' +
+                         ''.join('%i\t%s\n' % row for row in self.rows[:3]) +
+                         '\\.\nCOMMIT;\nBEGIN;\n')
+
+
+class FakeSchemaCursor(object):
+    """Answers read_mysql_tables()' and read_mysql_fingerprints() queries."""
+
+    def __init__(self, fingerprints):
+        self.fingerprints = fingerprints
+        self.queries = []
+        self.columns = [
+            dict(TABLE_NAME='a', COLUMN_NAME='id', COLUMN_TYPE='int(11)',
+                 ORDINAL_POSITION=1, COLUMN_DEFAULT=None, IS_NULLABLE='NO',
+                 EXTRA='auto_increment'),
+            dict(TABLE_NAME='a', COLUMN_NAME='name', COLUMN_TYPE='text',
+                 ORDINAL_POSITION=2, COLUMN_DEFAULT=None, IS_NULLABLE='YES',
+                 EXTRA=''),
+            dict(TABLE_NAME='b', COLUMN_NAME='x', COLUMN_TYPE='int(11)',
+                 ORDINAL_POSITION=1, COLUMN_DEFAULT=None, IS_NULLABLE='YES',
+                 EXTRA=''),
+        ]
+        self.statistics = [
+            dict(TABLE_NAME='a', INDEX_NAME='PRIMARY', COLUMN_NAME='id',
+                 INDEX_TYPE='BTREE', NON_UNIQUE=0, NULLABLE=''),
+            dict(TABLE_NAME='b', INDEX_NAME='xy', COLUMN_NAME='x',
+                 INDEX_TYPE='BTREE', NON_UNIQUE=1, NULLABLE='YES'),
+        ]
+
+    def execute(self, sql, args=()):
+        self.queries.append(sql)
+        tables = [t for t in sorted(self.fingerprints)
+                  if 'IN (' not in sql or t in args]
+        if 'MD5' in sql:
+            self.rows = [dict(TABLE_NAME=t, checksum=self.fingerprints[t])
+                         for t in tables]
+        elif 'information_schema.tables' in sql:
+            self.rows = [dict(TABLE_NAME=t, CREATE_TIME=None) for t in tables]
+        elif 'information_schema.columns' in sql:
+            self.rows = [r for r in self.columns if r['TABLE_NAME'] in tables]
+        elif 'information_schema.statistics' in sql:
+            self.rows = [r for r in self.statistics
+                         if r['TABLE_NAME'] in tables]
+        else:
+            self.rows = []
+
+    def fetchall(self):
+        return self.rows
+
+
+class IntrospectionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({'starting_table': None,
+                                        'date_conversion': 'server',
+                                        'geometry': 'wkt',
+                                        'unique_indexes': False})
+
+    def test_read_mysql_tables(self):
+        cursor = FakeSchemaCursor({'a': '1', 'b': '1'})
+        tables, table_cols, table_indexes = my2pg.read_mysql_tables(
+            cursor, 'db', self.options)
+        self.assertEqual(len(cursor.queries), 3)
+        self.assertEqual(tables, ['a', 'b'])
+        self.assertEqual([c.name for c in table_cols['a']], ['id', 'name'])
+        self.assertTrue(table_cols['a'][0].auto_increment)
+        self.assertEqual([i.name for i in table_indexes['a']], ['PRIMARY'])
+        self.assertEqual(table_indexes['b'][0].column_names, ['x'])
+
+    def test_cache(self):
+        plans, cache = my2pg.read_table_plans(
+            FakeSchemaCursor({'a': '1', 'b': '1'}), 'db', self.options,
+            'public', {})
+        self.assertEqual([p.table for p in plans], ['a', 'b'])
+
+        # Only the table whose fingerprint changed is read again.
+        cursor = FakeSchemaCursor({'a': '1', 'b': '2'})
+        plans2, cache2 = my2pg.read_table_plans(
+            cursor, 'db', self.options, 'public', cache)
+        self.assertTrue(plans2[0] is plans[0])
+        self.assertFalse(plans2[1] is plans[1])
+        self.assertTrue([q for q in cursor.queries if 'IN (' in q])
+
+        # A different target schema rebuilds the cached plans.
+        plans3, cache3 = my2pg.read_table_plans(
+            FakeSchemaCursor({'a': '1', 'b': '2'}), 'db', self.options,
+            'other', cache2)
+        self.assertEqual(plans3[0].schema, 'other')
+
+        # So does --unique-indexes.
+        self.options.unique_indexes = True
+        plans4, cache4 = my2pg.read_table_plans(
+            FakeSchemaCursor({'a': '1', 'b': '2'}), 'db', self.options,
+            'other', cache3)
+        self.assertFalse(plans4[0] is plans3[0])
+        self.assertTrue(plans4[0].unique_indexes)
+
+
+class FakeKeyCursor(object):
+    """Answers the MIN/MAX and EXPLAIN queries of primary_key_chunks()."""
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def execute(self, sql):
+        if sql.startswith('EXPLAIN'):
+            lo, hi = [int(v) for v in re.findall(r'(\d+)', sql)[-2:]]
+            self.row = {'rows': len([k for k in self.keys if lo <= k <= hi])}
+        else:
+            self.row = {'lo': min(self.keys or [None]),
+                        'hi': max(self.keys or [None])}
+
+    def fetchone(self):
+        return self.row
+
+
+class ChunkingTestCase(unittest.TestCase):
+    def test_integer_primary_key(self):
+        cols = [my2pg.Column(name='id', type='int(11)', auto_increment=True),
+                my2pg.Column(name='code', type='varchar(8)',
+                             auto_increment=False)]
+        pk = my2pg.Index(name='PRIMARY', column_names=['id'])
+        self.assertTrue(my2pg.integer_primary_key(cols, [pk]) is cols[0])
+        pk.column_names = ['code']
+        self.assertEqual(my2pg.integer_primary_key(cols, [pk]), None)
+        pk.column_names = ['id', 'code']
+        self.assertEqual(my2pg.integer_primary_key(cols, [pk]), None)
+        self.assertEqual(my2pg.integer_primary_key(cols, []), None)
+
+    def test_chunks_follow_gaps(self):
+        keys = range(1, 101) + range(100000, 100100)
+        pk = my2pg.Column(name='id')
+        chunks = my2pg.primary_key_chunks(FakeKeyCursor(keys), 't', pk, 50)
+        # The ranges cover the whole key space without overlapping...
+        self.assertEqual(chunks[0][0], 1)
+        self.assertEqual(chunks[-1][1], 100099)
+        for (lo1, hi1), (lo2, hi2) in zip(chunks, chunks[1:]):
+            self.assertEqual(hi1 + 1, lo2)
+        # ...and hold no more than 50 rows each.
+        sizes = [len([k for k in keys if lo <= k <= hi]) for lo, hi in chunks]
+        self.assertEqual(sum(sizes), 200)
+        self.assertTrue(max(sizes) <= 50)
+        self.assertTrue(len(chunks) <= 8)
+
+    def test_empty_table(self):
+        pk = my2pg.Column(name='id')
+        self.assertEqual(my2pg.primary_key_chunks(FakeKeyCursor([]), 't',
+                                                  pk, 50), [])
+
+
+class FakeChecksumCursor(object):
+    """Answers the checksum queries of verify_range() from {key: md5}."""
+
+    def __init__(self, rows, queries):
+        self.rows = rows
+        self.queries = queries
+
+    def execute(self, sql):
+        self.queries.append(sql)
+        lo = re.search(r'>= (\d+)', sql)
+        hi = re.search(r'<= (\d+)', sql)
+        keys = sorted(k for k in self.rows
+                      if (lo is None or k >= int(lo.group(1))) and
+                      (hi is None or k <= int(hi.group(1))))
+        if 'COUNT(*)' in sql.upper():
+            self.result = [(len(keys), sum(int(self.rows[k][:15], 16)
+                                           for k in keys))]
+        elif 'MIN(' in sql.upper():
+            self.result = [(keys and keys[0] or None,
+                            keys and keys[-1] or None)]
+        else:
+            self.result = [(k, self.rows[k]) for k in keys]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+    def close(self):
+        pass
+
+
+class FakeChecksumConnection(object):
+    def __init__(self, rows):
+        self.rows = rows
+        self.queries = []
+
+    def cursor(self):
+        return FakeChecksumCursor(self.rows, self.queries)
+
+
+class VerifyTestCase(unittest.TestCase):
+    def setUp(self):
+        cols = [make_column('id', 'int(11)', is_nullable=False),
+                make_column('created', 'datetime', is_nullable=False),
+                make_column('data', 'blob'),
+                make_column('score', 'double')]
+        indexes = [my2pg.Index(name='PRIMARY', table='t',
+                               column_names=['id'])]
+        self.plan = my2pg.TablePlan('public', 't', cols, indexes)
+        self.rows = dict((k, hashlib.md5(str(k)).hexdigest())
+                         for k in range(1, 5001))
+        self.diffs = {'missing': [], 'extra': [], 'different': [],
+                      'tables': []}
+
+    def verify(self, pg_rows, lo=None, hi=None):
+        mysql_conn = FakeChecksumConnection(self.rows)
+        pg_conn = FakeChecksumConnection(pg_rows)
+        my2pg.verify_range(mysql_conn, pg_conn, self.plan, lo, hi,
+                           self.diffs)
+        return mysql_conn.queries
+
+    def test_checksum_exprs(self):
+        my, pg = my2pg.checksum_exprs(self.plan.columns[1])
+        self.assertTrue("'0000-00-00 00:00:00'" in my)
+        self.assertTrue("'1970-01-01 00:00:00'" in my)
+        self.assertEqual(pg, "COALESCE(to_char(\"created\", "
+                         "'YYYY-MM-DD HH24:MI:SS'), '~NULL~')")
+        my, pg = my2pg.checksum_exprs(self.plan.columns[2])
+        self.assertEqual(my, "IFNULL(HEX(`data`), '~NULL~')")
+        my, pg = my2pg.checksum_exprs(self.plan.columns[3])
+        self.assertTrue('DECIMAL(65, 6)' in my)
+        self.assertTrue('round("score"::numeric, 6)' in pg)
+
+    def test_matching_ranges(self):
+        queries = self.verify(dict(self.rows))
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self.diffs, {'missing': [], 'extra': [],
+                                      'different': [], 'tables': []})
+
+    def test_narrowing(self):
+        pg_rows = dict(self.rows)
+        del pg_rows[17]
+        pg_rows[4000] = '0' * 32
+        pg_rows[9999] = '1' * 32
+        queries = self.verify(pg_rows)
+        self.assertEqual(self.diffs['missing'], [17])
+        self.assertEqual(self.diffs['extra'], [9999])
+        self.assertEqual(self.diffs['different'], [4000])
+        # Matching halves stop the descent early, and only ranges of up
+        # to VERIFY_ROWS rows are fetched row by row.
+        self.assertTrue(len(queries) < 40)
+        fetched = [sql for sql in queries
+                   if 'COUNT' not in sql and 'MIN' not in sql]
+        self.assertEqual(len(fetched), 3)
+        for sql in fetched:
+            lo, hi = [int(v) for v in re.findall(r'[<>]= (\d+)', sql)]
+            self.assertTrue(len([k for k in self.rows if lo <= k <= hi])
+                            <= my2pg.VERIFY_ROWS)
+
+    def test_no_primary_key(self):
+        self.plan.primary_key = None
+        self.verify({1: self.rows[1]})
+        self.assertEqual(self.diffs['tables'], ['t'])
+        self.assertEqual(self.diffs['missing'], [])
+
+
+class WriteRowsEvent(object):
+    """Stand-ins for python-mysql-replication's events."""
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+
+class QueryEvent(WriteRowsEvent):
+    pass
+
+
+class FakeSettingsCursor(object):
+    def __init__(self, settings):
+        self.settings = settings
+
+    def execute(self, sql):
+        pass
+
+    def fetchall(self):
+        return self.settings.items()
+
+    def close(self):
+        pass
+
+
+class FakeSettingsConnection(object):
+    def __init__(self, **settings):
+        self.settings = settings
+
+    def cursor(self):
+        return FakeSettingsCursor(self.settings)
+
+
+class ReplicationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.options = optparse.Values({
+            'dry_run': False, 'batch_size': 100, 'reject_file': None,
+            'commit_rows': 1000, 'commit_seconds': 1000.0,
+            'catch_up': True, 'metrics_file': None})
+        self.plan = my2pg.TablePlan(
+            'public', 't', [make_column('id', 'int(11)', is_nullable=False),
+                            make_column('name', 'varchar(10)'),
+                            make_column('born', 'date', is_nullable=False),
+                            make_column('shape', 'point')],
+            [my2pg.Index(name='PRIMARY', table='t', type='BTREE',
+                         column_names=['id'])])
+        self.nokey = my2pg.TablePlan('public', 'log',
+                                     [make_column('msg', 'text')], [])
+        self.point = '\x00' * 4 + '\x01\x01\x00\x00\x00' + struct.pack(
+            '<dd', 1, 2)
+
+    def event(self, log_pos, kind, table=None, rows=(), **kw):
+        return my2pg.BinlogEvent(kind=kind, table=table, rows=list(rows),
+                                 log_file='mysql-bin.000002',
+                                 log_pos=log_pos, **kw)
+
+    def values(self, id, name, born=None, shape=None):
+        return {'id': id, 'name': name, 'born': born, 'shape': shape}
+
+    def test_for_binlog(self):
+        plan = self.plan.for_binlog()
+        self.assertEqual(plan.key_positions, [0])
+        self.assertEqual(plan.delete_sql,
+                         'DELETE FROM "public".t WHERE ("id") IN %s')
+        self.assertTrue('ON CONFLICT ("id") DO UPDATE' in plan.insert_sql)
+        self.assertEqual(self.nokey.for_binlog(), None)
+
+    def test_apply(self):
+        now = int(time.time())
+        born = datetime.date(1990, 5, 17)
+        binlog = my2pg.RecordedBinlog([
+            # Before the recorded position, so already converted.
+            self.event(100, 'insert', 't', [self.values(9, 'old', born)]),
+            self.event(120, 'commit', timestamp=now),
+            self.event(200, 'insert', 't', [
+                self.values(1, 'a', born), self.values(2, 'b', None),
+                self.values(3, 'c', born, self.point)]),
+            self.event(250, 'update', 't', [
+                (self.values(2, 'b', None), self.values(2, u'b\xe9', born))]),
+            self.event(300, 'update', 't', [
+                (self.values(3, 'c', born, self.point),
+                 self.values(4, 'c', born, self.point))]),
+            self.event(350, 'delete', 't', [self.values(1, 'a', born)]),
+            self.event(360, 'insert', 'log', [{'msg': 'ignored'}]),
+            self.event(400, 'commit', timestamp=now),
+            # Not committed yet.
+            self.event(500, 'insert', 't', [self.values(5, 'e', born)]),
+        ])
+        pg_conn = FakeConnection()
+        applier = my2pg.apply_binlog(pg_conn, self.options,
+                                     [self.plan, self.nokey], binlog,
+                                     'mysql/db', ('mysql-bin.000002', 150))
+        self.assertEqual(pg_conn.commits, 1)
+        self.assertEqual(applier.applied, 4)
+        self.assertEqual(applier.position, ('mysql-bin.000002', 400))
+        self.assertEqual(len(applier.current), 1)
+        self.assertTrue(0 <= applier.lag < 60)
+
+        deletes = [args for sql, args in pg_conn.executed
+                   if sql.startswith('DELETE FROM "public".t')]
+        self.assertEqual(len(deletes), 1)
+        self.assertEqual(sorted(deletes[0][0]), [(1,), (3,)])
+        upserted = sorted(zip(*[iter(pg_conn.inserted[:8])] * 4))
+        self.assertEqual(upserted[0][:3], (2, u'b\xe9', born))
+        self.assertEqual(upserted[1][:3], (4, 'c', born))
+        self.assertTrue(isinstance(upserted[1][3], my2pg.GeometryWKB))
+        # The position is recorded with the batch.
+        self.assertEqual(pg_conn.inserted[8:],
+                         ['mysql/db', 'mysql-bin.000002', 400])
+
+    def test_myisam_commit(self):
+        # Changes to non-transactional tables end with a COMMIT query
+        # rather than an XID event.
+        events = [
+            my2pg.binlog_event(WriteRowsEvent(
+                table='t', timestamp=0,
+                rows=[{'values': self.values(1, 'a')}]),
+                'mysql-bin.000002', 10),
+            my2pg.binlog_event(QueryEvent(query='BEGIN', timestamp=0),
+                               'mysql-bin.000002', 15),
+            my2pg.binlog_event(QueryEvent(query='COMMIT', timestamp=0),
+                               'mysql-bin.000002', 20),
+        ]
+        self.assertEqual(events[0].kind, 'insert')
+        self.assertEqual(events[0].rows, [self.values(1, 'a')])
+        self.assertEqual(events[1], None)
+        self.assertEqual(events[2].kind, 'commit')
+        pg_conn = FakeConnection()
+        applier = my2pg.apply_binlog(
+            pg_conn, self.options, [self.plan],
+            my2pg.RecordedBinlog([e for e in events if e is not None]),
+            'mysql/db', ('mysql-bin.000002', 0))
+        self.assertEqual(applier.applied, 1)
+        self.assertEqual(applier.current, [])
+        self.assertEqual(applier.position, ('mysql-bin.000002', 20))
+
+    def test_binlog_settings(self):
+        check = my2pg.check_binlog_settings
+        self.assertEqual(check(FakeSettingsConnection(
+            log_bin='ON', binlog_format='ROW', binlog_row_image='FULL')),
+            None)
+        # Before MySQL 5.6, row images were always full.
+        self.assertEqual(check(FakeSettingsConnection(
+            log_bin='ON', binlog_format='ROW')), None)
+        self.assertEqual(check(FakeSettingsConnection(
+            log_bin='OFF', binlog_format='ROW')), 'binary logging is off')
+        self.assertEqual(check(FakeSettingsConnection(
+            log_bin='ON', binlog_format='MIXED')),
+            'binlog_format is MIXED, not ROW')
+        self.assertEqual(check(FakeSettingsConnection(
+            log_bin='ON', binlog_format='ROW', binlog_row_image='MINIMAL')),
+            'binlog_row_image is MINIMAL, not FULL')
+
+    def test_zero_dates(self):
+        # The binlog gives zero dates as None; NOT NULL ones become the
+        # epoch, like in the bulk conversion.
+        applier = my2pg.BinlogApplier([self.plan], 'public', 'mysql/db',
+                                      ('mysql-bin.000002', 0))
+        applier.add(self.event(10, 'insert', 't',
+                               [self.values(1, None, None)]))
+        self.assertEqual(applier.current[0][2][2], my2pg.EPOCH_DATE)
+
+    def test_batches(self):
+        # A batch ends once --commit-rows changes are committed, and
+        # when MySQL goes quiet.
+        self.options.commit_rows = 2
+        binlog = my2pg.RecordedBinlog([
+            self.event(10, 'insert', 't', [self.values(1, 'a'),
+                                           self.values(2, 'b')]),
+            self.event(20, 'commit', timestamp=0),
+            self.event(30, 'insert', 't', [self.values(3, 'c')]),
+            self.event(40, 'commit', timestamp=0),
+            self.event(40, 'heartbeat'),
+        ])
+        pg_conn = FakeConnection()
+        applier = my2pg.apply_binlog(pg_conn, self.options, [self.plan],
+                                     binlog, 'mysql/db',
+                                     ('mysql-bin.000002', 0))
+        self.assertEqual(pg_conn.commits, 2)
+        self.assertEqual(applier.applied, 3)
+
+
 if __name__ == '__main__':
     unittest.main()